@@ -0,0 +1,150 @@
+"""
+本地模型替身服务：只用标准库实现 OpenAI 兼容的 /v1/models 和 /v1/chat/completions 接口，
+返回固定的示例内容，用来在没有网络、没有API密钥时完整运行和调试写作应用。
+
+用法：
+    python local_llm_server.py --port 8080
+    AI_BACKENDS='[{"name": "local", "base_url": "http://127.0.0.1:8080/v1", "model": "local-stand-in"}]' streamlit run magic_writing_app.py
+
+真正部署时把 base_url 换成局域网里的 llama.cpp / vLLM 等服务即可。
+"""
+import argparse
+import json
+import re
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, List
+
+MODEL_NAME = "local-stand-in"
+CHUNK_SIZE = 6  # 流式返回时每段的字符数
+
+def build_evaluation(prompt: str) -> str:
+    """作文评价提示词：按作文长度给出一份格式完整的JSON评价"""
+    match = re.search(r"作文内容：(.*)", prompt, re.S)
+    content = match.group(1) if match else ""
+    words = len(content.split())
+    base = max(60, min(92, 60 + words // 5))
+    dimension_scores = {
+        "structure": base,
+        "vocabulary": base - 2,
+        "phrases": base - 4,
+        "sentence_patterns": base - 3,
+        "grammar": base + 1,
+        "content": base + 2
+    }
+    evaluation = {
+        "overall_score": base,
+        "dimension_scores": dimension_scores,
+        "english_evaluation": f"The essay has {words} words. The ideas are clear; try adding more linking words and varied sentences.",
+        "chinese_evaluation": f"作文共{words}个单词，思路清楚。可以多用连接词，并尝试不同的句式。",
+        "improvement_suggestions": [
+            "在段落开头使用 First / Then / Finally 等连接词",
+            "把两个简单句合并成一个带 because 或 when 的复合句",
+            "结尾加一句总结自己的感受"
+        ],
+        "encouragement": "写得很认真，继续加油！"
+    }
+    return json.dumps(evaluation, ensure_ascii=False)
+
+def build_reply(messages: List[Dict]) -> str:
+    prompt = str(messages[-1].get("content", "")) if messages else ""
+    # 固定的评分要求放在system消息里，作文本身在最后一条user消息里
+    if any("overall_score" in str(message.get("content", "")) for message in messages):
+        return build_evaluation(prompt)
+    topic_match = re.search(r"主题[：:]\s*(.+)", prompt)
+    topic = topic_match.group(1).strip() if topic_match else "this topic"
+    return (f"### 本地示例内容：{topic}\n\n"
+            "1. **Opening**: Start with one sentence that tells the reader what you will write about.\n"
+            "2. **Details**: Give two or three examples with time, place and feelings.\n"
+            "3. **Ending**: Finish with what you learned or how you felt.\n\n"
+            "（本内容由本地替身服务生成，仅用于调试。）")
+
+class ChatHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    delay = 0.0  # 模拟推理耗时（秒）
+
+    def do_GET(self):
+        if self.path.rstrip("/").endswith("/models"):
+            self._send_json(200, {"object": "list", "data": [{"id": MODEL_NAME, "object": "model"}]})
+        else:
+            self._send_json(404, {"error": "not found"})
+
+    def do_POST(self):
+        if not self.path.rstrip("/").endswith("/chat/completions"):
+            self._send_json(404, {"error": "not found"})
+            return
+        try:
+            length = int(self.headers.get("Content-Length", 0))
+            request = json.loads(self.rfile.read(length) or b"{}")
+        except ValueError:
+            self._send_json(400, {"error": "invalid json"})
+            return
+
+        if self.delay:
+            time.sleep(self.delay)
+        messages = request.get("messages") or []
+        reply = build_reply(messages)
+        prompt_tokens = sum(len(str(message.get("content", ""))) for message in messages) // 2
+        usage = {"prompt_tokens": prompt_tokens, "completion_tokens": len(reply) // 2,
+                 "total_tokens": prompt_tokens + len(reply) // 2}
+        if request.get("stream"):
+            self._send_stream(reply, usage, bool((request.get("stream_options") or {}).get("include_usage")))
+        else:
+            self._send_json(200, {
+                "object": "chat.completion",
+                "model": request.get("model", MODEL_NAME),
+                "choices": [{"index": 0, "message": {"role": "assistant", "content": reply}, "finish_reason": "stop"}],
+                "usage": usage
+            })
+
+    def _send_json(self, status: int, body: Dict):
+        data = json.dumps(body, ensure_ascii=False).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _send_stream(self, reply: str, usage: Dict, include_usage: bool):
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        events = [{"choices": [{"index": 0, "delta": {"content": reply[i:i + CHUNK_SIZE]}}]}
+                  for i in range(0, len(reply), CHUNK_SIZE)]
+        if include_usage:
+            events.append({"choices": [], "usage": usage})
+        try:
+            for event in events:
+                self._write_chunk(f"data: {json.dumps(event, ensure_ascii=False)}\n\n".encode("utf-8"))
+            self._write_chunk(b"data: [DONE]\n\n")
+            self._write_chunk(b"")
+        except (BrokenPipeError, ConnectionResetError):
+            # 客户端取消了请求
+            pass
+
+    def _write_chunk(self, data: bytes):
+        self.wfile.write(b"%x\r\n%s\r\n" % (len(data), data))
+        self.wfile.flush()
+
+    def log_message(self, format, *args):
+        pass
+
+def main():
+    parser = argparse.ArgumentParser(description="OpenAI兼容的本地模型替身服务")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--delay", type=float, default=0.0, help="每个请求模拟的推理耗时（秒）")
+    args = parser.parse_args()
+
+    ChatHandler.delay = args.delay
+    server = ThreadingHTTPServer((args.host, args.port), ChatHandler)
+    server.daemon_threads = True
+    print(f"本地模型替身服务已启动：http://{args.host}:{args.port}/v1")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == "__main__":
+    main()
@@ -3,12 +3,46 @@ import pandas as pd
 import random
 from datetime import datetime
 import json
+import hashlib
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.connection import HTTPConnection, HTTPSConnection
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
 import time
-from typing import List, Dict, Optional
+import threading
+import sqlite3
+import socket
+from collections import Counter, deque, OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor, as_completed
+from streamlit.runtime.scriptrunner import get_script_run_ctx
+from email.utils import parsedate_to_datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import List, Dict, Optional, Iterator, Union, Callable
 import os
+import re
+import sys
+import mmap
+import struct
+import unicodedata
+import itertools
+import uuid
 
 # ==================== DeepSeek API 配置 ====================
+def get_config_value(name: str, default=None):
+    """按 环境变量 → Streamlit secrets 的顺序读取配置项"""
+    value_from_env = os.environ.get(name)
+    if value_from_env:
+        return value_from_env
+
+    try:
+        value_from_secrets = st.secrets.get(name)
+        if value_from_secrets:
+            return value_from_secrets
+    except:
+        pass
+
+    return default
+
 def get_api_key():
     """安全获取API密钥"""
     # 1. 环境变量
@@ -26,63 +60,2521 @@ def get_api_key():
     
     return None
 
-DEEPSEEK_API_KEY = get_api_key()
-DEEPSEEK_API_URL = "https://api.deepseek.com/v1/chat/completions"
-OFFLINE_MODE = DEEPSEEK_API_KEY is None
+def get_api_keys() -> List[str]:
+    """读取密钥池：DEEPSEEK_API_KEYS（逗号分隔或列表）加上 DEEPSEEK_API_KEY，去重后保持顺序"""
+    keys = []
+    pool_value = get_config_value("DEEPSEEK_API_KEYS")
+    if isinstance(pool_value, str):
+        keys.extend(key.strip() for key in pool_value.split(","))
+    elif pool_value:
+        keys.extend(str(key).strip() for key in pool_value)
+    single_key = get_api_key()
+    if single_key:
+        keys.append(single_key)
+    return list(dict.fromkeys(key for key in keys if key))
+
+DEEPSEEK_BASE_URL = get_config_value("DEEPSEEK_BASE_URL", "https://api.deepseek.com/v1")
+DEEPSEEK_MODEL = get_config_value("DEEPSEEK_MODEL", "deepseek-chat")
+
+# ==================== HTTP连接池 ====================
+# 缓存的主机连接池数量，以及每个主机最多保持的keep-alive连接数
+HTTP_POOL_CONNECTIONS = int(get_config_value("DEEPSEEK_POOL_CONNECTIONS", 4))
+HTTP_POOL_MAXSIZE = int(get_config_value("DEEPSEEK_POOL_MAXSIZE", 32))
+
+class RequestAbort:
+    """记录一次流式请求用到的连接，取消时从其他线程关闭它的socket：
+    正在等响应头或两段数据之间的线程立即出错返回，不必等到下一段数据才发现已取消。
+    请求结束（finish）后连接会回到连接池给别的请求用，之后不再关闭它"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.connections: List[HTTPConnection] = []
+        self.aborted = False
+        self.finished = False
+
+    def track(self, connection: HTTPConnection):
+        with self.lock:
+            if not self.finished:
+                self.connections.append(connection)
+
+    def on_connected(self, connection: HTTPConnection):
+        """连接刚建立：取消发生在建立连接期间时立即关闭"""
+        with self.lock:
+            if self.aborted and not self.finished:
+                self._shutdown(connection)
+
+    def abort(self):
+        # 持有锁关闭，保证不会关到已经 finish、回到连接池的连接
+        with self.lock:
+            if self.aborted or self.finished:
+                return
+            self.aborted = True
+            for connection in self.connections:
+                self._shutdown(connection)
+
+    def finish(self):
+        with self.lock:
+            self.finished = True
+
+    @staticmethod
+    def _shutdown(connection: HTTPConnection):
+        sock = getattr(connection, "sock", None)
+        if sock is None:
+            return
+        try:
+            sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+def _tracking_pool_classes(state: threading.local) -> Dict[str, type]:
+    """连接池类：发送请求时把连接登记到当前线程正在进行的 RequestAbort（state.abort）"""
+    def tracking(connection_class: type) -> type:
+        class TrackingConnection(connection_class):
+            def request(self, *args, **kwargs):
+                self.request_abort = getattr(state, "abort", None)
+                if self.request_abort is not None:
+                    self.request_abort.track(self)
+                return super().request(*args, **kwargs)
+
+            def connect(self):
+                super().connect()
+                if getattr(self, "request_abort", None) is not None:
+                    self.request_abort.on_connected(self)
+        return TrackingConnection
+
+    class TrackingHTTPConnectionPool(HTTPConnectionPool):
+        ConnectionCls = tracking(HTTPConnection)
+
+    class TrackingHTTPSConnectionPool(HTTPSConnectionPool):
+        ConnectionCls = tracking(HTTPSConnection)
+
+    return {"http": TrackingHTTPConnectionPool, "https": TrackingHTTPSConnectionPool}
+
+class PooledHTTPTransport:
+    """进程级共享的HTTP传输层，复用keep-alive连接，避免每次请求重新握手"""
+
+    def __init__(self, pool_connections: int, pool_maxsize: int):
+        self.pool_connections = pool_connections
+        self.pool_maxsize = pool_maxsize
+        self.session = requests.Session()
+        # pool_block=True：每个主机的连接数达到上限时排队等待，而不是临时新建连接
+        self.adapter = HTTPAdapter(
+            pool_connections=pool_connections,
+            pool_maxsize=pool_maxsize,
+            pool_block=True,
+            max_retries=0
+        )
+        self.session.mount("https://", self.adapter)
+        self.session.mount("http://", self.adapter)
+        self.state = threading.local()
+        self.adapter.poolmanager.pool_classes_by_scheme = _tracking_pool_classes(self.state)
+
+    def post(self, url: str, abort: Optional[RequestAbort] = None, **kwargs) -> requests.Response:
+        """abort 不为空时登记这次请求用到的连接，之后可以从其他线程调用 abort.abort() 中止"""
+        self.state.abort = abort
+        try:
+            return self.session.post(url, **kwargs)
+        finally:
+            self.state.abort = None
+
+    def stats(self) -> Dict:
+        """连接池统计：新建连接数、复用连接数、空闲连接数"""
+        pools = self.adapter.poolmanager.pools
+        total_requests = 0
+        new_connections = 0
+        idle_connections = 0
+        for pool_key in list(pools.keys()):
+            pool = pools.get(pool_key)
+            if pool is None:
+                continue
+            total_requests += pool.num_requests
+            new_connections += pool.num_connections
+            if pool.pool is not None:
+                # 队列里预先填充了None占位，只统计真正保持着的连接
+                idle_connections += sum(1 for conn in list(pool.pool.queue) if conn is not None)
+
+        return {
+            "hosts": len(pools),
+            "requests": total_requests,
+            "new_connections": new_connections,
+            "reused_connections": max(total_requests - new_connections, 0),
+            "idle_connections": idle_connections,
+            "pool_maxsize": self.pool_maxsize
+        }
 
-def call_deepseek_api(messages: List[Dict], temperature: float = 0.7, max_retries: int = 2) -> Optional[str]:
-    """改进版API调用，更好的错误处理"""
-    if OFFLINE_MODE:
+@st.cache_resource(show_spinner=False)
+def get_http_transport() -> PooledHTTPTransport:
+    """所有Streamlit会话共享同一个连接池"""
+    return PooledHTTPTransport(HTTP_POOL_CONNECTIONS, HTTP_POOL_MAXSIZE)
+
+# ==================== 进程级限流 ====================
+# 所有会话共享的 请求数/分钟 和 token数/分钟 上限
+RATE_LIMIT_RPM = int(get_config_value("DEEPSEEK_RATE_LIMIT_RPM", 60))
+RATE_LIMIT_TPM = int(get_config_value("DEEPSEEK_RATE_LIMIT_TPM", 120000))
+RATE_LIMIT_MAX_WAIT = float(get_config_value("DEEPSEEK_RATE_LIMIT_MAX_WAIT", 30))  # 单次调用最多排队等待的秒数
+RATE_LIMIT_MAX_RETRIES = 5  # 429后最多重新排队的次数
+MAX_COMPLETION_TOKENS = 2000
+
+def estimate_tokens(text: str) -> int:
+    """本地粗略估算token数：中文约每字0.6个token，其他字符约每4个字符1个token"""
+    cjk_chars = sum(1 for char in text if "\u4e00" <= char <= "\u9fff")
+    return int(cjk_chars * 0.6 + (len(text) - cjk_chars) / 4) + 1
+
+def parse_retry_after(value: Optional[str]) -> Optional[float]:
+    """解析Retry-After响应头，支持秒数和HTTP日期两种格式"""
+    if not value:
+        return None
+    try:
+        return max(float(value), 0.0)
+    except ValueError:
+        pass
+    try:
+        return max(parsedate_to_datetime(value).timestamp() - time.time(), 0.0)
+    except (TypeError, ValueError):
+        return None
+
+class TokenBucketRateLimiter:
+    """令牌桶限流器（每个API密钥一个）：请求数和token数两个桶，根据429自适应调整速率（乘性减、加性增）"""
+
+    MIN_RATE_FACTOR = 0.1
+    RATE_DECREASE = 0.5
+    RATE_INCREASE = 0.05
+    DEFAULT_PAUSE = 3.0
+
+    def __init__(self, requests_per_minute: int, tokens_per_minute: int):
+        self.max_rpm = requests_per_minute
+        self.max_tpm = tokens_per_minute
+        self.rate_factor = 1.0
+        self.request_bucket = float(requests_per_minute)
+        self.token_bucket = float(tokens_per_minute)
+        self.paused_until = 0.0
+        self.last_refill = time.monotonic()
+        self.last_decrease = 0.0
+        self.lock = threading.Lock()
+        self.granted = 0
+        self.rate_limited = 0
+
+    def _refill(self, now: float):
+        elapsed = now - self.last_refill
+        self.last_refill = now
+        rpm = self.max_rpm * self.rate_factor
+        tpm = self.max_tpm * self.rate_factor
+        self.request_bucket = min(rpm, self.request_bucket + elapsed * rpm / 60)
+        self.token_bucket = min(tpm, self.token_bucket + elapsed * tpm / 60)
+
+    def try_acquire(self, tokens: int) -> float:
+        """尝试获取一次请求的额度：成功返回0，否则返回预计还需等待的秒数"""
+        with self.lock:
+            now = time.monotonic()
+            self._refill(now)
+            # 单次请求超过桶容量时按容量计算，避免永远拿不到
+            needed_tokens = min(tokens, self.max_tpm * self.rate_factor)
+            if now >= self.paused_until and self.request_bucket >= 1 and self.token_bucket >= needed_tokens:
+                self.request_bucket -= 1
+                self.token_bucket -= needed_tokens
+                self.granted += 1
+                return 0.0
+            
+            rpm = self.max_rpm * self.rate_factor
+            tpm = self.max_tpm * self.rate_factor
+            return max(
+                self.paused_until - now,
+                (1 - self.request_bucket) * 60 / rpm,
+                (needed_tokens - self.token_bucket) * 60 / tpm,
+                0.05
+            )
+
+    def available_fraction(self) -> float:
+        """剩余额度占当前速率上限的比例，用于在多个密钥之间挑选"""
+        with self.lock:
+            now = time.monotonic()
+            self._refill(now)
+            if now < self.paused_until:
+                return 0.0
+            return max(min(self.request_bucket / (self.max_rpm * self.rate_factor),
+                           self.token_bucket / (self.max_tpm * self.rate_factor)), 0.0)
+
+    def record_usage(self, estimated_tokens: int, actual_tokens: Optional[int]):
+        """请求成功：按实际token用量校正桶，并逐步恢复速率"""
+        with self.lock:
+            if actual_tokens is not None:
+                self.token_bucket -= actual_tokens - estimated_tokens
+            self.rate_factor = min(1.0, self.rate_factor + self.RATE_INCREASE)
+
+    def on_rate_limited(self, retry_after: Optional[float]):
+        """收到429：使用该密钥的所有会话一起暂停到Retry-After，并降低速率"""
+        with self.lock:
+            now = time.monotonic()
+            self.rate_limited += 1
+            self.paused_until = max(self.paused_until, now + (retry_after if retry_after is not None else self.DEFAULT_PAUSE))
+            # 同一时刻多个请求同时收到429只算一次降速
+            if now - self.last_decrease > 1.0:
+                self.rate_factor = max(self.MIN_RATE_FACTOR, self.rate_factor * self.RATE_DECREASE)
+                self.last_decrease = now
+            # 清空桶，暂停结束后按新速率匀速放行，而不是同时涌入
+            self.request_bucket = 0.0
+            self.token_bucket = 0.0
+
+    def stats(self) -> Dict:
+        with self.lock:
+            self._refill(time.monotonic())
+            return {
+                "rpm": round(self.max_rpm * self.rate_factor, 1),
+                "tpm": round(self.max_tpm * self.rate_factor),
+                "rate_factor": round(self.rate_factor, 2),
+                "paused_for": round(max(self.paused_until - time.monotonic(), 0.0), 1),
+                "granted": self.granted,
+                "rate_limited": self.rate_limited
+            }
+
+# ==================== API密钥池 ====================
+AUTH_FAILURE_BENCH_SECONDS = 600  # 密钥鉴权失败（401/403）后停用的时间
+
+class ApiKeyState:
+    """密钥池中单个密钥的限流器、停用时间和用量统计"""
+
+    def __init__(self, key: str, index: int, requests_per_minute: int, tokens_per_minute: int):
+        self.key = key
+        self.index = index  # 在配置列表中的序号，统计里只用它标识密钥
+        self.limiter = TokenBucketRateLimiter(requests_per_minute, tokens_per_minute)
+        self.benched_until = 0.0
+        self.bench_reason = ""
+        self.tokens_used = 0
+        self.auth_failures = 0
+
+    @property
+    def label(self) -> str:
+        return f"#{self.index}"
+
+class ApiKeyPool:
+    """API密钥池：按剩余额度分配请求，收到429的密钥暂时停用，所有会话共享"""
+
+    def __init__(self, requests_per_minute: int, tokens_per_minute: int):
+        self.requests_per_minute = requests_per_minute
+        self.tokens_per_minute = tokens_per_minute
+        self.states: Dict[str, ApiKeyState] = {}
+        self.lock = threading.Lock()
+        self.rejected = 0
+        self.granted = 0
+        self.total_wait = 0.0
+
+    def sync(self, keys: List[str]):
+        """与最新配置的密钥列表同步：保留已有密钥的状态，加入新密钥，移除已删除的密钥"""
+        with self.lock:
+            for index, key in enumerate(keys, 1):
+                if key not in self.states:
+                    self.states[key] = ApiKeyState(key, index, self.requests_per_minute, self.tokens_per_minute)
+                self.states[key].index = index
+            for key in list(self.states):
+                if key not in keys:
+                    del self.states[key]
+
+    def acquire(self, tokens: int, timeout: float) -> Optional[ApiKeyState]:
+        """排队获取一个有额度的密钥，优先剩余额度最多的；timeout内拿不到时返回None"""
+        started = time.monotonic()
+        deadline = started + timeout
+        while True:
+            now = time.monotonic()
+            with self.lock:
+                states = list(self.states.values())
+            available = [state for state in states if state.benched_until <= now]
+            available.sort(key=lambda state: state.limiter.available_fraction(), reverse=True)
+            
+            wait = None
+            for state in available:
+                state_wait = state.limiter.try_acquire(tokens)
+                if state_wait == 0:
+                    with self.lock:
+                        self.granted += 1
+                        self.total_wait += now - started
+                    return state
+                wait = state_wait if wait is None else min(wait, state_wait)
+            if wait is None:
+                # 全部密钥都在停用期，等最早恢复的那个
+                benched = [state.benched_until - now for state in states]
+                wait = min(benched) if benched else timeout + 1
+            
+            if now + wait > deadline:
+                with self.lock:
+                    self.rejected += 1
+                return None
+            # 分段睡眠，让其他线程有机会在额度恢复时先拿到
+            time.sleep(min(wait, 0.5))
+
+    def record_usage(self, state: ApiKeyState, estimated_tokens: int, actual_tokens: Optional[int]):
+        state.limiter.record_usage(estimated_tokens, actual_tokens)
+        with self.lock:
+            state.tokens_used += actual_tokens if actual_tokens is not None else estimated_tokens
+
+    def on_rate_limited(self, state: ApiKeyState, retry_after: Optional[float]):
+        """收到429：降低该密钥的速率并停用到Retry-After，其他密钥继续服务"""
+        state.limiter.on_rate_limited(retry_after)
+        pause = retry_after if retry_after is not None else TokenBucketRateLimiter.DEFAULT_PAUSE
+        with self.lock:
+            state.benched_until = max(state.benched_until, time.monotonic() + pause)
+            state.bench_reason = "429"
+
+    def on_auth_failed(self, state: ApiKeyState):
+        """鉴权失败的密钥长时间停用，避免一直分到请求"""
+        with self.lock:
+            state.auth_failures += 1
+            state.benched_until = time.monotonic() + AUTH_FAILURE_BENCH_SECONDS
+            state.bench_reason = "鉴权失败"
+
+    def stats(self) -> Dict:
+        with self.lock:
+            states = list(self.states.values())
+            summary = {
+                "granted": self.granted,
+                "rejected": self.rejected,
+                "avg_wait": round(self.total_wait / self.granted, 2) if self.granted else 0.0
+            }
+        now = time.monotonic()
+        summary["keys"] = [
+            {
+                "key": state.label,
+                "tokens_used": state.tokens_used,
+                "benched_for": round(max(state.benched_until - now, 0.0), 1),
+                "bench_reason": state.bench_reason,
+                **state.limiter.stats()
+            }
+            for state in states
+        ]
+        return summary
+
+@st.cache_resource(show_spinner=False)
+def get_key_pool() -> ApiKeyPool:
+    """所有Streamlit会话共享同一个密钥池，每个密钥按单个账号的速率上限限流"""
+    return ApiKeyPool(RATE_LIMIT_RPM, RATE_LIMIT_TPM)
+
+class StreamIncomplete(Exception):
+    """流式响应在结束标记（[DONE] 或 finish_reason）之前中断，已收到的内容不完整"""
+
+def iter_stream_content(response: requests.Response,
+                        on_usage: Optional[Callable[[Optional[Dict], Optional[bool]], None]] = None,
+                        abort: Optional[RequestAbort] = None) -> Iterator[str]:
+    """解析SSE流式响应，逐段产出模型生成的文本。流结束后回调 on_usage(usage, complete)：
+    usage 是最后一段里的用量（没有时为None），complete 表示是否收到了结束标记，调用方提前关闭时为None。
+    没有收到结束标记就断开时，产出已收到的内容后抛出 StreamIncomplete；abort 在连接还给连接池之前结束"""
+    # text/event-stream 没有声明charset时requests会按ISO-8859-1解码，中文会乱码
+    response.encoding = "utf-8"
+    usage = None
+    complete: Optional[bool] = False
+    try:
+        for line in response.iter_lines(decode_unicode=True):
+            if not line or not line.startswith("data:"):
+                continue
+            data = line[len("data:"):].strip()
+            if data == "[DONE]":
+                complete = True
+                break
+            try:
+                chunk = json.loads(data)
+            except ValueError:
+                continue
+            if chunk.get("usage"):
+                usage = chunk["usage"]
+            choices = chunk.get("choices") or []
+            if choices:
+                if choices[0].get("finish_reason"):
+                    complete = True
+                content = (choices[0].get("delta") or {}).get("content")
+                if content:
+                    yield content
+    except GeneratorExit:
+        complete = None
+        raise
+    except requests.exceptions.RequestException:
+        pass
+    finally:
+        if abort is not None:
+            abort.finish()
+        response.close()
+        if on_usage is not None:
+            on_usage(usage, complete)
+    if not complete:
+        raise StreamIncomplete("AI回复中途断开")
+
+# ==================== 熔断器 ====================
+# 最近 BREAKER_WINDOW_SIZE 次调用中失败率或慢调用比例超过阈值时熔断，熔断期间直接使用离线内容
+BREAKER_FAILURE_RATE = float(get_config_value("DEEPSEEK_BREAKER_FAILURE_RATE", 0.5))
+BREAKER_SLOW_CALL_SECONDS = float(get_config_value("DEEPSEEK_BREAKER_SLOW_CALL_SECONDS", 15))
+BREAKER_SLOW_CALL_RATE = float(get_config_value("DEEPSEEK_BREAKER_SLOW_CALL_RATE", 0.8))
+BREAKER_OPEN_SECONDS = float(get_config_value("DEEPSEEK_BREAKER_OPEN_SECONDS", 30))
+BREAKER_WINDOW_SIZE = 20
+BREAKER_MIN_CALLS = 5
+BREAKER_PROBE_FAILURES = 3  # 健康检查连续失败这么多次才熔断，偶尔一次探测超时不影响正常请求
+
+class CircuitBreaker:
+    """熔断器：closed 正常放行 → open 直接走离线兜底 → half_open 放一个探测请求决定是否恢复"""
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(self, failure_rate: float, slow_call_seconds: float, slow_call_rate: float,
+                 open_seconds: float, window_size: int = BREAKER_WINDOW_SIZE, min_calls: int = BREAKER_MIN_CALLS,
+                 probe_failures: int = BREAKER_PROBE_FAILURES):
+        self.failure_rate = failure_rate
+        self.slow_call_seconds = slow_call_seconds
+        self.slow_call_rate = slow_call_rate
+        self.open_seconds = open_seconds
+        self.min_calls = min_calls
+        self.probe_failures = max(probe_failures, 1)
+        self.failed_probes = 0  # 连续失败的健康检查次数
+        self.outcomes = deque(maxlen=window_size)  # (是否成功, 耗时)
+        self.state = self.CLOSED
+        self.opened_at = 0.0
+        self.probe_started = 0.0
+        self.trips = 0
+        self.short_circuited = 0
+        self.lock = threading.Lock()
+
+    def allow_request(self) -> bool:
+        """当前是否可以向上游发请求；熔断冷却结束后只放行一个探测请求"""
+        with self.lock:
+            now = time.monotonic()
+            if self.state == self.CLOSED:
+                return True
+            if self.state == self.OPEN and now - self.opened_at >= self.open_seconds:
+                self.state = self.HALF_OPEN
+                self.probe_started = 0.0
+            # 探测请求长时间没有结果（例如会话中断）时允许新的探测
+            if self.state == self.HALF_OPEN and now - self.probe_started >= self.open_seconds:
+                self.probe_started = now
+                return True
+            self.short_circuited += 1
+            return False
+
+    def record_success(self, latency: float):
+        with self.lock:
+            if self.state == self.HALF_OPEN:
+                if latency < self.slow_call_seconds:
+                    self.state = self.CLOSED
+                    self.outcomes.clear()
+                else:
+                    self._trip()
+                return
+            self.outcomes.append((True, latency))
+            self._evaluate()
+
+    def record_failure(self, latency: float):
+        with self.lock:
+            if self.state == self.HALF_OPEN:
+                self._trip()
+                return
+            self.outcomes.append((False, latency))
+            self._evaluate()
+
+    def _evaluate(self):
+        if self.state != self.CLOSED or len(self.outcomes) < self.min_calls:
+            return
+        total = len(self.outcomes)
+        failures = sum(1 for ok, _ in self.outcomes if not ok)
+        slow_calls = sum(1 for _, latency in self.outcomes if latency >= self.slow_call_seconds)
+        if failures / total >= self.failure_rate or slow_calls / total >= self.slow_call_rate:
+            self._trip()
+
+    def on_health_probe(self, healthy: bool):
+        """后台健康检查的结果：连续 probe_failures 次不可用才熔断，熔断期间检查通过则进入半开状态"""
+        with self.lock:
+            if healthy:
+                self.failed_probes = 0
+                if self.state == self.OPEN:
+                    self.state = self.HALF_OPEN
+                    self.probe_started = 0.0
+                return
+            self.failed_probes += 1
+            if self.failed_probes >= self.probe_failures and self.state != self.OPEN:
+                self._trip()
+
+    def _trip(self):
+        self.state = self.OPEN
+        self.opened_at = time.monotonic()
+        self.trips += 1
+        self.outcomes.clear()
+
+    def stats(self) -> Dict:
+        with self.lock:
+            retry_in = 0.0
+            if self.state == self.OPEN:
+                retry_in = max(self.open_seconds - (time.monotonic() - self.opened_at), 0.0)
+            return {
+                "state": self.state,
+                "trips": self.trips,
+                "short_circuited": self.short_circuited,
+                "retry_in": round(retry_in, 1)
+            }
+
+def create_circuit_breaker() -> CircuitBreaker:
+    """按配置创建熔断器，每个模型后端一个"""
+    return CircuitBreaker(BREAKER_FAILURE_RATE, BREAKER_SLOW_CALL_SECONDS,
+                          BREAKER_SLOW_CALL_RATE, BREAKER_OPEN_SECONDS)
+
+# ==================== 超时与重试策略 ====================
+# 每类任务的读超时范围和整个用户操作的总时间预算（秒）。
+# 读超时在 [read_min, read_max] 内按观测到的P95延迟自适应；流式请求的读超时是两段数据之间的最长间隔。
+TASK_TIMEOUT_PROFILES = {
+    "evaluate": {"read_default": 30, "read_min": 10, "read_max": 60, "budget": 90},
+    "suggestions": {"read_default": 20, "read_min": 8, "read_max": 45, "budget": 60},
+    "vocabulary": {"read_default": 15, "read_min": 5, "read_max": 30, "budget": 40},
+    "sentences": {"read_default": 15, "read_min": 5, "read_max": 30, "budget": 40},
+    "essay": {"read_default": 20, "read_min": 8, "read_max": 45, "budget": 60},
+    "evaluate_chunk": {"read_default": 20, "read_min": 8, "read_max": 45, "budget": 90},
+    "suggestions_chunk": {"read_default": 15, "read_min": 5, "read_max": 30, "budget": 60},
+    "default": {"read_default": 10, "read_min": 5, "read_max": 30, "budget": 30},
+}
+CONNECT_TIMEOUT = 3
+BACKOFF_BASE = 0.5
+BACKOFF_CAP = 8.0
+MIN_ATTEMPT_SECONDS = 2.0  # 剩余预算不足这个时间时不再发起新的尝试
+LATENCY_WINDOW_SIZE = 50
+LATENCY_MIN_SAMPLES = 5
+
+def get_timeout_profile(task: str) -> Dict:
+    return TASK_TIMEOUT_PROFILES.get(task, TASK_TIMEOUT_PROFILES["default"])
+
+def backoff_delay(attempt: int) -> float:
+    """指数退避 + 全抖动：避免多个会话在同一时刻重试"""
+    return random.uniform(0, min(BACKOFF_CAP, BACKOFF_BASE * (2 ** attempt)))
+
+class LatencyTracker:
+    """按任务类型记录最近的上游延迟，据此推算读超时"""
+
+    def __init__(self, window_size: int = LATENCY_WINDOW_SIZE):
+        self.window_size = window_size
+        self.samples: Dict[str, deque] = {}
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def _key(task: str, stream: bool) -> str:
+        return f"{task}:stream" if stream else task
+
+    def record(self, task: str, stream: bool, latency: float):
+        with self.lock:
+            key = self._key(task, stream)
+            if key not in self.samples:
+                self.samples[key] = deque(maxlen=self.window_size)
+            self.samples[key].append(latency)
+
+    def percentile(self, task: str, stream: bool, pct: float) -> Optional[float]:
+        with self.lock:
+            samples = sorted(self.samples.get(self._key(task, stream), ()))
+        if len(samples) < LATENCY_MIN_SAMPLES:
+            return None
+        index = min(int(len(samples) * pct), len(samples) - 1)
+        return samples[index]
+
+    def read_timeout(self, task: str, stream: bool) -> float:
+        """读超时 = P95 × 1.5，限制在任务的上下限之内；样本不足时用默认值"""
+        profile = get_timeout_profile(task)
+        p95 = self.percentile(task, stream, 0.95)
+        if p95 is None:
+            return profile["read_default"]
+        return min(max(p95 * 1.5, profile["read_min"]), profile["read_max"])
+
+    def stats(self) -> Dict:
+        with self.lock:
+            keys = list(self.samples.keys())
+        result = {}
+        for key in keys:
+            task, _, stream = key.partition(":")
+            p95 = self.percentile(task, bool(stream), 0.95)
+            result[key] = {
+                "p50": self.percentile(task, bool(stream), 0.5),
+                "p95": p95,
+                "timeout": round(self.read_timeout(task, bool(stream)), 1)
+            }
+        return result
+
+class PromptCacheStats:
+    """按提示词版本统计上游上下文缓存（prompt_cache_hit/miss_tokens）的命中情况、实际的输入输出token数，
+    以及命中与未命中请求的平均延迟，用来比较同一提示词不同版本的成本和速度"""
+
+    def __init__(self):
+        self.tasks: Dict[str, Dict] = {}
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def cache_tokens(usage: Dict) -> tuple:
+        """返回 (命中token数, 未命中token数)；兼容DeepSeek和OpenAI两种字段"""
+        hit = usage.get("prompt_cache_hit_tokens")
+        if hit is None:
+            hit = (usage.get("prompt_tokens_details") or {}).get("cached_tokens", 0)
+        miss = usage.get("prompt_cache_miss_tokens")
+        if miss is None:
+            miss = max(usage.get("prompt_tokens", 0) - hit, 0)
+        return hit, miss
+
+    def record(self, version_id: str, usage: Optional[Dict], latency: float):
+        with self.lock:
+            summary = self.tasks.setdefault(version_id, {
+                "requests": 0, "reported": 0, "hit_tokens": 0, "miss_tokens": 0, "completion_tokens": 0,
+                "hit_requests": 0, "hit_latency": 0.0, "miss_latency": 0.0
+            })
+            summary["requests"] += 1
+            if not usage:
+                return
+            hit, miss = self.cache_tokens(usage)
+            summary["reported"] += 1
+            summary["hit_tokens"] += hit
+            summary["miss_tokens"] += miss
+            summary["completion_tokens"] += usage.get("completion_tokens", 0)
+            if hit > 0:
+                summary["hit_requests"] += 1
+                summary["hit_latency"] += latency
+            else:
+                summary["miss_latency"] += latency
+
+    def stats(self) -> Dict:
+        with self.lock:
+            result = {}
+            for version_id, summary in self.tasks.items():
+                prompt_tokens = summary["hit_tokens"] + summary["miss_tokens"]
+                miss_requests = summary["reported"] - summary["hit_requests"]
+                reported = summary["reported"]
+                result[version_id] = {
+                    "requests": summary["requests"],
+                    "hit_tokens": summary["hit_tokens"],
+                    "miss_tokens": summary["miss_tokens"],
+                    "avg_prompt_tokens": round(prompt_tokens / reported) if reported else None,
+                    "avg_completion_tokens": round(summary["completion_tokens"] / reported) if reported else None,
+                    "hit_rate": round(summary["hit_tokens"] / prompt_tokens, 3) if prompt_tokens else None,
+                    "hit_latency": round(summary["hit_latency"] / summary["hit_requests"], 2) if summary["hit_requests"] else None,
+                    "miss_latency": round(summary["miss_latency"] / miss_requests, 2) if miss_requests else None
+                }
+            return result
+
+    def avg_completion_tokens(self, version_id: str) -> Optional[float]:
+        with self.lock:
+            summary = self.tasks.get(version_id)
+            if not summary or not summary["reported"]:
+                return None
+            return summary["completion_tokens"] / summary["reported"]
+
+@st.cache_resource(show_spinner=False)
+def get_prompt_cache_stats() -> PromptCacheStats:
+    return PromptCacheStats()
+
+def action_deadline(task: str) -> float:
+    """一次用户操作的截止时间（time.monotonic()），所有重试都不能超过它"""
+    return time.monotonic() + get_timeout_profile(task)["budget"]
+
+# ==================== 模型后端 ====================
+# AI_BACKENDS 按故障转移顺序列出OpenAI兼容的后端（JSON数组），例如优先使用局域网内的llama.cpp服务，失败再用DeepSeek：
+#   [{"name": "local", "base_url": "http://192.168.1.20:8080/v1", "model": "qwen2.5-7b", "concurrency": 2},
+#    {"name": "deepseek"}]
+# 名为 deepseek 的后端默认使用官方地址、模型和密钥池；其他后端可以用 api_key 指定自己的密钥。未配置时只使用DeepSeek。
+# 本地调试可以运行 local_llm_server.py 作为替身服务，不需要联网。
+DEEPSEEK_MAX_CONCURRENCY = int(get_config_value("DEEPSEEK_MAX_CONCURRENCY", 16))
+LOCAL_BACKEND_CONCURRENCY = 2  # 未指定并发上限的自建后端（例如CPU推理）默认同时处理的请求数
+
+class BackendError(Exception):
+    """某个后端这次没能返回结果；message 是给用户看的提示，level 是提示方式"""
+
+    def __init__(self, message: str, level: str = "error"):
+        super().__init__(message)
+        self.message = message
+        self.level = level
+
+class LLMBackend:
+    """一个OpenAI兼容的模型后端：地址、模型名、并发上限，以及它自己的熔断器和延迟统计"""
+
+    def __init__(self, name: str, base_url: str, model: str, concurrency: int,
+                 api_key: Optional[str] = None, use_key_pool: bool = False):
+        self.name = name
+        self.base_url = base_url.rstrip("/")
+        self.model = model
+        self.concurrency = concurrency
+        self.api_key = api_key
+        self.use_key_pool = use_key_pool  # True 时从API密钥池取密钥并按密钥限流
+        self.slots = threading.BoundedSemaphore(concurrency)
+        self.breaker = create_circuit_breaker()
+        self.latency = LatencyTracker()
+        self.lock = threading.Lock()
+        self.active = 0
+        self.requests = 0
+        self.failovers = 0
+
+    @property
+    def chat_url(self) -> str:
+        return f"{self.base_url}/chat/completions"
+
+    @property
+    def models_url(self) -> str:
+        return f"{self.base_url}/models"
+
+    def is_configured(self) -> bool:
+        """使用密钥池的后端需要至少一个密钥；自建后端只要配置了地址就可用"""
+        return bool(current_api_keys()) if self.use_key_pool else True
+
+    def acquire_slot(self, timeout: float) -> bool:
+        if not self.slots.acquire(timeout=max(timeout, 0.0)):
+            return False
+        with self.lock:
+            self.active += 1
+            self.requests += 1
+        return True
+
+    def release_slot(self):
+        with self.lock:
+            self.active -= 1
+        self.slots.release()
+
+    def record_failover(self):
+        with self.lock:
+            self.failovers += 1
+
+    def stats(self) -> Dict:
+        with self.lock:
+            summary = {
+                "name": self.name,
+                "model": self.model,
+                "active": self.active,
+                "concurrency": self.concurrency,
+                "requests": self.requests,
+                "failovers": self.failovers
+            }
+        summary["breaker"] = self.breaker.stats()
+        summary["latency"] = self.latency.stats()
+        return summary
+
+def load_backend_configs() -> List[Dict]:
+    """读取 AI_BACKENDS（JSON字符串或secrets中的数组），格式错误时退回只用DeepSeek"""
+    raw = get_config_value("AI_BACKENDS")
+    if isinstance(raw, str):
+        try:
+            raw = json.loads(raw)
+        except ValueError:
+            raw = None
+    if not raw:
+        return [{"name": "deepseek"}]
+    return [dict(item) for item in raw if item]
+
+@st.cache_resource(show_spinner=False)
+def get_backends() -> List[LLMBackend]:
+    """按故障转移顺序排列的后端列表，所有会话共享（并发槽位、熔断状态都是进程级的）"""
+    backends = []
+    for config in load_backend_configs():
+        name = str(config.get("name") or f"backend-{len(backends) + 1}")
+        if name == "deepseek" and not config.get("base_url"):
+            backends.append(LLMBackend(
+                name,
+                DEEPSEEK_BASE_URL,
+                config.get("model", DEEPSEEK_MODEL),
+                int(config.get("concurrency", DEEPSEEK_MAX_CONCURRENCY)),
+                use_key_pool=True
+            ))
+        elif config.get("base_url"):
+            backends.append(LLMBackend(
+                name,
+                config["base_url"],
+                config.get("model", DEEPSEEK_MODEL),
+                int(config.get("concurrency", LOCAL_BACKEND_CONCURRENCY)),
+                api_key=config.get("api_key") or None
+            ))
+    return backends
+
+# ==================== 健康检查 ====================
+HEALTH_CHECK_INTERVAL = float(get_config_value("DEEPSEEK_HEALTH_CHECK_INTERVAL", 30))
+HEALTH_CHECK_TIMEOUT = 5
+# 设置后在该端口提供 /healthz（存活）和 /readyz（就绪）接口，供编排系统轮询
+HEALTH_PORT = get_config_value("AI_HEALTH_PORT")
+# 侧边栏的运维统计（密钥用量、限流、调度等）只在管理员部署时打开，学生看不到
+SHOW_OPERATOR_PANELS = str(get_config_value("AI_SHOW_OPERATOR_PANELS", "")).lower() in ("1", "true", "yes")
+
+class AIHealthMonitor:
+    """后台健康检查：定期重新读取API密钥、探测每个后端，结果缓存给所有会话"""
+
+    def __init__(self, interval: float):
+        self.interval = interval
+        self.api_keys = get_api_keys()
+        get_key_pool().sync(self.api_keys)
+        self.healthy: Optional[bool] = None  # None 表示还没有检查过；有一个后端可用即为健康
+        self.last_check = 0.0
+        self.last_latency: Optional[float] = None
+        self.last_error = ""
+        self.backend_health: Dict[str, Dict] = {}
+        self.checks = 0
+        self.lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.thread = threading.Thread(target=self._run, name="ai-health-monitor", daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        while True:
+            self.check_once()
+            self.wakeup.wait(self.interval)
+            self.wakeup.clear()
+
+    def check_now(self):
+        """立即触发一次后台检查（例如用户刚配置好密钥）"""
+        self.api_keys = get_api_keys()
+        get_key_pool().sync(self.api_keys)
+        self.wakeup.set()
+
+    def check_once(self):
+        # 每次检查都重新读取密钥，修改环境变量或secrets后无需重启
+        api_keys = get_api_keys()
+        get_key_pool().sync(api_keys)
+        with self.lock:
+            self.api_keys = api_keys
+        
+        results = {}
+        for backend in get_backends():
+            api_key = api_keys[0] if backend.use_key_pool and api_keys else backend.api_key
+            if backend.use_key_pool and not api_key:
+                continue
+            healthy, latency, error = self._probe(backend, api_key)
+            results[backend.name] = {"healthy": healthy, "latency": latency, "error": error}
+            backend.breaker.on_health_probe(healthy)
+        
+        # 汇总时取第一个可用后端的延迟，全部不可用时取第一个后端的错误
+        first_healthy = next((result for result in results.values() if result["healthy"]), None)
+        first_result = first_healthy or next(iter(results.values()), None)
+        with self.lock:
+            self.backend_health = results
+            self.healthy = first_healthy is not None if results else None
+            self.last_check = time.time()
+            self.last_latency = first_result["latency"] if first_result else None
+            self.last_error = first_result["error"] if first_result else ""
+            self.checks += 1
+
+    @staticmethod
+    def _probe(backend: LLMBackend, api_key: Optional[str]) -> tuple:
+        """请求后端的模型列表接口，返回 (是否可用, 延迟, 错误)"""
+        headers = {"Authorization": f"Bearer {api_key}"} if api_key else {}
+        started = time.monotonic()
+        try:
+            response = get_http_transport().session.get(
+                backend.models_url,
+                headers=headers,
+                timeout=(CONNECT_TIMEOUT, HEALTH_CHECK_TIMEOUT)
+            )
+            response.close()
+        except requests.exceptions.RequestException as e:
+            return False, None, type(e).__name__
+        latency = time.monotonic() - started
+        if response.status_code != 200:
+            return False, latency, f"HTTP {response.status_code}"
+        return True, latency, ""
+
+    def stats(self) -> Dict:
+        configured_backends = [backend for backend in get_backends() if backend.is_configured()]
+        # 有一个后端的熔断器闭合就能正常服务；全部熔断时整体视为熔断
+        breaker_states = [backend.breaker.stats()["state"] for backend in configured_backends]
+        if CircuitBreaker.CLOSED in breaker_states:
+            breaker_state = CircuitBreaker.CLOSED
+        elif CircuitBreaker.HALF_OPEN in breaker_states:
+            breaker_state = CircuitBreaker.HALF_OPEN
+        else:
+            breaker_state = CircuitBreaker.OPEN if breaker_states else CircuitBreaker.CLOSED
+        with self.lock:
+            return {
+                "configured": bool(configured_backends),
+                "keys": len(self.api_keys),
+                "healthy": self.healthy,
+                "ready": bool(configured_backends) and self.healthy is not False,
+                "last_check_ago": round(time.time() - self.last_check, 1) if self.last_check else None,
+                "latency": round(self.last_latency, 3) if self.last_latency is not None else None,
+                "last_error": self.last_error,
+                "checks": self.checks,
+                "breaker": breaker_state,
+                "backends": dict(self.backend_health)
+            }
+
+def _start_health_endpoint(monitor: AIHealthMonitor, port: int):
+    """在独立端口上提供就绪检查接口"""
+    class HealthHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.startswith("/healthz"):
+                status, body = 200, {"alive": True}
+            elif self.path.startswith("/readyz"):
+                body = monitor.stats()
+                status = 200 if body["ready"] else 503
+            else:
+                status, body = 404, {"error": "not found"}
+            data = json.dumps(body).encode("utf-8")
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def log_message(self, format, *args):
+            pass
+
+    try:
+        server = ThreadingHTTPServer(("0.0.0.0", port), HealthHandler)
+    except OSError:
+        # 多个进程共用配置时只有第一个能绑定端口
+        return None
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="ai-health-endpoint", daemon=True).start()
+    return server
+
+@st.cache_resource(show_spinner=False)
+def get_health_monitor() -> AIHealthMonitor:
+    """进程内唯一的后台健康检查线程"""
+    monitor = AIHealthMonitor(HEALTH_CHECK_INTERVAL)
+    if HEALTH_PORT:
+        _start_health_endpoint(monitor, int(HEALTH_PORT))
+    return monitor
+
+def current_api_keys() -> List[str]:
+    """当前生效的API密钥列表（由后台检查定期刷新）"""
+    return get_health_monitor().api_keys
+
+def is_offline_mode() -> bool:
+    return not any(backend.is_configured() for backend in get_backends())
+
+def get_ai_status() -> tuple:
+    """AI服务状态，返回 (状态, 说明)，用于侧边栏和首页展示"""
+    monitor_stats = get_health_monitor().stats()
+    if not monitor_stats["configured"]:
+        return "离线", "需配置"
+    if monitor_stats["breaker"] == CircuitBreaker.OPEN:
+        return "熔断", "本地兜底"
+    if monitor_stats["healthy"] is False:
+        return "异常", monitor_stats["last_error"] or "上游不可用"
+    if monitor_stats["breaker"] == CircuitBreaker.HALF_OPEN:
+        return "探测中", "恢复检测"
+    if monitor_stats["healthy"] is None:
+        return "在线", "检测中"
+    return "在线", "已连接"
+
+# ==================== 请求取消 ====================
+class RequestCancelled(Exception):
+    """发起请求的后台任务已被取消（离开页面、重新开始或被同一位置的新请求取代）"""
+
+class CancelToken:
+    """协作式取消标记：每个后台任务持有一个，任务里的AI调用在发送前、重试等待和流式读取时检查它"""
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.callbacks: List[Callable[[], None]] = []
+        self.lock = threading.Lock()
+
+    @property
+    def cancelled(self) -> bool:
+        return self.event.is_set()
+
+    def on_cancel(self, callback: Callable[[], None]):
+        """登记取消时的回调；已经取消时立即调用"""
+        with self.lock:
+            if not self.event.is_set():
+                self.callbacks.append(callback)
+                return
+        callback()
+
+    def cancel(self) -> bool:
+        """取消并依次调用回调；已经取消过时返回False"""
+        with self.lock:
+            if self.event.is_set():
+                return False
+            self.event.set()
+            callbacks, self.callbacks = self.callbacks, []
+        for callback in callbacks:
+            callback()
+        return True
+
+def is_cancelled(token: Optional[CancelToken]) -> bool:
+    return token is not None and token.cancelled
+
+def check_cancelled(cancel: Optional[CancelToken]):
+    if is_cancelled(cancel):
+        raise RequestCancelled()
+
+class CancellationStats:
+    """被取消而中止的上游请求数，以及因此没有生成的输出token数（按该提示词版本的平均输出量估算）"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.before_send = 0
+        self.mid_stream = 0
+        self.saved_tokens = 0
+
+    def record(self, task: str, generated: Optional[str]):
+        """generated 为None表示请求发出前就取消了，否则是断开连接前已经生成的文本"""
+        expected = get_prompt_cache_stats().avg_completion_tokens(PROMPTS.version_id(task)) or MAX_COMPLETION_TOKENS
+        saved = expected if generated is None else max(expected - estimate_tokens(generated), 0)
+        with self.lock:
+            if generated is None:
+                self.before_send += 1
+            else:
+                self.mid_stream += 1
+            self.saved_tokens += round(saved)
+
+    def stats(self) -> Dict:
+        with self.lock:
+            return {"before_send": self.before_send, "mid_stream": self.mid_stream, "saved_tokens": self.saved_tokens}
+
+@st.cache_resource(show_spinner=False)
+def get_cancellation_stats() -> CancellationStats:
+    return CancellationStats()
+
+# ==================== 请求调度 ====================
+# 所有发往上游的请求先经过调度器：同时进行的请求数有上限，超出的按优先级排队。
+# interactive：学生在页面上等待的请求；prefetch：预取和过期缓存刷新；batch：预生成等批量任务。
+PRIORITY_CLASSES = ("interactive", "prefetch", "batch")  # 按优先级从高到低
+SCHEDULER_MAX_CONCURRENT = int(get_config_value("AI_SCHEDULER_MAX_CONCURRENT", 12))  # 同时在上游进行的请求数上限
+SCHEDULER_INTERACTIVE_RESERVED = int(get_config_value("AI_SCHEDULER_INTERACTIVE_RESERVED", 4))  # 只留给交互请求的名额
+SCHEDULER_MAX_QUEUE = int(get_config_value("AI_SCHEDULER_MAX_QUEUE", 100))  # 排队请求数上限，超出时直接拒绝
+SCHEDULER_BACKGROUND_MAX_WAIT = 600  # 预取和批量请求最多排队多久（秒）；交互请求以操作的截止时间为准
+SCHEDULER_POLL_INTERVAL = 0.5  # 排队时检查取消和汇报位置的间隔（秒）
+SCHEDULER_INITIAL_SERVICE_SECONDS = 10.0  # 还没有完成过请求时估算等待用的单个请求耗时
+
+class RequestScope:
+    """工作线程里AI调用的上下文：所属任务的取消标记、调度优先级，以及排队时汇报位置的回调"""
+
+    def __init__(self, token: Optional[CancelToken] = None, priority: str = "interactive",
+                 on_queue: Optional[Callable[[object, Optional[int], Optional[float]], None]] = None):
+        self.token = token
+        self.priority = priority
+        self.on_queue = on_queue
+
+@st.cache_resource(show_spinner=False)
+def get_thread_state() -> threading.local:
+    """跨脚本重跑共享的线程局部变量：后台线程里运行的可能是上一次运行定义的函数，
+    模块级的 threading.local() 每次重跑都会换成新的，前后设置和读取的就不是同一个对象"""
+    return threading.local()
+
+_request_scope = get_thread_state()
+
+def current_scope() -> RequestScope:
+    """当前线程的调用上下文；页面线程没有设置，按交互请求处理"""
+    return getattr(_request_scope, "scope", None) or RequestScope()
+
+def run_in_scope(scope: RequestScope, work: Callable, *args):
+    """以 scope 作为当前线程的调用上下文执行 work(*args)，并发分析的工作线程用它继承任务的上下文"""
+    previous = getattr(_request_scope, "scope", None)
+    _request_scope.scope = scope
+    try:
+        return work(*args)
+    finally:
+        _request_scope.scope = previous
+
+class SchedulerTicket:
+    """一次排队：优先级、进入队列的顺序和时间"""
+
+    def __init__(self, priority: str, seq: int):
+        self.priority = priority
+        self.rank = PRIORITY_CLASSES.index(priority)
+        self.seq = seq
+        self.enqueued_at = time.monotonic()
+        self.granted_at: Optional[float] = None
+
+    def promote(self, priority: str) -> bool:
+        """提升到更高的优先级，返回是否有变化；调用方需持有调度器的锁"""
+        rank = PRIORITY_CLASSES.index(priority)
+        if rank >= self.rank:
+            return False
+        self.priority = priority
+        self.rank = rank
+        return True
+
+class PriorityScheduler:
+    """进程级的上游请求调度：同时进行的请求数不超过 max_concurrent，其余按 (优先级, 先后) 排队。
+    预取和批量请求合计最多占用 max_concurrent - interactive_reserved 个名额，批量任务跑满时学生的请求仍能马上发出"""
+
+    def __init__(self, max_concurrent: int, interactive_reserved: int, max_queue: int):
+        self.max_concurrent = max(max_concurrent, 1)
+        self.background_limit = max(self.max_concurrent - interactive_reserved, 1)
+        self.max_queue = max_queue
+        self.cond = threading.Condition()
+        self.queue: List[SchedulerTicket] = []
+        self.seq = itertools.count()
+        self.active = {priority: 0 for priority in PRIORITY_CLASSES}
+        self.granted = {priority: 0 for priority in PRIORITY_CLASSES}
+        self.rejected = {priority: 0 for priority in PRIORITY_CLASSES}
+        self.total_wait = {priority: 0.0 for priority in PRIORITY_CLASSES}
+        self.avg_service = SCHEDULER_INITIAL_SERVICE_SECONDS  # 单个请求占用名额的时间（指数移动平均）
+
+    def _has_room(self, priority: str) -> bool:
+        if sum(self.active.values()) >= self.max_concurrent:
+            return False
+        if priority != "interactive":
+            return sum(count for name, count in self.active.items() if name != "interactive") < self.background_limit
+        return True
+
+    def _next_ticket(self) -> Optional[SchedulerTicket]:
+        for ticket in self.queue:
+            if self._has_room(ticket.priority):
+                return ticket
+        return None
+
+    def _estimate(self, ticket: SchedulerTicket) -> tuple:
+        """返回 (排队位置, 预计等待秒数)；位置从1开始，只算排在它前面的请求"""
+        position = self.queue.index(ticket) + 1
+        capacity = self.max_concurrent if ticket.priority == "interactive" else self.background_limit
+        return position, position * self.avg_service / capacity
+
+    def acquire(self, priority: str, timeout: float, cancel: Optional[CancelToken] = None,
+                on_queue: Optional[Callable[[object, Optional[int], Optional[float]], None]] = None,
+                on_enqueue: Optional[Callable[[SchedulerTicket], None]] = None) -> Optional[SchedulerTicket]:
+        """取得一个上游名额，返回凭据（用完后交给 release）；队列已满或等待超时返回None，
+        排队中 cancel 被设置时抛出 RequestCancelled。排队期间定期用 (凭据, 位置, 预计等待) 回调 on_queue，开始后以 None 回调一次。
+        on_enqueue 在持有锁时以新凭据回调一次，可以在排序前提升它的优先级，之后再提升用 boost"""
+        deadline = time.monotonic() + timeout
+        queued = False
+        with self.cond:
+            if len(self.queue) >= self.max_queue:
+                self.rejected[priority] += 1
+                return None
+            ticket = SchedulerTicket(priority, next(self.seq))
+            if on_enqueue is not None:
+                on_enqueue(ticket)
+            self.queue.append(ticket)
+            self.queue.sort(key=lambda item: (item.rank, item.seq))
+            try:
+                while self._next_ticket() is not ticket:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        self.rejected[ticket.priority] += 1
+                        return None
+                    check_cancelled(cancel)
+                    if on_queue is not None:
+                        on_queue(ticket, *self._estimate(ticket))
+                        queued = True
+                    self.cond.wait(min(remaining, SCHEDULER_POLL_INTERVAL))
+                ticket.granted_at = time.monotonic()
+                self.active[ticket.priority] += 1
+                self.granted[ticket.priority] += 1
+                self.total_wait[ticket.priority] += ticket.granted_at - ticket.enqueued_at
+                return ticket
+            finally:
+                self.queue.remove(ticket)
+                # 排在后面的请求可能因此轮到
+                self.cond.notify_all()
+                if queued:
+                    on_queue(ticket, None, None)
+
+    def boost(self, ticket: SchedulerTicket, priority: str):
+        """把仍在排队的凭据提升到更高的优先级；已经取得名额或离开队列的凭据不变"""
+        with self.cond:
+            if ticket in self.queue and ticket.promote(priority):
+                self.queue.sort(key=lambda item: (item.rank, item.seq))
+                self.cond.notify_all()
+
+    def release(self, ticket: Optional[SchedulerTicket]):
+        if ticket is None:
+            return
+        with self.cond:
+            self.active[ticket.priority] -= 1
+            self.avg_service = 0.8 * self.avg_service + 0.2 * (time.monotonic() - ticket.granted_at)
+            self.cond.notify_all()
+
+    def stats(self) -> Dict:
+        with self.cond:
+            return {
+                "active": sum(self.active.values()),
+                "max_concurrent": self.max_concurrent,
+                "avg_service": round(self.avg_service, 1),
+                "classes": {
+                    priority: {
+                        "active": self.active[priority],
+                        "queued": sum(1 for ticket in self.queue if ticket.priority == priority),
+                        "granted": self.granted[priority],
+                        "rejected": self.rejected[priority],
+                        "avg_wait": round(self.total_wait[priority] / self.granted[priority], 2) if self.granted[priority] else 0.0
+                    }
+                    for priority in PRIORITY_CLASSES
+                }
+            }
+
+@st.cache_resource(show_spinner=False)
+def get_scheduler() -> PriorityScheduler:
+    """所有Streamlit会话共享同一个调度器"""
+    return PriorityScheduler(SCHEDULER_MAX_CONCURRENT, SCHEDULER_INTERACTIVE_RESERVED, SCHEDULER_MAX_QUEUE)
+
+# ==================== 请求合并 ====================
+FLIGHT_WAIT_TIMEOUT = 120  # 等待其他会话的同一请求完成的最长时间（秒）
+
+class InFlightRequest:
+    """一个正在进行的上游请求，生成的文本片段对所有等待者可见。
+    每个等待者登记自己的取消标记，所有等待者都取消后请求被放弃（abandoned），上游连接随即断开"""
+
+    def __init__(self, priority: str = "interactive"):
+        self.chunks: List[str] = []
+        self.done = False
+        self.failed = False
+        self.cond = threading.Condition()
+        self.listeners: List[Optional[CancelToken]] = []
+        self.abandoned = CancelToken()  # 取消时的回调负责断开上游连接
+        self.on_abandoned: Optional[Callable[[], None]] = None  # 被放弃时回调一次，用来从请求表里移除
+        self.priority = priority  # 所有等待者里最高的优先级，发起者排队时按它排
+        self.ticket: Optional[SchedulerTicket] = None
+
+    def set_ticket(self, ticket: SchedulerTicket):
+        """发起者进入调度队列时回调（持有调度器的锁）：记下凭据，并补上在此之前合并进来的更高优先级"""
+        with self.cond:
+            self.ticket = ticket
+            ticket.promote(self.priority)
+
+    def raise_priority(self, priority: str, scheduler: PriorityScheduler):
+        """合并进来的调用优先级更高时提升发起者的排队优先级，学生的请求不会跟着预取或批量请求一起等"""
+        with self.cond:
+            if PRIORITY_CLASSES.index(priority) >= PRIORITY_CLASSES.index(self.priority):
+                return
+            self.priority = priority
+            ticket = self.ticket
+        if ticket is not None:
+            scheduler.boost(ticket, priority)
+
+    def attach(self, token: Optional[CancelToken]) -> bool:
+        """登记一个等待结果的调用方，之后由 wait_text / subscribe 负责注销；
+        请求已经结束或被放弃时不再登记，返回False"""
+        with self.cond:
+            if self.done or self.abandoned.cancelled:
+                return False
+            self.listeners.append(token)
+        if token is not None:
+            token.on_cancel(self._check_abandoned)
+        return True
+
+    def detach(self, token: Optional[CancelToken]):
+        with self.cond:
+            self.listeners.remove(token)
+        self._check_abandoned()
+
+    def _check_abandoned(self):
+        with self.cond:
+            newly_abandoned = (not self.done and not self.abandoned.cancelled and self.listeners
+                               and all(is_cancelled(token) for token in self.listeners))
+            if newly_abandoned:
+                # 回调只关闭socket，不会再获取这把锁
+                self.abandoned.cancel()
+            # 唤醒等待中的调用方，已取消的尽快返回
+            self.cond.notify_all()
+        if newly_abandoned and self.on_abandoned is not None:
+            self.on_abandoned()
+
+    def publish(self, chunk: str):
+        with self.cond:
+            self.chunks.append(chunk)
+            self.cond.notify_all()
+
+    def finish(self, failed: bool = False):
+        """结束请求；failed 表示结果不可用（请求失败，或流在结束标记前中断，已发布的片段不完整）"""
+        with self.cond:
+            self.done = True
+            self.failed = failed
+            self.cond.notify_all()
+
+    def wait_text(self, timeout: float = FLIGHT_WAIT_TIMEOUT, token: Optional[CancelToken] = None) -> Optional[str]:
+        """等待请求结束，返回完整文本；失败时返回None，token 被取消时抛出 RequestCancelled"""
+        try:
+            with self.cond:
+                self.cond.wait_for(lambda: self.done or is_cancelled(token), timeout=timeout)
+                if is_cancelled(token):
+                    raise RequestCancelled()
+                if not self.done or self.failed:
+                    return None
+                return "".join(self.chunks)
+        finally:
+            self.detach(token)
+
+    def subscribe(self, timeout: float = FLIGHT_WAIT_TIMEOUT, token: Optional[CancelToken] = None) -> Optional[Iterator[str]]:
+        """流式订阅：先回放已生成的片段，再跟随后续片段；还没有任何片段就失败时返回None，
+        回放完中途失败的请求后抛出 StreamIncomplete，token 被取消时抛出 RequestCancelled"""
+        with self.cond:
+            self.cond.wait_for(lambda: self.chunks or self.done or is_cancelled(token), timeout=timeout)
+            ready = bool(self.chunks) and not is_cancelled(token)
+        if not ready:
+            self.detach(token)
+            if is_cancelled(token):
+                raise RequestCancelled()
+            return None
+        return self._replay(token)
+
+    def _replay(self, token: Optional[CancelToken]) -> Iterator[str]:
+        index = 0
+        try:
+            while True:
+                with self.cond:
+                    self.cond.wait_for(lambda: index < len(self.chunks) or self.done or is_cancelled(token),
+                                       timeout=FLIGHT_WAIT_TIMEOUT)
+                    if is_cancelled(token):
+                        raise RequestCancelled()
+                    pending = self.chunks[index:]
+                    if not pending and not self.done:
+                        # 上游长时间没有新内容也没有结束，已回放的部分不完整
+                        raise StreamIncomplete("AI回复超时")
+                    finished = self.done
+                for chunk in pending:
+                    yield chunk
+                index += len(pending)
+                if finished and index >= len(self.chunks):
+                    if self.failed:
+                        raise StreamIncomplete("AI回复中途断开")
+                    return
+        finally:
+            self.detach(token)
+
+class SingleFlight:
+    """进程内请求合并：相同的请求同时只向上游发送一次，其余调用等待并共享结果"""
+
+    def __init__(self):
+        self.lock = threading.RLock()  # join 里登记时可能立即触发放弃回调，回调要再次加锁
+        self.flights: Dict[str, InFlightRequest] = {}
+        self.leaders = 0
+        self.deduplicated = 0
+
+    def join(self, key: str, token: Optional[CancelToken] = None, priority: str = "interactive") -> tuple:
+        """以 token 登记为等待者，返回 (flight, 是否由当前调用负责发起请求)；priority 是发起请求时的排队优先级。
+        已被放弃的请求马上就会中止，不再合并进去，而是重新发起"""
+        with self.lock:
+            flight = self.flights.get(key)
+            if flight is not None and flight.attach(token):
+                self.deduplicated += 1
+                return flight, False
+            flight = InFlightRequest(priority)
+            flight.on_abandoned = lambda: self._forget(key, flight)
+            flight.attach(token)
+            self.flights[key] = flight
+            self.leaders += 1
+            return flight, True
+
+    def _forget(self, key: str, flight: InFlightRequest):
+        with self.lock:
+            if self.flights.get(key) is flight:
+                del self.flights[key]
+
+    def complete(self, key: str, flight: InFlightRequest, failed: bool = False):
+        self._forget(key, flight)
+        # 被放弃的请求只生成了一部分，不能当作成功的结果
+        flight.finish(failed or flight.abandoned.cancelled)
+
+    def stats(self) -> Dict:
+        with self.lock:
+            return {
+                "in_flight": len(self.flights),
+                "upstream_calls": self.leaders,
+                "deduplicated": self.deduplicated
+            }
+
+@st.cache_resource(show_spinner=False)
+def get_single_flight() -> SingleFlight:
+    """所有Streamlit会话共享同一张进行中请求表"""
+    return SingleFlight()
+
+def request_fingerprint(messages: List[Dict], model: str, temperature: float) -> str:
+    """请求指纹：规范化空白后的提示词 + 模型 + 温度"""
+    normalized = [
+        {"role": message.get("role"), "content": " ".join(str(message.get("content", "")).split())}
+        for message in messages
+    ]
+    raw = json.dumps({"messages": normalized, "model": model, "temperature": temperature},
+                     ensure_ascii=False, sort_keys=True)
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+# ==================== 页面提示 ====================
+_notice_sink = get_thread_state()
+
+def notify(level: str, message: str):
+    """显示请求过程中的提示（toast/info/warning/error 对应同名的st函数）。
+    并发分析的工作线程没有页面上下文，提示先收集起来由页面线程显示；缓存刷新等其他后台线程直接忽略"""
+    sink = getattr(_notice_sink, "messages", None)
+    if sink is not None:
+        if (level, message) not in sink:
+            sink.append((level, message))
+    elif get_script_run_ctx(suppress_warning=True) is not None:
+        getattr(st, level)(message)
+
+def run_collecting_notices(work: Callable[[], object]) -> tuple:
+    """在当前线程执行 work，返回 (结果, 期间产生的提示列表)"""
+    _notice_sink.messages = []
+    try:
+        return work(), _notice_sink.messages
+    finally:
+        _notice_sink.messages = None
+
+def call_deepseek_api(messages: List[Dict], temperature: float = 0.7, max_retries: int = 2,
+                      stream: bool = False, task: str = "default",
+                      deadline: Optional[float] = None, flight_key: Optional[str] = None) -> Optional[Union[str, Iterator[str]]]:
+    """改进版API调用，更好的错误处理；stream=True 时返回逐段产出文本的迭代器。
+    相同的请求正在进行时不会重复调用上游，而是等待并共享它的结果：默认按提示词指纹判断是否相同，
+    结果要写入缓存的调用传入缓存键作为 flight_key，主题写法不同但对应同一条缓存的请求也合并在一起。
+    task 决定超时配置；deadline 是整个用户操作的截止时间（time.monotonic()），默认按任务预算计算。
+    在后台任务里调用时，任务被取消会抛出 RequestCancelled；合并在一起的调用全部取消后上游请求才会中止。
+    真正发往上游的请求先按当前线程的优先级在调度器排队，合并进来的调用不占名额，但会把排队优先级提到自己的级别。"""
+    if is_offline_mode():
         return None
     
-    headers = {
-        "Authorization": f"Bearer {DEEPSEEK_API_KEY}",
-        "Content-Type": "application/json"
-    }
-    
+    scope = current_scope()
+    token = scope.token
+    if is_cancelled(token):
+        raise RequestCancelled()
+    # 后台请求的预算从开始发送时算起，排队时间不计入
+    budget_after_queue = deadline is None and scope.priority != "interactive"
+    if deadline is None:
+        deadline = action_deadline(task)
+    
+    single_flight = get_single_flight()
+    models = ",".join(backend.model for backend in get_backends())
+    if flight_key is None:
+        key = request_fingerprint(messages, models, temperature)
+    else:
+        key = hashlib.sha256(json.dumps([flight_key, models, temperature]).encode("utf-8")).hexdigest()
+    scheduler = get_scheduler()
+    flight, is_leader = single_flight.join(key, token, scope.priority)
+    if not is_leader:
+        flight.raise_priority(scope.priority, scheduler)
+        remaining = max(deadline - time.monotonic(), 0.0)
+        return flight.subscribe(timeout=remaining, token=token) if stream else flight.wait_text(timeout=remaining, token=token)
+    
+    # 可取消的调用一律以流式向上游请求，取消时能在生成途中断开连接
+    upstream_stream = stream or token is not None
+    ticket = None
+    try:
+        wait = deadline - time.monotonic() - MIN_ATTEMPT_SECONDS if scope.priority == "interactive" else SCHEDULER_BACKGROUND_MAX_WAIT
+        ticket = scheduler.acquire(scope.priority, wait, flight.abandoned, scope.on_queue, flight.set_ticket)
+        if ticket is None:
+            # 排队已满或等不到名额：学生的请求提示后使用离线内容，后台请求直接放弃
+            if scope.priority == "interactive":
+                notify("warning", "当前使用人数较多，请稍后再试")
+            response = None
+        else:
+            if budget_after_queue:
+                deadline = action_deadline(task)
+            response = _request_deepseek(messages, temperature, max_retries, upstream_stream, task, deadline, flight.abandoned)
+    except RequestCancelled:
+        scheduler.release(ticket)
+        single_flight.complete(key, flight, failed=True)
+        flight.detach(token)
+        get_cancellation_stats().record(task, None)
+        raise
+    except BaseException:
+        scheduler.release(ticket)
+        single_flight.complete(key, flight, failed=True)
+        flight.detach(token)
+        raise
+    
+    if response is None or isinstance(response, str):
+        scheduler.release(ticket)
+        if response is not None:
+            flight.publish(response)
+        single_flight.complete(key, flight, failed=response is None)
+        flight.detach(token)
+        return response
+    
+    # 流式：由后台线程读取上游数据，当前调用和合并进来的调用都从flight回放，
+    # 这样发起者中途离开页面也不会打断其他等待者；所有等待者都取消后才断开上游连接
+    def pump():
+        aborted = False
+        failed = True
+        try:
+            for chunk in response:
+                flight.publish(chunk)
+                if flight.abandoned.cancelled:
+                    aborted = True
+                    break
+            else:
+                failed = False
+        except StreamIncomplete:
+            # 取消时连接被直接断开，读取会以不完整的流结束
+            aborted = flight.abandoned.cancelled
+        finally:
+            if aborted:
+                # 关闭生成器会关闭HTTP连接让上游停止生成，后端并发槽位也随之归还
+                response.close()
+                get_cancellation_stats().record(task, "".join(flight.chunks))
+            scheduler.release(ticket)
+            # 中断或放弃的流只有一部分内容，标记为失败，等待者不会把它当作完整结果
+            single_flight.complete(key, flight, failed=failed)
+    
+    threading.Thread(target=pump, daemon=True).start()
+    if stream:
+        return flight.subscribe(token=token)
+    return flight.wait_text(timeout=max(deadline - time.monotonic(), 0.0), token=token)
+
+def _request_deepseek(messages: List[Dict], temperature: float, max_retries: int, stream: bool, task: str,
+                      deadline: float, cancel: Optional[CancelToken] = None) -> Optional[Union[str, Iterator[str]]]:
+    """按故障转移顺序依次尝试各个后端，不做请求合并；全部失败时提示最后一个错误。
+    cancel 被设置后在下一个检查点抛出 RequestCancelled"""
+    last_error = None
+    for backend in get_backends():
+        check_cancelled(cancel)
+        if not backend.is_configured():
+            continue
+        # 熔断中的后端不再等待超时，直接换下一个
+        if not backend.breaker.allow_request():
+            continue
+        if deadline - time.monotonic() < MIN_ATTEMPT_SECONDS:
+            break
+        try:
+            return _request_backend(backend, messages, temperature, max_retries, stream, task, deadline, cancel)
+        except BackendError as e:
+            backend.record_failover()
+            last_error = e
+    
+    if last_error is None:
+        # 所有后端都在熔断，返回None让调用方使用离线内容
+        notify("toast", "AI服务暂时不稳定，已切换为本地内容")
+    elif last_error.level == "warning":
+        notify("warning", last_error.message)
+    else:
+        notify("error", last_error.message)
+    return None
+
+def _release_slot_after(chunks: Iterator[str], backend: LLMBackend) -> Iterator[str]:
+    """流式响应读完（或中断）后才归还后端的并发槽位"""
+    try:
+        yield from chunks
+    finally:
+        backend.release_slot()
+
+def _request_backend(backend: LLMBackend, messages: List[Dict], temperature: float, max_retries: int,
+                     stream: bool, task: str, deadline: float,
+                     cancel: Optional[CancelToken] = None) -> Union[str, Iterator[str]]:
+    """向一个后端发送请求（并发槽位、密钥池限流、熔断、超时预算内的重试）；失败时抛出 BackendError"""
+    remaining = deadline - time.monotonic()
+    if not backend.acquire_slot(timeout=remaining - MIN_ATTEMPT_SECONDS):
+        raise BackendError("当前使用人数较多，请稍后再试", "warning")
+    try:
+        response = _send_with_retries(backend, messages, temperature, max_retries, stream, task, deadline, cancel)
+    except BaseException:
+        backend.release_slot()
+        raise
+    if isinstance(response, str):
+        backend.release_slot()
+        return response
+    return _release_slot_after(response, backend)
+
+def _send_with_retries(backend: LLMBackend, messages: List[Dict], temperature: float, max_retries: int,
+                       stream: bool, task: str, deadline: float,
+                       cancel: Optional[CancelToken] = None) -> Union[str, Iterator[str]]:
     payload = {
-        "model": "deepseek-chat",
+        "model": backend.model,
         "messages": messages,
         "temperature": temperature,
-        "max_tokens": 2000
+        "max_tokens": MAX_COMPLETION_TOKENS
     }
-    
-    for attempt in range(max_retries):
+    if stream:
+        payload["stream"] = True
+        # 让流的最后一段带上usage，用于统计上下文缓存命中
+        payload["stream_options"] = {"include_usage": True}
+    
+    key_pool = get_key_pool()
+    breaker = backend.breaker
+    latency_tracker = backend.latency
+    estimated_tokens = estimate_tokens("".join(str(message.get("content", "")) for message in messages)) + MAX_COMPLETION_TOKENS
+    
+    attempt = 0
+    rate_limited_count = 0
+    while attempt < max_retries:
+        check_cancelled(cancel)
+        # 熔断期间不再等待超时，交给下一个后端或离线内容
+        if attempt > 0 and not breaker.allow_request():
+            raise BackendError("AI服务暂时不稳定，请稍后再试", "warning")
+        
+        headers = {"Content-Type": "application/json"}
+        key_state = None
+        if backend.use_key_pool:
+            # 从密钥池排队取一个有额度的密钥，所有会话共享同一个节奏；排队时间也计入总预算
+            remaining = deadline - time.monotonic()
+            if remaining >= MIN_ATTEMPT_SECONDS:
+                key_state = key_pool.acquire(estimated_tokens, timeout=min(RATE_LIMIT_MAX_WAIT, remaining - MIN_ATTEMPT_SECONDS))
+            if key_state is None:
+                raise BackendError("当前使用人数较多，请稍后再试", "warning")
+            check_cancelled(cancel)
+            headers["Authorization"] = f"Bearer {key_state.key}"
+        elif backend.api_key:
+            headers["Authorization"] = f"Bearer {backend.api_key}"
+        
+        attempt += 1
+        # 读超时按该任务观测到的延迟自适应，但不能超过剩余预算
+        remaining = deadline - time.monotonic()
+        read_timeout = min(latency_tracker.read_timeout(task, stream), remaining)
+        started = time.monotonic()
+        # 可取消的流式请求：取消时直接关闭socket，不用等响应头或下一段数据，并发槽位和调度名额随即归还
+        abort = RequestAbort() if stream and cancel is not None else None
+        if abort is not None:
+            cancel.on_cancel(abort.abort)
         try:
-            # 缩短超时时间，更快失败
-            response = requests.post(
-                DEEPSEEK_API_URL, 
-                headers=headers, 
-                json=payload, 
-                timeout=(3, 10)  # 更短的超时
-            )
+            try:
+                response = get_http_transport().post(
+                    backend.chat_url, 
+                    headers=headers, 
+                    json=payload, 
+                    timeout=(min(CONNECT_TIMEOUT, remaining), read_timeout),  # 流式时读超时为两段数据之间的最长间隔
+                    stream=stream,
+                    abort=abort
+                )
+            except requests.exceptions.RequestException:
+                if abort is not None:
+                    abort.finish()
+                # 被我们自己断开的连接不算上游故障
+                check_cancelled(cancel)
+                raise
+            if abort is not None and response.status_code != 200:
+                abort.finish()
             
             if response.status_code == 200:
-                return response.json()["choices"][0]["message"]["content"]
-            elif response.status_code == 429:
-                st.warning(f"请求频繁，等待重试 ({attempt+1}/{max_retries})")
-                time.sleep(3)
+                if stream:
+                    # 流式请求以收到响应头的时间作为延迟；成败和用量在流结束后才知道
+                    latency = time.monotonic() - started
+                    latency_tracker.record(task, stream, latency)
+                    
+                    def on_usage(usage: Optional[Dict], complete: Optional[bool], latency: float = latency,
+                                 started: float = started, key_state: Optional[ApiKeyState] = key_state):
+                        # 没收到结束标记就断开算一次失败；我们自己取消或断开的不计入熔断统计
+                        if complete:
+                            breaker.record_success(latency)
+                        elif complete is False and not is_cancelled(cancel):
+                            breaker.record_failure(time.monotonic() - started)
+                        if key_state:
+                            key_pool.record_usage(key_state, estimated_tokens, (usage or {}).get("total_tokens"))
+                        get_prompt_cache_stats().record(PROMPTS.version_id(task), usage, latency)
+                    
+                    return iter_stream_content(response, on_usage, abort)
+                data = response.json()
+                latency = time.monotonic() - started
+                breaker.record_success(latency)
+                latency_tracker.record(task, stream, latency)
+                if key_state:
+                    key_pool.record_usage(key_state, estimated_tokens, (data.get("usage") or {}).get("total_tokens"))
+                get_prompt_cache_stats().record(PROMPTS.version_id(task), data.get("usage"), latency)
+                return data["choices"][0]["message"]["content"]
+            elif response.status_code == 429 and key_state:
+                response.close()
+                # 不单独睡眠：停用该密钥并降速，下一轮从密钥池换一个有额度的密钥
+                key_pool.on_rate_limited(key_state, parse_retry_after(response.headers.get("Retry-After")))
+                rate_limited_count += 1
+                if rate_limited_count > RATE_LIMIT_MAX_RETRIES:
+                    raise BackendError("请求频繁，请稍后再试", "warning")
+                notify("info", f"请求频繁，排队重试中 ({rate_limited_count}/{RATE_LIMIT_MAX_RETRIES})")
+                attempt -= 1
+                continue
+            elif response.status_code in (401, 403) and key_state and len(current_api_keys()) > 1:
+                # 某个密钥失效时停用它，用池里的其他密钥重试
+                response.close()
+                key_pool.on_auth_failed(key_state)
+                attempt -= 1
                 continue
             else:
-                st.error(f"API错误 {response.status_code}: {response.text[:100]}")
-                return None
+                breaker.record_failure(time.monotonic() - started)
+                error_text = response.text[:100]
+                # 5xx 多为上游临时故障，在预算内退避后重试
+                if response.status_code >= 500 and _sleep_before_retry(attempt, max_retries, deadline, cancel):
+                    continue
+                raise BackendError(f"API错误 {response.status_code}: {error_text}")
                 
         except requests.exceptions.Timeout:
-            if attempt < max_retries - 1:
-                st.info(f"请求超时，重试中 ({attempt+1}/{max_retries})")
-                time.sleep(2)
+            latency = time.monotonic() - started
+            breaker.record_failure(latency)
+            # 超时按已等待的时间记入样本，让读超时逐步放宽
+            latency_tracker.record(task, stream, latency)
+            if _sleep_before_retry(attempt, max_retries, deadline, cancel):
+                notify("info", f"请求超时，重试中 ({attempt}/{max_retries})")
                 continue
-            else:
-                st.error("请求超时，请检查网络连接")
-                return None
+            raise BackendError("请求超时，请检查网络连接")
         except requests.exceptions.ConnectionError:
-            st.error("网络连接失败")
-            return None
+            breaker.record_failure(time.monotonic() - started)
+            raise BackendError("网络连接失败")
+        except (BackendError, RequestCancelled):
+            raise
         except Exception as e:
-            st.error(f"API调用错误: {str(e)[:100]}")
-            return None
+            breaker.record_failure(time.monotonic() - started)
+            raise BackendError(f"API调用错误: {str(e)[:100]}")
     
-    return None
+    raise BackendError("AI服务暂时不可用，请稍后再试")
+
+def _sleep_before_retry(attempt: int, max_retries: int, deadline: float,
+                       cancel: Optional[CancelToken] = None) -> bool:
+    """还有重试次数、且退避之后仍有足够预算时睡眠并返回True，否则返回False；睡眠中被取消时抛出 RequestCancelled"""
+    if attempt >= max_retries:
+        return False
+    delay = backoff_delay(attempt)
+    if time.monotonic() + delay + MIN_ATTEMPT_SECONDS > deadline:
+        return False
+    if cancel is not None:
+        cancel.event.wait(delay)
+        check_cancelled(cancel)
+    else:
+        time.sleep(delay)
+    return True
+
+# ==================== 响应缓存 ====================
+# 两级读穿缓存：进程内LRU（按字节数限制内存）→ SQLite（持久化，带过期时间和条数上限）。
+# 条目在 CACHE_FRESH_SECONDS 内是新鲜的；之后直到 CACHE_TTL_SECONDS 过期前仍可先返回旧内容，同时在后台刷新。
+CACHE_DB_PATH = get_config_value("AI_CACHE_DB_PATH",
+                                 os.path.join(os.path.dirname(os.path.abspath(__file__)), ".cache", "ai_cache.sqlite3"))
+CACHE_MEMORY_MAX_BYTES = int(get_config_value("AI_CACHE_MEMORY_MB", 16)) * 1024 * 1024
+CACHE_MAX_ENTRY_BYTES = int(get_config_value("AI_CACHE_MAX_ENTRY_KB", 256)) * 1024  # 超过该大小的单条内容不放进内存
+TEMPLATE_CACHE_MAX_BYTES = int(get_config_value("AI_TEMPLATE_CACHE_MB", 4)) * 1024 * 1024
+CACHE_DB_MAX_ENTRIES = int(get_config_value("AI_CACHE_DB_MAX_ENTRIES", 5000))
+CACHE_TTL_SECONDS = float(get_config_value("AI_CACHE_TTL_HOURS", 7 * 24)) * 3600
+CACHE_FRESH_SECONDS = float(get_config_value("AI_CACHE_FRESH_HOURS", 24)) * 3600
+# 英式/美式拼写统一为美式，避免同一个主题因拼写不同而缓存两份
+SPELLING_VARIANTS = {
+    "favourite": "favorite", "favourites": "favorites", "colour": "color", "colours": "colors",
+    "colourful": "colorful", "neighbour": "neighbor", "neighbours": "neighbors", "neighbourhood": "neighborhood",
+    "behaviour": "behavior", "honour": "honor", "humour": "humor", "labour": "labor", "flavour": "flavor",
+    "centre": "center", "theatre": "theater", "metre": "meter", "programme": "program",
+    "travelling": "traveling", "travelled": "traveled", "organise": "organize", "realise": "realize",
+    "recognise": "recognize", "apologise": "apologize", "practise": "practice", "grey": "gray",
+    "jewellery": "jewelry", "defence": "defense", "licence": "license", "cheque": "check",
+}
+
+def canonicalize_topic(topic: str) -> str:
+    """主题的规范形式：全角转半角、忽略大小写和标点、合并空白、统一拼写变体"""
+    text = unicodedata.normalize("NFKC", str(topic)).lower()
+    # 标点和符号都当作分隔符，中文等文字保留
+    text = "".join(" " if unicodedata.category(char)[0] in "PSZ" else char for char in text)
+    words = [SPELLING_VARIANTS.get(word, word) for word in text.split()]
+    return " ".join(words)
+
+class CacheEntry:
+    """缓存条目及其新鲜度信息"""
+
+    def __init__(self, value: str, version: str, stored_at: float, expires_at: float):
+        self.value = value
+        self.version = version
+        self.stored_at = stored_at
+        self.expires_at = expires_at
+        self.size = len(value.encode("utf-8"))
+
+    @property
+    def age(self) -> float:
+        return max(time.time() - self.stored_at, 0.0)
+
+    def is_fresh(self, namespace: str) -> bool:
+        """提示词版本一致且没有超过新鲜期；提示词改版后推荐内容先返回旧版本再在后台刷新，作文评价则重新请求"""
+        return self.version == PROMPTS.version_id(namespace) and self.age < CACHE_FRESH_SECONDS
+
+class MemoryLRUCache:
+    """进程内LRU缓存，所有会话共享：限制单条大小和总字节数，超出时淘汰最久未使用的条目"""
+
+    def __init__(self, max_bytes: int, max_entry_bytes: Optional[int] = None):
+        self.max_bytes = max_bytes
+        self.max_entry_bytes = min(max_entry_bytes or max_bytes, max_bytes)
+        self.entries: "OrderedDict[str, CacheEntry]" = OrderedDict()
+        self.total_bytes = 0
+        self.evictions = 0
+        self.rejected = 0
+        self.lock = threading.Lock()
+
+    def get(self, key: str) -> Optional[CacheEntry]:
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            if entry.expires_at <= time.time():
+                self._remove(key)
+                return None
+            self.entries.move_to_end(key)
+            return entry
+
+    def put(self, key: str, entry: CacheEntry):
+        with self.lock:
+            if entry.size > self.max_entry_bytes:
+                self.rejected += 1
+                return
+            if key in self.entries:
+                self._remove(key)
+            self.entries[key] = entry
+            self.total_bytes += entry.size
+            while self.total_bytes > self.max_bytes:
+                self._remove(next(iter(self.entries)))
+                self.evictions += 1
+
+    def _remove(self, key: str):
+        self.total_bytes -= self.entries.pop(key).size
+
+    def stats(self) -> Dict:
+        with self.lock:
+            return {
+                "entries": len(self.entries),
+                "bytes": self.total_bytes,
+                "max_bytes": self.max_bytes,
+                "max_entry_bytes": self.max_entry_bytes,
+                "evictions": self.evictions,
+                "rejected": self.rejected
+            }
+
+class SQLiteCache:
+    """持久化缓存：进程重启后仍然有效，过期条目和超出条数上限的最久未访问条目会被清理；
+    登记的代表主题超出上限时清理最早登记的"""
+
+    def __init__(self, path: str, max_entries: int, max_topics: int):
+        self.path = path
+        self.max_entries = max_entries
+        self.max_topics = max_topics
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.lock = threading.Lock()
+        with self.lock, self.conn:
+            self.conn.execute("PRAGMA journal_mode=WAL")
+            self.conn.execute("""
+                CREATE TABLE IF NOT EXISTS responses (
+                    key TEXT PRIMARY KEY,
+                    namespace TEXT NOT NULL,
+                    version TEXT NOT NULL,
+                    value TEXT NOT NULL,
+                    stored_at REAL NOT NULL,
+                    expires_at REAL NOT NULL,
+                    last_access REAL NOT NULL
+                )
+            """)
+            self.conn.execute("CREATE INDEX IF NOT EXISTS idx_responses_access ON responses (last_access)")
+            self.conn.execute("""
+                CREATE TABLE IF NOT EXISTS topics (
+                    namespace TEXT NOT NULL,
+                    grade TEXT NOT NULL,
+                    topic TEXT NOT NULL,
+                    PRIMARY KEY (namespace, grade, topic)
+                )
+            """)
+
+    def get(self, key: str) -> Optional[CacheEntry]:
+        """不存在或已过期时返回None"""
+        now = time.time()
+        with self.lock, self.conn:
+            row = self.conn.execute(
+                "SELECT value, version, stored_at, expires_at FROM responses WHERE key = ? AND expires_at > ?", (key, now)
+            ).fetchone()
+            if row is not None:
+                self.conn.execute("UPDATE responses SET last_access = ? WHERE key = ?", (now, key))
+        return CacheEntry(*row) if row is not None else None
+
+    def put(self, key: str, namespace: str, entry: CacheEntry):
+        now = time.time()
+        with self.lock, self.conn:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO responses (key, namespace, version, value, stored_at, expires_at, last_access) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (key, namespace, entry.version, entry.value, entry.stored_at, entry.expires_at, now)
+            )
+            self._evict(now)
+
+    def add_topic(self, namespace: str, grade: str, topic: str):
+        with self.lock, self.conn:
+            self.conn.execute("INSERT OR IGNORE INTO topics (namespace, grade, topic) VALUES (?, ?, ?)",
+                              (namespace, grade, topic))
+            count = self.conn.execute("SELECT COUNT(*) FROM topics").fetchone()[0]
+            if count > self.max_topics:
+                self.conn.execute(
+                    "DELETE FROM topics WHERE rowid IN (SELECT rowid FROM topics ORDER BY rowid LIMIT ?)",
+                    (count - self.max_topics,)
+                )
+
+    def load_topics(self) -> List[tuple]:
+        """按登记顺序返回"""
+        with self.lock:
+            return self.conn.execute("SELECT namespace, grade, topic FROM topics ORDER BY rowid").fetchall()
+
+    def _evict(self, now: float):
+        self.conn.execute("DELETE FROM responses WHERE expires_at <= ?", (now,))
+        count = self.conn.execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+        if count > self.max_entries:
+            self.conn.execute(
+                "DELETE FROM responses WHERE key IN (SELECT key FROM responses ORDER BY last_access LIMIT ?)",
+                (count - self.max_entries,)
+            )
+
+    def stats(self) -> Dict:
+        with self.lock:
+            count, size, oldest, stale = self.conn.execute(
+                "SELECT COUNT(*), COALESCE(SUM(LENGTH(value)), 0), MIN(stored_at), "
+                "COALESCE(SUM(stored_at <= ?), 0) FROM responses",
+                (time.time() - CACHE_FRESH_SECONDS,)
+            ).fetchone()
+        return {
+            "entries": count,
+            "bytes": size,
+            "stale_entries": stale,
+            "oldest_age": round(time.time() - oldest) if oldest else None
+        }
+
+class TieredCache:
+    """内存LRU + SQLite 两级缓存，命中SQLite时回填内存；SQLite不可用时只用内存"""
+
+    def __init__(self, memory: MemoryLRUCache, disk: Optional[SQLiteCache], ttl: float):
+        self.memory = memory
+        self.disk = disk
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.stale_hits = 0
+        self.max_stale_age = 0.0  # 返回过的最旧内容的年龄（秒）
+
+    @staticmethod
+    def make_key(namespace: str, *parts) -> str:
+        """缓存键不含提示词版本：版本存在条目里，用来判断内容是否过期"""
+        raw = json.dumps([namespace, *parts], ensure_ascii=False)
+        return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+    def lookup(self, key: str) -> Optional[CacheEntry]:
+        """查找未过期的条目（不论是否新鲜），命中SQLite时回填内存"""
+        entry = self.memory.get(key)
+        if entry is not None:
+            self._count("memory_hits")
+            return entry
+        entry = self._disk_call("get", key)
+        if entry is not None:
+            self.memory.put(key, entry)
+            self._count("disk_hits")
+            return entry
+        self._count("misses")
+        return None
+
+    def peek(self, key: str) -> Optional[CacheEntry]:
+        """不计入命中统计的查找，供预取判断是否已有缓存"""
+        return self.memory.get(key) or self._disk_call("get", key)
+
+    def get(self, key: str, namespace: str) -> Optional[str]:
+        """只返回当前提示词版本生成的内容"""
+        entry = self.lookup(key)
+        if entry is None or entry.version != PROMPTS.version_id(namespace):
+            return None
+        return entry.value
+
+    def record_stale_hit(self, entry: CacheEntry):
+        with self.lock:
+            self.stale_hits += 1
+            self.max_stale_age = max(self.max_stale_age, entry.age)
+
+    def put(self, key: str, namespace: str, value: str):
+        now = time.time()
+        entry = CacheEntry(value, PROMPTS.version_id(namespace), now, now + self.ttl)
+        self.memory.put(key, entry)
+        self._disk_call("put", key, namespace, entry)
+
+    def remember_topic(self, namespace: str, grade: str, topic: str):
+        """把新的代表主题写入SQLite，重启后主题索引可以恢复"""
+        self._disk_call("add_topic", namespace, grade, topic)
+
+    def _disk_call(self, method: str, *args):
+        if self.disk is None:
+            return None
+        try:
+            return getattr(self.disk, method)(*args)
+        except sqlite3.Error:
+            # 磁盘缓存出错（例如只读文件系统）时不影响正常请求
+            return None
+
+    def _count(self, counter: str):
+        with self.lock:
+            setattr(self, counter, getattr(self, counter) + 1)
+
+    def stats(self) -> Dict:
+        with self.lock:
+            lookups = self.memory_hits + self.disk_hits + self.misses
+            summary = {
+                "memory_hits": self.memory_hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+                "hit_rate": round((self.memory_hits + self.disk_hits) / lookups, 3) if lookups else 0.0,
+                "stale_hits": self.stale_hits,
+                "max_stale_age": round(self.max_stale_age)
+            }
+        summary["memory"] = self.memory.stats()
+        try:
+            summary["disk"] = self.disk.stats() if self.disk else None
+        except sqlite3.Error:
+            summary["disk"] = None
+        return summary
+
+@st.cache_resource(show_spinner=False)
+def get_response_cache() -> TieredCache:
+    """所有会话共享同一份响应缓存"""
+    try:
+        disk = SQLiteCache(CACHE_DB_PATH, CACHE_DB_MAX_ENTRIES, TOPIC_INDEX_MAX_TOPICS)
+    except (sqlite3.Error, OSError):
+        disk = None
+    return TieredCache(MemoryLRUCache(CACHE_MEMORY_MAX_BYTES, CACHE_MAX_ENTRY_BYTES), disk, CACHE_TTL_SECONDS)
+
+@st.cache_resource(show_spinner=False)
+def get_template_cache() -> MemoryLRUCache:
+    """离线模板内容的共享缓存（只在内存中，不写SQLite）"""
+    return MemoryLRUCache(TEMPLATE_CACHE_MAX_BYTES, CACHE_MAX_ENTRY_BYTES)
+
+def cached_template(name: str, build: Callable[..., str], *args) -> str:
+    """按参数缓存离线模板的渲染结果，所有会话共用一份"""
+    cache = get_template_cache()
+    key = TieredCache.make_key("template", name, *args)
+    entry = cache.get(key)
+    if entry is None:
+        entry = CacheEntry(build(*args), "v1", time.time(), float("inf"))
+        cache.put(key, entry)
+    return entry.value
+
+def cached_ai_text(namespace: str, key: str, response: Optional[Union[str, Iterator[str]]]) -> Optional[Union[str, Iterator[str]]]:
+    """把AI返回的结果写入缓存：字符串直接写入，流式结果只在正常结束后写入。
+    流在结束标记前中断、等待超时或被取消时迭代器会抛出异常，读者提前停止读取时生成器被关闭，这些情况都不写入"""
+    if response is None:
+        return None
+    if isinstance(response, str):
+        if response.strip():
+            get_response_cache().put(key, namespace, response)
+        return response
+    
+    def tee():
+        parts = []
+        completed = False
+        try:
+            for chunk in response:
+                parts.append(chunk)
+                yield chunk
+            completed = True
+        finally:
+            text = "".join(parts)
+            if completed and text.strip():
+                get_response_cache().put(key, namespace, text)
+    
+    return tee()
+
+# ==================== 后台刷新 ====================
+class CacheRevalidator:
+    """过期缓存的后台刷新：每个缓存键同时最多一个刷新任务"""
+
+    def __init__(self):
+        self.in_flight = set()
+        self.lock = threading.Lock()
+        self.refreshed = 0
+        self.failed = 0
+
+    def schedule(self, key: str, refresh: Callable[[], Optional[str]]) -> bool:
+        """安排一次刷新；该键已经在刷新时返回False"""
+        with self.lock:
+            if key in self.in_flight:
+                return False
+            self.in_flight.add(key)
+        threading.Thread(target=self._run, args=(key, refresh), name="cache-revalidate", daemon=True).start()
+        return True
+
+    def _run(self, key: str, refresh: Callable[[], Optional[str]]):
+        try:
+            # 学生已经拿到旧内容，刷新按后台优先级排队
+            succeeded = bool(run_in_scope(RequestScope(priority="prefetch"), refresh))
+        except Exception:
+            succeeded = False
+        with self.lock:
+            self.in_flight.discard(key)
+            if succeeded:
+                self.refreshed += 1
+            else:
+                self.failed += 1
+
+    def stats(self) -> Dict:
+        with self.lock:
+            return {"in_flight": len(self.in_flight), "refreshed": self.refreshed, "failed": self.failed}
+
+@st.cache_resource(show_spinner=False)
+def get_cache_revalidator() -> CacheRevalidator:
+    return CacheRevalidator()
+
+def serve_ai_text(namespace: str, key: str, messages: List[Dict], task: str, stream: bool = False,
+                  temperature: float = 0.7) -> Optional[Union[str, Iterator[str]]]:
+    """stale-while-revalidate 读取：预生成内容和新鲜的缓存直接返回；旧的缓存也立即返回，同时在后台重新生成；
+    没有缓存时调用AI并写入缓存。返回None表示AI不可用，由调用方使用离线内容。"""
+    store = get_content_store()
+    if store is not None:
+        text = store.get(key, namespace)
+        if text is not None:
+            return iter([text]) if stream else text
+    
+    cache = get_response_cache()
+    entry = cache.lookup(key)
+    if entry is not None:
+        if not entry.is_fresh(namespace):
+            cache.record_stale_hit(entry)
+            if not is_offline_mode():
+                def refresh() -> Optional[str]:
+                    text = cached_ai_text(namespace, key, call_deepseek_api(messages, temperature=temperature, task=task,
+                                                                            flight_key=key))
+                    return text if isinstance(text, str) else None
+                get_cache_revalidator().schedule(key, refresh)
+        return iter([entry.value]) if stream else entry.value
+    
+    # 按缓存键合并：写法不同（大小写、标点、拼写变体）但解析到同一代表主题的请求只调用一次上游
+    return cached_ai_text(namespace, key, call_deepseek_api(messages, temperature=temperature, stream=stream, task=task,
+                                                            flight_key=key))
+
+# ==================== 主题近似匹配 ====================
+TOPIC_MATCH_THRESHOLD = float(get_config_value("AI_TOPIC_MATCH_THRESHOLD", 0.8))  # 字符三元组Jaccard相似度阈值
+TOPIC_INDEX_MAX_TOPICS = 20000
+COMMON_WORDS_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "common_words.txt")
+
+@st.cache_resource(show_spinner=False)
+def get_common_words() -> frozenset:
+    """常用英文单词表（只含原形），用来判断一个词是拼错了还是另一个真实的词；文件不存在时为空"""
+    try:
+        with open(COMMON_WORDS_PATH, encoding="utf-8") as f:
+            return frozenset(word for line in f if not line.startswith("#") for word in line.lower().split())
+    except OSError:
+        return frozenset()
+
+def topic_trigrams(topic: str) -> set:
+    padded = f"  {topic} "
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+def topic_words(topic: str) -> List[str]:
+    """比较用的词：英文等按单词，中文按单个汉字"""
+    return re.findall(r"[a-z0-9]+|[^\W\da-z_]", topic)
+
+def word_stems(word: str) -> set:
+    """词本身和去掉复数、时态后缀后可能的原形。es 只在 s/x/z/ch/sh 之后整体去掉（boxes → box），
+    其他情况只去 s（planes → plane，和 plans → plan 不同）；s 前是 s/u/i 时不去（glass、bus、this）"""
+    stems = {word}
+    if len(word) > 4 and word.endswith("ies"):
+        stems.add(word[:-3] + "y")
+    if len(word) > 4 and word.endswith("es") and word[:-2].endswith(("s", "x", "z", "ch", "sh")):
+        stems.add(word[:-2])
+    if len(word) > 3 and word.endswith("s") and word[-2] not in "siu":
+        stems.add(word[:-1])
+    for suffix in ("ing", "ed"):
+        if len(word) > len(suffix) + 2 and word.endswith(suffix):
+            base = word[:-len(suffix)]
+            stems.update((base, base + "e"))
+            if len(base) > 2 and base[-1] == base[-2]:
+                # 双写辅音：running → run
+                stems.add(base[:-1])
+    return stems
+
+def within_one_edit(a: str, b: str) -> bool:
+    """两个词之间最多差一次增、删或替换"""
+    if abs(len(a) - len(b)) > 1:
+        return False
+    if len(a) > len(b):
+        a, b = b, a
+    for i in range(len(a)):
+        if a[i] != b[i]:
+            return a[i:] == b[i + 1:] if len(a) < len(b) else a[i + 1:] == b[i + 1:]
+    return True
+
+def is_word_variant(a: str, b: str, is_real_word: Callable[[str], bool]) -> bool:
+    """单复数、时态等词形变化，或较长单词里的一处拼写差异；
+    两个词都是真实存在的词时（house / horse、books / boots）不算拼写差异"""
+    if word_stems(a) & word_stems(b):
+        return True
+    return min(len(a), len(b)) >= 5 and within_one_edit(a, b) and not (is_real_word(a) and is_real_word(b))
+
+def same_topic_words(a: str, b: str, is_real_word: Callable[[str], bool]) -> bool:
+    """两个主题逐词对应，不同的词都只是词形或拼写变体。多出来的词（例如 not）或意思不同的词
+    （advantages / disadvantages、爸 / 妈）都不算同一主题，避免字符相似度把反义的主题合并"""
+    left = Counter(topic_words(a))
+    right = Counter(topic_words(b))
+    unmatched = list((right - left).elements())
+    for word in (left - right).elements():
+        variant = next((other for other in unmatched if is_word_variant(word, other, is_real_word)), None)
+        if variant is None:
+            return False
+        unmatched.remove(variant)
+    return not unmatched
+
+class TopicIndex:
+    """已缓存主题的字符三元组倒排索引，把近似的主题（单复数、少量拼写差异）映射到同一个代表主题。
+    按 (命名空间, 年级) 分组，只在同一类推荐、同一年级内匹配；三元组相似度只用来找候选，
+    最后还要逐词比较，只有词形和拼写变体才算同一主题。单词表和已登记主题里出现过的词都当作真实的词，不会被当成拼写错误合并。"""
+
+    def __init__(self, threshold: float, max_topics: int = TOPIC_INDEX_MAX_TOPICS,
+                 dictionary: Optional[frozenset] = None):
+        self.threshold = threshold
+        self.max_topics = max_topics
+        self.dictionary = get_common_words() if dictionary is None else dictionary
+        self.words: set = set()  # 已登记主题里出现过的词
+        self.postings: Dict[tuple, Dict[str, set]] = {}  # 分组 -> 三元组 -> 主题集合
+        self.topic_grams: Dict[tuple, Dict[str, set]] = {}  # 分组 -> 主题 -> 三元组
+        self.size = 0
+        self.lock = threading.Lock()
+        self.exact = 0
+        self.fuzzy = 0
+        self.new = 0
+
+    def add(self, group: tuple, topic: str):
+        with self.lock:
+            self._add(group, topic)
+
+    def _add(self, group: tuple, topic: str) -> bool:
+        """返回是否新登记；索引已满时不再登记"""
+        topics = self.topic_grams.setdefault(group, {})
+        if topic in topics or self.size >= self.max_topics:
+            return False
+        grams = topic_trigrams(topic)
+        topics[topic] = grams
+        self.words.update(topic_words(topic))
+        postings = self.postings.setdefault(group, {})
+        for gram in grams:
+            postings.setdefault(gram, set()).add(topic)
+        self.size += 1
+        return True
+
+    def resolve(self, group: tuple, topic: str) -> tuple:
+        """返回 (代表主题, 是否新登记)：组内与 topic 最相似且超过阈值的已有主题，没有时登记 topic 本身；
+        索引已满时直接返回 topic，但不登记"""
+        with self.lock:
+            topics = self.topic_grams.get(group, {})
+            if topic in topics:
+                self.exact += 1
+                return topic, False
+            grams = topic_trigrams(topic)
+            shared_counts: Dict[str, int] = {}
+            for gram in grams:
+                for candidate in self.postings.get(group, {}).get(gram, ()):
+                    shared_counts[candidate] = shared_counts.get(candidate, 0) + 1
+            scored = []
+            for candidate, shared in shared_counts.items():
+                score = shared / (len(grams) + len(topics[candidate]) - shared)
+                if score >= self.threshold:
+                    scored.append((score, candidate))
+            for _, candidate in sorted(scored, reverse=True):
+                if same_topic_words(topic, candidate, self._is_known_word):
+                    self.fuzzy += 1
+                    return candidate, False
+            self.new += 1
+            return topic, self._add(group, topic)
+
+    def _is_known_word(self, word: str) -> bool:
+        return any(stem in self.dictionary or stem in self.words for stem in word_stems(word))
+
+    def stats(self) -> Dict:
+        with self.lock:
+            return {"topics": self.size, "exact": self.exact, "fuzzy": self.fuzzy, "new": self.new}
+
+def normalize_essay(content: str) -> str:
+    """缓存键用的作文内容：只合并空白和换行，大小写和标点都会影响评价所以保留"""
+    return " ".join(str(content).split())
+
+@st.cache_resource(show_spinner=False)
+def get_topic_index() -> TopicIndex:
+    """所有会话共享的主题索引，启动时从SQLite恢复之前登记过的代表主题"""
+    index = TopicIndex(TOPIC_MATCH_THRESHOLD)
+    # 预生成的标准主题也作为代表主题，学生输入的近似写法会命中预生成内容；先登记，索引满了也不会被挤掉
+    store = get_content_store()
+    if store is not None:
+        for namespace, grade, topic in store.topics:
+            index.add((namespace, grade), topic)
+    disk = get_response_cache().disk
+    if disk is not None:
+        try:
+            for namespace, grade, topic in disk.load_topics():
+                index.add((namespace, grade), topic)
+        except sqlite3.Error:
+            pass
+    return index
+
+def resolve_cache_topic(namespace: str, topic: str, grade: str) -> str:
+    """把主题映射到缓存中的代表主题：先规范化，再在同一类推荐、同一年级内做近似匹配"""
+    resolved, is_new = get_topic_index().resolve((namespace, grade), canonicalize_topic(topic))
+    if is_new:
+        get_response_cache().remember_topic(namespace, grade, resolved)
+    return resolved
+
+# ==================== 预生成内容 ====================
+# 标准课本主题的词汇、句型和范文由 `python magic_writing_app.py pregenerate` 离线生成，写入只读的内容文件。
+# 应用启动时用mmap映射该文件，多个工作进程共享操作系统的页缓存，上课时间这些主题不再调用API。
+# 文件格式：魔数 + 索引长度（8字节小端）+ JSON索引 + UTF-8正文；索引记录每条内容的偏移和长度。
+CONTENT_STORE_PATH = get_config_value("AI_CONTENT_STORE_PATH",
+                                      os.path.join(os.path.dirname(os.path.abspath(__file__)), "content_store.bin"))
+CONTENT_STORE_MAGIC = b"MWCS1\n"
+GRADE_OPTIONS = ["Grade 1-2", "Grade 3-4", "Grade 5-6", "Grade 7-8"]
+
+class ContentStore:
+    """只读的预生成内容文件，按缓存键查找"""
+
+    def __init__(self, path: str):
+        self.path = path
+        with open(path, "rb") as f:
+            self.data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        header_size = len(CONTENT_STORE_MAGIC) + 8
+        if self.data[:len(CONTENT_STORE_MAGIC)] != CONTENT_STORE_MAGIC:
+            raise ValueError(f"不是预生成内容文件：{path}")
+        index_length = struct.unpack("<Q", self.data[len(CONTENT_STORE_MAGIC):header_size])[0]
+        index = json.loads(self.data[header_size:header_size + index_length].decode("utf-8"))
+        self.base = header_size + index_length
+        self.index_entries = index["entries"]
+        self.entries = {item["key"]: (item["offset"], item["length"], item["version"]) for item in self.index_entries}
+        self.topics = [(item["namespace"], item["grade"], item["topic"]) for item in self.index_entries]
+        self.created_at = index.get("created_at")
+        self.hits = 0
+
+    def has(self, key: str, namespace: Optional[str] = None) -> bool:
+        """给出 namespace 时，提示词版本和当前不一致的内容视为不存在"""
+        location = self.entries.get(key)
+        return location is not None and (namespace is None or location[2] == PROMPTS.version_id(namespace))
+
+    def get(self, key: str, namespace: Optional[str] = None) -> Optional[str]:
+        """给出 namespace 时只返回用当前提示词版本生成的内容，旧版本的按未命中处理，改由缓存或AI重新生成"""
+        if not self.has(key, namespace):
+            return None
+        offset, length, _ = self.entries[key]
+        self.hits += 1
+        return self.data[self.base + offset:self.base + offset + length].decode("utf-8")
+
+    def stats(self) -> Dict:
+        return {"entries": len(self.entries), "bytes": len(self.data), "hits": self.hits, "created_at": self.created_at}
+
+    @staticmethod
+    def write(path: str, records: List[Dict]):
+        """写入内容文件；records 每项包含 key、namespace、grade、topic、version、value。
+        先写临时文件再替换，已映射旧文件的进程不受影响"""
+        entries = []
+        blobs = []
+        offset = 0
+        for record in records:
+            blob = record["value"].encode("utf-8")
+            entries.append({
+                "key": record["key"],
+                "namespace": record["namespace"],
+                "grade": record["grade"],
+                "topic": record["topic"],
+                "version": record["version"],
+                "offset": offset,
+                "length": len(blob)
+            })
+            blobs.append(blob)
+            offset += len(blob)
+        index = json.dumps({"created_at": datetime.now().strftime("%Y-%m-%d %H:%M:%S"), "entries": entries},
+                           ensure_ascii=False).encode("utf-8")
+        temp_path = f"{path}.tmp"
+        with open(temp_path, "wb") as f:
+            f.write(CONTENT_STORE_MAGIC)
+            f.write(struct.pack("<Q", len(index)))
+            f.write(index)
+            for blob in blobs:
+                f.write(blob)
+        os.replace(temp_path, path)
+
+    def records(self) -> List[Dict]:
+        """读出全部内容，用于增量重新生成"""
+        return [{**item, "value": self.get(item["key"])} for item in self.index_entries]
+
+@st.cache_resource(show_spinner=False)
+def get_content_store() -> Optional[ContentStore]:
+    """进程启动时映射预生成内容文件；文件不存在或损坏时返回None"""
+    if not os.path.exists(CONTENT_STORE_PATH):
+        return None
+    try:
+        return ContentStore(CONTENT_STORE_PATH)
+    except (OSError, ValueError, KeyError):
+        return None
+
+# ==================== 增量JSON解析 ====================
+class IncrementalJSONParser:
+    """增量解析流式返回的JSON对象：每个字段一完整就写入 result，格式错误的尾部不影响已解析的部分"""
+
+    def __init__(self):
+        self.buffer = ""
+        self.result: Dict = {}
+        self.done = False
+        self._pos = 0
+        self._stack: List[Dict] = []
+        self._token_start: Optional[int] = None
+        self._in_string = False
+        self._escape = False
+
+    def feed(self, chunk: str) -> Dict:
+        """追加一段文本并继续解析，返回当前已解析出的结果"""
+        self.buffer += chunk
+        while self._pos < len(self.buffer) and not self.done:
+            self._consume(self.buffer[self._pos], self._pos)
+            self._pos += 1
+        return self.result
+
+    def partial_text(self) -> Optional[tuple]:
+        """正在生成中的顶层字符串字段，返回 (字段名, 已生成的文本)"""
+        if not self._in_string or len(self._stack) != 1:
+            return None
+        frame = self._stack[-1]
+        if frame["state"] != "value":
+            return None
+        raw = self.buffer[self._token_start + 1:]
+        try:
+            return frame["key"], json.loads(f'"{raw}"')
+        except ValueError:
+            pass
+        # 去掉被截断的转义序列，例如末尾的 "\" 或 "\u4e"
+        cut = raw.rfind("\\")
+        if cut != -1 and len(raw) - cut < 6:
+            raw = raw[:cut]
+        try:
+            return frame["key"], json.loads(f'"{raw}"')
+        except ValueError:
+            return frame["key"], raw
+
+    def finish(self) -> Dict:
+        """输出结束：被截断的顶层长文本也保留下来"""
+        partial = self.partial_text()
+        if partial and not self.done:
+            key, text = partial
+            self.result.setdefault(key, text)
+        return self.result
+
+    def _deliver(self, value):
+        if not self._stack:
+            return
+        frame = self._stack[-1]
+        container = frame["container"]
+        if isinstance(container, dict):
+            if frame["state"] == "key":
+                frame["key"] = value if isinstance(value, str) else str(value)
+                frame["state"] = "colon"
+            elif frame["state"] == "value":
+                container[frame["key"]] = value
+                frame["state"] = "comma"
+        else:
+            container.append(value)
+            frame["state"] = "comma"
+
+    def _close_scalar(self, end: int):
+        raw = self.buffer[self._token_start:end]
+        self._token_start = None
+        try:
+            self._deliver(json.loads(raw))
+        except ValueError:
+            # 单个值格式错误时跳过，继续解析后面的字段
+            if self._stack and self._stack[-1]["state"] == "value":
+                self._stack[-1]["state"] = "comma"
+
+    def _consume(self, char: str, index: int):
+        if self._in_string:
+            if self._escape:
+                self._escape = False
+            elif char == "\\":
+                self._escape = True
+            elif char == '"':
+                self._in_string = False
+                self._close_scalar(index + 1)
+            return
+
+        if self._token_start is not None:
+            if char not in ",}] \t\r\n":
+                return
+            self._close_scalar(index)
+
+        if not self._stack:
+            # 跳过JSON之前的说明文字或 ```json 标记
+            if char == "{":
+                self._stack.append({"container": self.result, "key": None, "state": "key"})
+            return
+
+        if char in " \t\r\n":
+            return
+        if char == '"':
+            self._in_string = True
+            self._token_start = index
+        elif char in "{[":
+            container = {} if char == "{" else []
+            self._deliver(container)
+            self._stack.append({"container": container, "key": None,
+                                "state": "key" if char == "{" else "value"})
+        elif char in "}]":
+            self._stack.pop()
+            if not self._stack:
+                self.done = True
+        elif char == ":":
+            self._stack[-1]["state"] = "value"
+        elif char == ",":
+            frame = self._stack[-1]
+            frame["state"] = "key" if isinstance(frame["container"], dict) else "value"
+        else:
+            self._token_start = index
 
 # ==================== 页面配置 ====================
 st.set_page_config(
@@ -803,6 +3295,8 @@ if (document.readyState === 'loading') {
 # ==================== 初始化状态 ====================
 if 'page' not in st.session_state:
     st.session_state.page = 'home'
+if 'last_page' not in st.session_state:
+    st.session_state.last_page = st.session_state.page  # 上一次运行时的页面，用来发现页面切换
 if 'language' not in st.session_state:
     st.session_state.language = 'cn'
 if 'writing_history' not in st.session_state:
@@ -823,22 +3317,144 @@ if 'writing_grade' not in st.session_state:
     st.session_state.writing_grade = 'Grade 3-4'
 if 'evaluation_content' not in st.session_state:
     st.session_state.evaluation_content = ''
+if 'pending_evaluation' not in st.session_state:
+    st.session_state.pending_evaluation = None
+if 'jobs' not in st.session_state:
+    st.session_state.jobs = {}  # 页面位置 -> 后台任务ID
+if 'tool_topic' not in st.session_state:
+    st.session_state.tool_topic = ''
+if 'tool_grade' not in st.session_state:
+    st.session_state.tool_grade = GRADE_OPTIONS[1]
+if 'prefetched' not in st.session_state:
+    st.session_state.prefetched = set()
+if 'prefetch_spent' not in st.session_state:
+    st.session_state.prefetch_spent = 0
+if 'prefetch_candidate' not in st.session_state:
+    st.session_state.prefetch_candidate = None  # 上一次运行时的 (规范化主题, 年级)
+if 'prefetch_pending' not in st.session_state:
+    st.session_state.prefetch_pending = {}  # 缓存键 -> (任务, 计入预算的token, 请求键)
+if 'analysis_results' not in st.session_state:
+    st.session_state.analysis_results = None
+
+# ==================== 评价维度配置 ====================
+DIMENSION_COLORS = {
+    "structure": "#4D96FF",
+    "vocabulary": "#FF9A3D",
+    "phrases": "#6BCF7F",
+    "sentence_patterns": "#9D4DFF",
+    "grammar": "#FF3366",
+    "content": "#33CC33"
+}
+
+DIMENSION_ICONS = {
+    "structure": "🏗️",
+    "vocabulary": "📚",
+    "phrases": "💬",
+    "sentence_patterns": "🔤",
+    "grammar": "✓",
+    "content": "📝"
+}
+
+DIMENSION_NAMES = {
+    "structure": "结构",
+    "vocabulary": "词汇",
+    "phrases": "短语",
+    "sentence_patterns": "句型",
+    "grammar": "语法",
+    "content": "内容"
+}
+
+DIMENSION_DESCRIPTIONS = {
+    "structure": "段落组织、逻辑连贯性",
+    "vocabulary": "词汇丰富度、准确性",
+    "phrases": "固定搭配、习惯用语",
+    "sentence_patterns": "句式多样性、复杂度",
+    "grammar": "语法准确性、时态一致性",
+    "content": "内容充实度、主题相关性"
+}
+
+def normalize_dimension_key(key: str) -> str:
+    """统一模型返回的维度名，例如 "Sentence Patterns" → "sentence_patterns" """
+    return str(key).strip().lower().replace("-", "_").replace(" ", "_")
+
+def to_score(value) -> Optional[int]:
+    """把模型返回的分数（数字或字符串）转换为0-100的整数，无法识别时返回None"""
+    try:
+        return min(max(int(round(float(value))), 0), 100)
+    except (TypeError, ValueError):
+        return None
+
+# ==================== 提示词模板 ====================
+# 固定不变的要求放在system部分，作为每次请求相同的前缀，上游可以命中上下文缓存（KV cache）；
+# 主题、年级、作文等可变内容按字段填进user部分。修改某个模板的文字时用新的版本号注册：
+# 缓存按版本号判断新鲜度，统计也按版本号分开，方便比较新旧提示词的延迟和token用量。
+# 配置 AI_PROMPT_VERSIONS（如 {"evaluate": "v3"}）可以指定使用哪个已注册的版本，默认用最后注册的版本。
+def load_prompt_version_overrides() -> Dict[str, str]:
+    raw = get_config_value("AI_PROMPT_VERSIONS")
+    if isinstance(raw, str):
+        try:
+            raw = json.loads(raw)
+        except ValueError:
+            raw = None
+    return {str(name): str(version) for name, version in dict(raw or {}).items()}
+
+def compact_prompt(text: str) -> str:
+    """去掉浪费token的空白：行首缩进、行尾空格、连续空格和空行，保留换行作为条目分隔"""
+    lines = (re.sub(r"[ \t\u3000]+", " ", line.strip()) for line in text.strip().splitlines())
+    return "\n".join(line for line in lines if line)
+
+class PromptTemplate:
+    """具名、带版本号的提示词模板，system部分以紧凑形式保存并估算token数"""
+
+    def __init__(self, name: str, version: str, system: str, user: str):
+        self.name = name
+        self.version = version
+        self.system = compact_prompt(system)
+        self.user = user
+        self.raw_tokens = estimate_tokens(system)
+        self.system_tokens = estimate_tokens(self.system)
+
+    @property
+    def version_id(self) -> str:
+        return f"{self.name}@{self.version}"
+
+    def render(self, **fields) -> List[Dict]:
+        return [
+            {"role": "system", "content": self.system},
+            {"role": "user", "content": self.user.format(**fields)}
+        ]
+
+class PromptRegistry:
+    """提示词模板注册表：同一个名字可以注册多个版本"""
+
+    def __init__(self, overrides: Dict[str, str]):
+        self.templates: Dict[str, Dict[str, PromptTemplate]] = {}
+        self.overrides = overrides
+
+    def register(self, name: str, version: str, system: str, user: str) -> PromptTemplate:
+        template = PromptTemplate(name, version, system, user)
+        self.templates.setdefault(name, {})[version] = template
+        return template
+
+    def get(self, name: str) -> PromptTemplate:
+        versions = self.templates[name]
+        return versions.get(self.overrides.get(name)) or list(versions.values())[-1]
+
+    def version_id(self, name: str) -> str:
+        """缓存和统计使用的版本标识；没有模板的任务（如健康检查）返回任务名本身"""
+        return self.get(name).version_id if name in self.templates else name
+
+    def stats(self) -> List[Dict]:
+        return [{
+            "version_id": template.version_id,
+            "versions": list(self.templates[name]),
+            "system_tokens": template.system_tokens,
+            "raw_tokens": template.raw_tokens
+        } for name, template in ((name, self.get(name)) for name in self.templates)]
 
-# ==================== 增强版AI助手类 ====================
-class EnhancedAIAssistant:
-    """增强版AI助手，提供更详细的建议"""
-    
-    @staticmethod
-    def evaluate_writing_detailed(topic: str, grade: str, content: str) -> Dict:
-        """详细的作文评价，包含百分制打分和多维度分析"""
-        if OFFLINE_MODE:
-            return EnhancedAIAssistant._get_offline_detailed_evaluation(topic, grade, content)
-            
-        prompt = f"""请对以下英语作文进行详细的评价和打分：
+PROMPTS = PromptRegistry(load_prompt_version_overrides())
 
-作文主题：{topic}
-学生年级：{grade}
-作文内容：{content[:1500]}
+PROMPTS.register("evaluate", "v3", """你是一位经验丰富的英语写作老师，请对学生的英语作文进行详细的评价和打分。
 
 请按照以下要求进行评价：
 
@@ -852,13 +3468,9 @@ class EnhancedAIAssistant:
    - 语法（Grammar）：语法准确性、时态一致性
    - 内容（Content）：内容充实度、主题相关性
 
-3. 详细评价（中英文双语）：
-   - 英文评价：每个维度的具体优点和改进建议
-   - 中文评价：每个维度的具体优点和改进建议
+3. 详细评价：分别用英文和中文写出每个维度的具体优点和改进建议
 
-4. 改进建议：
-   - 提供3-5条具体的修改建议
-   - 给出修改前后的对比示例
+4. 改进建议：3-5条具体的修改建议，附修改前后的对比示例
 
 5. 鼓励性总结
 
@@ -870,26 +3482,335 @@ class EnhancedAIAssistant:
 - improvement_suggestions: 改进建议列表
 - encouragement: 鼓励性话语
 
-注意：评价要具体、有建设性，既要指出优点也要提出改进建议。"""
+注意：评价要具体、有建设性，既要指出优点也要提出改进建议。评价标准要符合学生所在年级的水平。""",
+                 "作文主题：{topic}\n学生年级：{grade}\n作文内容：\n{content}")
+
+PROMPTS.register("suggestions", "v3", """你是一位耐心的英语写作老师，请对学生的英语作文提供详细的改进建议。
+
+请从以下几个方面提供具体、可操作的改进建议：
+
+1. 内容扩展建议（如何增加细节和描述）
+2. 词汇提升建议（哪些词汇可以替换为更丰富的词汇）
+3. 句型改进建议（如何让句子更丰富多样）
+4. 语法和拼写检查（指出明显的错误）
+5. 结构优化建议（如何组织段落更合理）
+6. 创意提升建议（如何让作文更有趣）
+
+每个建议都要具体，给出修改前后的对比示例。
+请用中文回复，语言要友好、鼓励。
+最后给出一个改进后的段落示例。""",
+                 "作文主题：{topic}\n学生年级：{grade}\n作文内容：\n{content}")
+
+PROMPTS.register("vocabulary", "v3", """你是一位英语老师，请为学生的写作主题推荐详细的英语词汇，难度符合学生的年级。
+
+请按以下结构推荐：
+
+1. 核心词汇（8-10个，必须掌握的词汇）
+   - 每个词汇要有：英文、中文、词性、例句
+
+2. 扩展词汇（10-15个，提高用词汇）
+   - 按词性分类：名词、动词、形容词、副词
+
+3. 短语搭配（5-8个，常用短语）
+
+4. 使用建议和记忆技巧
+
+请用中文回复，格式要清晰易读。""",
+                 "主题：{topic}\n年级：{grade}")
+
+PROMPTS.register("sentences", "v3", """你是一位英语老师，请为学生的写作主题推荐详细的英语句型，难度符合学生的年级。
+
+请按以下结构推荐：
+
+1. 基础句型（5-8个，适合初学者的简单句型）
+   - 每个句型要有：英文句型、中文解释、2个例句
+
+2. 中级句型（5-8个，有一定难度的句型）
+   - 包括：复合句、从句等
+
+3. 高级句型（3-5个，提高用句型）
+   - 包括：倒装句、强调句等
+
+4. 句型练习建议和常见错误提醒
+
+请用中文回复，格式清晰。""",
+                 "主题：{topic}\n年级：{grade}")
+
+PROMPTS.register("essay", "v3", """你是一位英语老师，请为学生的写作主题写一篇英语范文。
+
+要求：
+
+1. 范文的词汇和句型符合该年级学生的水平，长度适中
+
+2. 结构清晰：开头点题、中间2-3个细节、结尾总结感受
+
+3. 范文后附中文翻译
+
+4. 列出3-5个值得学习的好词好句，并说明好在哪里
+
+请用Markdown格式回复。""",
+                 "主题：{topic}\n年级：{grade}")
+
+# 长作文分段时使用，system部分与整篇时完全相同，可以共用上游的上下文缓存
+PROMPTS.register("evaluate_chunk", "v1", PROMPTS.get("evaluate").system,
+                 "作文主题：{topic}\n学生年级：{grade}\n这是一篇长作文的第{index}/{total}部分，只评价这一部分。\n作文内容：\n{content}")
+
+PROMPTS.register("suggestions_chunk", "v1", PROMPTS.get("suggestions").system,
+                 "作文主题：{topic}\n学生年级：{grade}\n这是一篇长作文的第{index}/{total}部分，只针对这一部分提建议。\n作文内容：\n{content}")
+
+# ==================== 长作文分段 ====================
+ESSAY_CHUNK_TOKENS = int(get_config_value("AI_ESSAY_CHUNK_TOKENS", 400))  # 作文超过这个token数时分段请求
+ESSAY_CHUNK_MAX_PARALLEL = int(get_config_value("AI_ESSAY_CHUNK_MAX_PARALLEL", 4))
+
+def split_essay(content: str, max_tokens: int = ESSAY_CHUNK_TOKENS) -> List[str]:
+    """按段落把长作文切成长度相近的几段，每段尽量不超过 max_tokens，超长的段落再按句子切开；
+    不超过上限的作文原样返回一段"""
+    total_tokens = estimate_tokens(content)
+    if total_tokens <= max_tokens:
+        return [content]
+    
+    pieces = []  # (文本, 是否新段落)
+    for paragraph in re.split(r"\n\s*", content.strip()):
+        if estimate_tokens(paragraph) <= max_tokens:
+            pieces.append((paragraph, True))
+            continue
+        sentences = [sentence for sentence in re.split(r"(?<=[.!?。！？])\s+", paragraph) if sentence]
+        pieces.extend((sentence, i == 0) for i, sentence in enumerate(sentences))
+    
+    # 加上下一块会超过剩余内容的平均长度时就结束（已经不太短的前提下），避免最后剩下很短的一段
+    piece_tokens = [estimate_tokens(text) for text, _ in pieces]
+    remaining = sum(piece_tokens)
+    chunk_count = -(-remaining // max_tokens)
+    target = -(-remaining // chunk_count)
+    chunks, current, current_tokens = [], "", 0
+    for (text, new_paragraph), tokens in zip(pieces, piece_tokens):
+        if current and (current_tokens + tokens > max_tokens
+                        or (current_tokens + tokens > target and current_tokens * 2 >= target)):
+            chunks.append(current)
+            remaining -= current_tokens
+            target = -(-remaining // max(chunk_count - len(chunks), 1))
+            current, current_tokens = "", 0
+        if current:
+            current += "\n\n" if new_paragraph else " "
+        current += text
+        current_tokens += tokens
+    if current:
+        chunks.append(current)
+    return chunks
+
+def map_chunks_concurrently(chunks: List[str], request: Callable[[int, str], Optional[str]]) -> Iterator[tuple]:
+    """并发处理各段，按完成顺序产出 (序号, 结果)；单段出错时结果为None，任务取消时抛出 RequestCancelled"""
+    def run(index: int) -> Optional[str]:
+        try:
+            return request(index, chunks[index])
+        except RequestCancelled:
+            raise
+        except Exception:
+            return None
+    
+    scope = current_scope()
+    executor = ThreadPoolExecutor(max_workers=min(len(chunks), ESSAY_CHUNK_MAX_PARALLEL))
+    try:
+        futures = {executor.submit(run_in_scope, scope, run, index): index for index in range(len(chunks))}
+        for future in as_completed(futures):
+            yield futures[future], future.result()
+    finally:
+        # 调用方提前停止读取时不等待剩下的请求
+        executor.shutdown(wait=False)
+
+# ==================== 增强版AI助手类 ====================
+class EnhancedAIAssistant:
+    """增强版AI助手，提供更详细的建议"""
+    
+    @staticmethod
+    def evaluate_writing_detailed(topic: str, grade: str, content: str,
+                                  on_update: Optional[Callable[[IncrementalJSONParser], None]] = None) -> Dict:
+        """详细的作文评价，包含百分制打分和多维度分析；传入 on_update 时流式解析，每收到一段回调一次。
+        内容没有变化的作文直接返回上次完整的AI评价，分数保持一致"""
+        chunks = split_essay(content)
+        # 长作文用分段提示词评价，缓存按分段提示词的版本判断是否过期；分段数也计入缓存键，分段设置变化后重新评价
+        namespace = "evaluate_chunk" if len(chunks) > 1 else "evaluate"
+        key_parts = [canonicalize_topic(topic), grade, normalize_essay(content)] + ([len(chunks)] if len(chunks) > 1 else [])
+        cache_key = TieredCache.make_key(namespace, *key_parts)
+        cached = get_response_cache().get(cache_key, namespace)
+        if cached is not None:
+            return {**json.loads(cached), "from_cache": True}
+        
+        if is_offline_mode():
+            return EnhancedAIAssistant._get_offline_detailed_evaluation(topic, grade, content)
         
-        messages = [{"role": "user", "content": prompt}]
-        response = call_deepseek_api(messages, temperature=0.3)
+        if len(chunks) > 1:
+            evaluation = EnhancedAIAssistant._evaluate_in_chunks(topic, grade, content, chunks, on_update)
+            if evaluation is None:
+                return EnhancedAIAssistant._get_offline_detailed_evaluation(topic, grade, content)
+            if evaluation.get("is_partial") is False:
+                get_response_cache().put(cache_key, namespace, json.dumps(evaluation, ensure_ascii=False))
+            return evaluation
+            
+        messages = EnhancedAIAssistant._evaluation_messages(topic, grade, content)
+        response = call_deepseek_api(messages, temperature=0.3, stream=on_update is not None, task="evaluate")
         
         if response:
+            # 增量解析JSON响应，尾部格式错误或流中途断开时保留已经解析出的字段；任务取消照常抛出
+            parser = IncrementalJSONParser()
+            incomplete = False
             try:
-                # 尝试解析JSON响应
-                import re
-                json_match = re.search(r'\{.*\}', response, re.DOTALL)
-                if json_match:
-                    return json.loads(json_match.group())
+                if isinstance(response, str):
+                    parser.feed(response)
                 else:
-                    # 如果不是JSON，使用离线版本
-                    return EnhancedAIAssistant._get_offline_detailed_evaluation(topic, grade, content)
-            except:
-                return EnhancedAIAssistant._get_offline_detailed_evaluation(topic, grade, content)
+                    for chunk in response:
+                        parser.feed(chunk)
+                        on_update(parser)
+            except StreamIncomplete:
+                incomplete = True
+            evaluation = EnhancedAIAssistant._complete_evaluation(parser.finish(), topic, grade, content)
+            if incomplete and not evaluation.get("is_offline"):
+                evaluation["is_partial"] = True
+            # 只缓存完整的AI评价；不完整或退回离线评价的结果下次重新请求
+            if evaluation.get("is_partial") is False:
+                get_response_cache().put(cache_key, "evaluate", json.dumps(evaluation, ensure_ascii=False))
+            return evaluation
         else:
             return EnhancedAIAssistant._get_offline_detailed_evaluation(topic, grade, content)
     
+    @staticmethod
+    def _evaluation_messages(topic: str, grade: str, content: str) -> List[Dict]:
+        return PROMPTS.get("evaluate").render(topic=topic, grade=grade, content=content)
+    
+    @staticmethod
+    def _evaluate_in_chunks(topic: str, grade: str, content: str, chunks: List[str],
+                            on_update: Optional[Callable[[IncrementalJSONParser], None]] = None) -> Optional[Dict]:
+        """长作文分段并发评价后合并为一份评价；每完成一段回调一次 on_update，所有段都失败时返回None"""
+        deadline = action_deadline("evaluate_chunk")
+        
+        def evaluate_chunk(index: int, chunk: str) -> Optional[Dict]:
+            messages = PROMPTS.get("evaluate_chunk").render(
+                topic=topic, grade=grade, index=index + 1, total=len(chunks), content=chunk
+            )
+            response = call_deepseek_api(messages, temperature=0.3, task="evaluate_chunk", deadline=deadline)
+            if not response:
+                return None
+            parser = IncrementalJSONParser()
+            parser.feed(response)
+            return parser.finish()
+        
+        parts: List[Optional[Dict]] = [None] * len(chunks)
+        weights = [estimate_tokens(chunk) for chunk in chunks]
+        for index, part in map_chunks_concurrently(chunks, evaluate_chunk):
+            parts[index] = part
+            if on_update is not None and part:
+                parser = IncrementalJSONParser()
+                parser.feed(json.dumps(EnhancedAIAssistant._merge_chunk_evaluations(parts, weights), ensure_ascii=False))
+                on_update(parser)
+        
+        if not any(parts):
+            return None
+        evaluation = EnhancedAIAssistant._complete_evaluation(
+            EnhancedAIAssistant._merge_chunk_evaluations(parts, weights), topic, grade, content
+        )
+        # 有段落没评上时不算完整评价，不写入缓存
+        if not all(parts):
+            evaluation["is_partial"] = True
+        evaluation["chunks"] = len(chunks)
+        return evaluation
+    
+    @staticmethod
+    def _merge_chunk_evaluations(parts: List[Optional[Dict]], weights: List[int]) -> Dict:
+        """合并各段评价：分数按段落长度加权平均，评语按段落顺序拼接，建议去重后合并"""
+        def weighted(scores: List[tuple]) -> Optional[int]:
+            total_weight = sum(weight for _, weight in scores)
+            return round(sum(score * weight for score, weight in scores) / total_weight) if total_weight else None
+        
+        overall_scores, dimension_scores, texts = [], {}, {"english_evaluation": [], "chinese_evaluation": []}
+        suggestions, encouragement = [], None
+        for index, (part, weight) in enumerate(zip(parts, weights)):
+            if not part:
+                continue
+            overall = to_score(part.get("overall_score"))
+            if overall is not None:
+                overall_scores.append((overall, weight))
+            if isinstance(part.get("dimension_scores"), dict):
+                for key, value in part["dimension_scores"].items():
+                    score = to_score(value)
+                    if score is not None:
+                        dimension_scores.setdefault(normalize_dimension_key(key), []).append((score, weight))
+            for field, collected in texts.items():
+                if field in part:
+                    collected.append(f"**（第{index + 1}/{len(parts)}部分）**\n\n{EnhancedAIAssistant._as_text(part[field])}")
+            for item in part.get("improvement_suggestions") or []:
+                text = EnhancedAIAssistant._as_text(item)
+                if text not in suggestions:
+                    suggestions.append(text)
+            if encouragement is None and "encouragement" in part:
+                encouragement = part["encouragement"]
+        
+        merged = {}
+        if overall_scores:
+            merged["overall_score"] = weighted(overall_scores)
+        if dimension_scores:
+            merged["dimension_scores"] = {dimension: weighted(scores) for dimension, scores in dimension_scores.items()}
+        for field, collected in texts.items():
+            if collected:
+                merged[field] = "\n\n".join(collected)
+        if suggestions:
+            merged["improvement_suggestions"] = suggestions
+        if encouragement is not None:
+            merged["encouragement"] = encouragement
+        return merged
+    
+    @staticmethod
+    def _as_text(value) -> str:
+        """模型有时把文本字段返回成字典或列表，统一转换为Markdown文本"""
+        if isinstance(value, dict):
+            return "\n\n".join(f"**{key}:** {EnhancedAIAssistant._as_text(item)}" for key, item in value.items())
+        if isinstance(value, list):
+            return "\n".join(f"- {EnhancedAIAssistant._as_text(item)}" for item in value)
+        return str(value)
+    
+    @staticmethod
+    def _complete_evaluation(partial: Dict, topic: str, grade: str, content: str) -> Dict:
+        """把（可能不完整的）AI评价补全为页面需要的结构；一个分数都没有时才使用离线评价"""
+        raw_dimensions = partial.get("dimension_scores")
+        dimension_scores = {}
+        if isinstance(raw_dimensions, dict):
+            for key, value in raw_dimensions.items():
+                dimension = normalize_dimension_key(key)
+                score = to_score(value)
+                if dimension in DIMENSION_NAMES and score is not None:
+                    dimension_scores[dimension] = score
+        
+        overall_score = to_score(partial.get("overall_score"))
+        if overall_score is None and not dimension_scores:
+            return EnhancedAIAssistant._get_offline_detailed_evaluation(topic, grade, content)
+        if overall_score is None:
+            overall_score = round(sum(dimension_scores.values()) / len(dimension_scores))
+        
+        required_fields = ["dimension_scores", "english_evaluation", "chinese_evaluation",
+                           "improvement_suggestions", "encouragement"]
+        is_partial = any(field not in partial for field in required_fields) or \
+            any(dimension not in dimension_scores for dimension in DIMENSION_NAMES)
+        
+        # 缺失的维度按总体分数补齐
+        for dimension in DIMENSION_NAMES:
+            dimension_scores.setdefault(dimension, overall_score)
+        
+        suggestions = partial.get("improvement_suggestions")
+        if not isinstance(suggestions, list) or not suggestions:
+            suggestions = EnhancedAIAssistant._get_offline_detailed_evaluation(topic, grade, content)["improvement_suggestions"]
+        
+        missing_text = "（AI评价内容生成不完整，已保留AI给出的评分）"
+        return {
+            "overall_score": overall_score,
+            "dimension_scores": dimension_scores,
+            "english_evaluation": EnhancedAIAssistant._as_text(partial.get("english_evaluation", missing_text)),
+            "chinese_evaluation": EnhancedAIAssistant._as_text(partial.get("chinese_evaluation", missing_text)),
+            "improvement_suggestions": [EnhancedAIAssistant._as_text(item) for item in suggestions],
+            "encouragement": EnhancedAIAssistant._as_text(
+                partial.get("encouragement", "Great effort! Keep practicing and you will keep improving! 🌟")
+            ),
+            "is_partial": is_partial
+        }
+    
     @staticmethod
     def _get_offline_detailed_evaluation(topic: str, grade: str, content: str) -> Dict:
         """离线详细评价"""
@@ -988,41 +3909,67 @@ This is a good effort! The essay shows understanding of the topic and generally
                 "Include specific examples to support your main ideas.",
                 "Practice using new vocabulary words in your writing."
             ],
-            "encouragement": "Great effort! Keep practicing and you will continue to improve your English writing skills. Remember, every great writer started somewhere! 🌟"
+            "encouragement": "Great effort! Keep practicing and you will continue to improve your English writing skills. Remember, every great writer started somewhere! 🌟",
+            "is_offline": True  # 示例评分，不是AI对这篇作文的评价
         }
     
     @staticmethod
-    def provide_detailed_writing_suggestions(topic: str, grade: str, content: str) -> str:
-        """提供详细的写作建议"""
-        if OFFLINE_MODE:
-            return EnhancedAIAssistant._get_offline_detailed_suggestions(topic, grade, content)
-            
-        prompt = f"""请对以下英语作文提供详细的改进建议：
-        
-        作文主题：{topic}
-        学生年级：{grade}
-        作文内容：{content[:1000]}
-        
-        请从以下几个方面提供具体、可操作的改进建议：
-        
-        1. 内容扩展建议（如何增加细节和描述）
-        2. 词汇提升建议（哪些词汇可以替换为更丰富的词汇）
-        3. 句型改进建议（如何让句子更丰富多样）
-        4. 语法和拼写检查（指出明显的错误）
-        5. 结构优化建议（如何组织段落更合理）
-        6. 创意提升建议（如何让作文更有趣）
-        
-        每个建议都要具体，给出修改前后的对比示例。
-        请用中文回复，语言要友好、鼓励。
-        最后给出一个改进后的段落示例。"""
-        
-        messages = [{"role": "user", "content": prompt}]
-        response = call_deepseek_api(messages, temperature=0.3)
+    def _offline_result(text: str, stream: bool) -> Union[str, Iterator[str]]:
+        """离线结果在流式模式下也包装成迭代器，调用方无需区分"""
+        return iter([text]) if stream else text
+    
+    @staticmethod
+    def provide_detailed_writing_suggestions(topic: str, grade: str, content: str,
+                                             stream: bool = False) -> Union[str, Iterator[str]]:
+        """提供详细的写作建议；stream=True 时逐段返回。长作文分段并发请求，按段落顺序拼接"""
+        chunks = split_essay(content)
+        if len(chunks) > 1 and not is_offline_mode():
+            response = EnhancedAIAssistant._suggestions_in_chunks(topic, grade, chunks, stream)
+        else:
+            messages = EnhancedAIAssistant._suggestions_messages(topic, grade, content)
+            response = call_deepseek_api(messages, temperature=0.3, stream=stream, task="suggestions")
         
         if response:
             return response
         else:
-            return EnhancedAIAssistant._get_offline_detailed_suggestions(topic, grade, content)
+            return EnhancedAIAssistant._offline_result(
+                EnhancedAIAssistant._get_offline_detailed_suggestions(topic, grade, content), stream
+            )
+    
+    @staticmethod
+    def _suggestions_messages(topic: str, grade: str, content: str) -> List[Dict]:
+        return PROMPTS.get("suggestions").render(topic=topic, grade=grade, content=content)
+    
+    @staticmethod
+    def _suggestions_in_chunks(topic: str, grade: str, chunks: List[str],
+                               stream: bool) -> Optional[Union[str, Iterator[str]]]:
+        """长作文分段并发请求建议；流式时前面的段落一完成就输出。所有段都失败时返回None"""
+        deadline = action_deadline("suggestions_chunk")
+        
+        def suggest_chunk(index: int, chunk: str) -> Optional[str]:
+            messages = PROMPTS.get("suggestions_chunk").render(
+                topic=topic, grade=grade, index=index + 1, total=len(chunks), content=chunk
+            )
+            return call_deepseek_api(messages, temperature=0.3, task="suggestions_chunk", deadline=deadline)
+        
+        def ordered_sections() -> Iterator[str]:
+            results: Dict[int, Optional[str]] = {}
+            next_index = 0
+            for index, text in map_chunks_concurrently(chunks, suggest_chunk):
+                results[index] = text
+                while next_index in results:
+                    text = results.pop(next_index)
+                    if text:
+                        yield f"## 📄 第{next_index + 1}/{len(chunks)}部分\n\n{text}\n\n"
+                    next_index += 1
+        
+        if stream:
+            sections = ordered_sections()
+            first = next(sections, None)
+            if first is None:
+                return None
+            return itertools.chain([first], sections)
+        return "".join(ordered_sections()) or None
     
     @staticmethod
     def _get_offline_detailed_suggestions(topic: str, grade: str, content: str) -> str:
@@ -1082,34 +4029,19 @@ This is a good effort! The essay shows understanding of the topic and generally
         return suggestions
     
     @staticmethod
-    def recommend_vocabulary_for_topic(topic: str, grade: str) -> str:
-        """详细的词汇推荐"""
-        if OFFLINE_MODE:
-            return EnhancedAIAssistant._get_offline_detailed_vocab(topic, grade)
-            
-        prompt = f"""请为以下写作主题推荐详细的英语词汇：
-        
-        主题：{topic}
-        年级：{grade}
-        
-        请按以下结构推荐：
+    def recommend_vocabulary_for_topic(topic: str, grade: str, stream: bool = False) -> Union[str, Iterator[str]]:
+        """详细的词汇推荐；stream=True 时逐段返回。同一主题和年级的AI结果会被缓存，过期后先返回旧内容再后台刷新"""
+        cache_key = TieredCache.make_key("vocabulary", resolve_cache_topic("vocabulary", topic, grade), grade)
+        messages = EnhancedAIAssistant._vocabulary_messages(topic, grade)
+        response = serve_ai_text("vocabulary", cache_key, messages, task="vocabulary", stream=stream)
         
-        1. 核心词汇（8-10个，必须掌握的词汇）
-           - 每个词汇要有：英文、中文、词性、例句
-        
-        2. 扩展词汇（10-15个，提高用词汇）
-           - 按词性分类：名词、动词、形容词、副词
-        
-        3. 短语搭配（5-8个，常用短语）
-        
-        4. 使用建议和记忆技巧
-        
-        请用中文回复，格式要清晰易读。"""
-        
-        messages = [{"role": "user", "content": prompt}]
-        response = call_deepseek_api(messages)
-        
-        return response or EnhancedAIAssistant._get_offline_detailed_vocab(topic, grade)
+        return response or EnhancedAIAssistant._offline_result(
+            cached_template("vocabulary", EnhancedAIAssistant._get_offline_detailed_vocab, topic, grade), stream
+        )
+    
+    @staticmethod
+    def _vocabulary_messages(topic: str, grade: str) -> List[Dict]:
+        return PROMPTS.get("vocabulary").render(topic=topic, grade=grade)
     
     @staticmethod
     def _get_offline_detailed_vocab(topic: str, grade: str) -> str:
@@ -1201,35 +4133,19 @@ This is a good effort! The essay shows understanding of the topic and generally
 """
     
     @staticmethod
-    def recommend_sentences_for_topic(topic: str, grade: str) -> str:
-        """详细的句型推荐"""
-        if OFFLINE_MODE:
-            return EnhancedAIAssistant._get_offline_detailed_sentences(topic, grade)
-            
-        prompt = f"""请为以下写作主题推荐详细的英语句型：
-        
-        主题：{topic}
-        年级：{grade}
-        
-        请按以下结构推荐：
-        
-        1. 基础句型（5-8个，适合初学者的简单句型）
-           - 每个句型要有：英文句型、中文解释、2个例句
-        
-        2. 中级句型（5-8个，有一定难度的句型）
-           - 包括：复合句、从句等
-        
-        3. 高级句型（3-5个，提高用句型）
-           - 包括：倒装句、强调句等
-        
-        4. 句型练习建议和常见错误提醒
+    def recommend_sentences_for_topic(topic: str, grade: str, stream: bool = False) -> Union[str, Iterator[str]]:
+        """详细的句型推荐；stream=True 时逐段返回。同一主题和年级的AI结果会被缓存，过期后先返回旧内容再后台刷新"""
+        cache_key = TieredCache.make_key("sentences", resolve_cache_topic("sentences", topic, grade), grade)
+        messages = EnhancedAIAssistant._sentences_messages(topic, grade)
+        response = serve_ai_text("sentences", cache_key, messages, task="sentences", stream=stream)
         
-        请用中文回复，格式清晰。"""
-        
-        messages = [{"role": "user", "content": prompt}]
-        response = call_deepseek_api(messages)
-        
-        return response or EnhancedAIAssistant._get_offline_detailed_sentences(topic, grade)
+        return response or EnhancedAIAssistant._offline_result(
+            cached_template("sentences", EnhancedAIAssistant._get_offline_detailed_sentences, topic, grade), stream
+        )
+    
+    @staticmethod
+    def _sentences_messages(topic: str, grade: str) -> List[Dict]:
+        return PROMPTS.get("sentences").render(topic=topic, grade=grade)
     
     @staticmethod
     def _get_offline_detailed_sentences(topic: str, grade: str) -> str:
@@ -1283,63 +4199,760 @@ This is a good effort! The essay shows understanding of the topic and generally
 - Spring is not only warm but also beautiful.
 - I not only like spring but also enjoy summer.
 
-## 🚀 高级句型（提高用）
+## 🚀 高级句型（提高用）
+
+### 1. 定语从句
+**句型：** Noun + that/which + Verb
+**中文：** ...的...
+**例句：**
+- Spring is the season that brings new life.
+- Flowers that bloom in spring are colorful.
+
+### 2. 现在分词作状语
+**句型：** Verb-ing, Subject + Verb
+**中文：** ...着，...
+**例句：**
+- Walking in the park, I enjoy the spring breeze.
+- Seeing flowers bloom, I feel happy.
+
+## 💡 句型组合练习
+
+### 初级组合
+**原句：** I like spring.
+**扩展：** I like spring because the weather is warm and flowers are beautiful.
+
+### 中级组合
+**原句：** Spring is good.
+**扩展：** What I like most about spring is that it brings new life to nature.
+
+## 🎓 练习建议
+
+### 每日练习计划
+1. **句型模仿**：每个句型模仿造2个句子
+2. **句型转换**：把一个句子用不同句型表达
+3. **句子扩展**：把简单句扩展为复杂句
+4. **错误纠正**：检查自己句子的语法错误
+
+### 常见错误提醒
+❌ **错误：** I very like spring.
+✅ **正确：** I like spring very much.
+
+❌ **错误：** Spring weather is warm and nice.
+✅ **更好：** Spring weather is pleasantly warm and enjoyable.
+
+## 📝 写作应用
+
+### 开头句参考
+- Among the four seasons, I prefer spring the most.
+- Spring is undoubtedly my favorite season.
+
+### 中间句参考
+- One of the reasons why I love spring is...
+- What makes spring special is...
+
+### 结尾句参考
+- In conclusion, spring is truly a wonderful season.
+- That's why spring holds a special place in my heart.
+
+✨ **多练习这些句型，你的英语写作会越来越流畅！**
+"""
+    
+    @staticmethod
+    def recommend_model_essay(topic: str, grade: str, stream: bool = False) -> Union[str, Iterator[str]]:
+        """参考范文；stream=True 时逐段返回。和词汇、句型推荐一样走预生成内容和缓存"""
+        cache_key = TieredCache.make_key("essay", resolve_cache_topic("essay", topic, grade), grade)
+        messages = EnhancedAIAssistant._model_essay_messages(topic, grade)
+        response = serve_ai_text("essay", cache_key, messages, task="essay", stream=stream)
+        
+        return response or EnhancedAIAssistant._offline_result(
+            cached_template("essay", EnhancedAIAssistant._get_offline_model_essay, topic, grade), stream
+        )
+    
+    @staticmethod
+    def _model_essay_messages(topic: str, grade: str) -> List[Dict]:
+        return PROMPTS.get("essay").render(topic=topic, grade=grade)
+    
+    @staticmethod
+    def _get_offline_model_essay(topic: str, grade: str) -> str:
+        """离线范文"""
+        return f"""
+# 📖 主题「{topic}」参考范文
+
+**My Favorite Season**
+
+There are four seasons in a year, and my favorite season is spring.
+
+In spring, the weather gets warm and the days become longer. Flowers bloom in the park, and the trees turn green again. I often fly kites with my friends on the grass. We laugh and run happily.
+
+Spring is also a season of hope. Farmers plant seeds in the fields, and I make new plans for the year, too.
+
+That's why I love spring. It makes me feel happy and full of energy!
+
+## 🌏 中文翻译
+
+一年有四个季节，我最喜欢的是春天。春天天气变暖，白天变长。公园里花儿盛开，树木重新变绿。我常常和朋友们在草地上放风筝，我们开心地笑着、跑着。春天也是充满希望的季节，农民在田里播种，我也为新的一年制定计划。这就是我喜欢春天的原因，它让我感到快乐、充满活力！
+
+## ✨ 好词好句
+
+- **bloom** - 开花：*Flowers bloom in the park.*
+- **turn green again** - 重新变绿，用 turn 表示变化
+- **That's why...** - 这就是……的原因，适合用在结尾总结
+- **make me feel + 形容词** - 让我感到……
+
+💡 **写作时可以参考这篇范文的结构：开头点题 → 中间写2-3个细节 → 结尾说出自己的感受。**
+"""
+
+# ==================== 预生成任务 ====================
+# 用法：python magic_writing_app.py pregenerate --topics standard_topics.txt [--grades "Grade 3-4,Grade 5-6"] [--force]
+PREGENERATION_BUILDERS = {
+    "vocabulary": EnhancedAIAssistant._vocabulary_messages,
+    "sentences": EnhancedAIAssistant._sentences_messages,
+    "essay": EnhancedAIAssistant._model_essay_messages,
+}
+
+def load_topic_list(path: str) -> List[str]:
+    """每行一个主题，# 开头的行是注释"""
+    with open(path, encoding="utf-8-sig") as f:
+        return [line.strip() for line in f if line.strip() and not line.strip().startswith("#")]
+
+def run_pregeneration(topics: List[str], grades: List[str], output_path: str, force: bool = False) -> int:
+    """为每个 主题 × 年级 × 内容类型 生成一份内容写入内容文件，返回新生成的条数。
+    已有且提示词版本一致的内容默认保留，中断后重新运行可以接着生成。"""
+    existing = {}
+    if os.path.exists(output_path) and not force:
+        try:
+            existing = {record["key"]: record for record in ContentStore(output_path).records()}
+        except (OSError, ValueError, KeyError):
+            existing = {}
+    
+    records = []
+    generated = 0
+    total = len(topics) * len(grades) * len(PREGENERATION_BUILDERS)
+    for topic in topics:
+        canonical = canonicalize_topic(topic)
+        for grade in grades:
+            for namespace, build_messages in PREGENERATION_BUILDERS.items():
+                key = TieredCache.make_key(namespace, canonical, grade)
+                version = PROMPTS.version_id(namespace)
+                record = existing.get(key)
+                if record is None or record["version"] != version:
+                    text = run_in_scope(RequestScope(priority="batch"),
+                                        lambda: call_deepseek_api(build_messages(topic, grade), task=namespace))
+                    if not text:
+                        print(f"[跳过] {topic} / {grade} / {namespace}：AI没有返回内容")
+                        continue
+                    record = {"key": key, "namespace": namespace, "grade": grade, "topic": canonical,
+                              "version": version, "value": text}
+                    generated += 1
+                records.append(record)
+                print(f"[{len(records)}/{total}] {topic} / {grade} / {namespace}")
+    
+    ContentStore.write(output_path, records)
+    return generated
+
+def pregeneration_cli(argv: List[str]):
+    import argparse
+    parser = argparse.ArgumentParser(prog="python magic_writing_app.py pregenerate",
+                                     description="预生成标准主题的词汇、句型和范文")
+    parser.add_argument("--topics", required=True, help="主题列表文件，每行一个主题")
+    parser.add_argument("--grades", default=",".join(GRADE_OPTIONS), help="逗号分隔的年级")
+    parser.add_argument("--out", default=CONTENT_STORE_PATH, help="输出的内容文件")
+    parser.add_argument("--force", action="store_true", help="忽略已有内容，全部重新生成")
+    args = parser.parse_args(argv)
+    
+    if is_offline_mode():
+        print("未配置API密钥或模型后端，无法预生成")
+        sys.exit(1)
+    grades = [grade.strip() for grade in args.grades.split(",") if grade.strip()]
+    generated = run_pregeneration(load_topic_list(args.topics), grades, args.out, args.force)
+    print(f"完成：新生成 {generated} 条，已写入 {args.out}")
+
+# 直接用python运行（而不是streamlit run）时作为命令行工具
+if __name__ == "__main__" and not st.runtime.exists() and sys.argv[1:2] == ["pregenerate"]:
+    pregeneration_cli(sys.argv[2:])
+    sys.exit(0)
+
+# ==================== 推测预取 ====================
+PREFETCH_SESSION_TOKENS = int(get_config_value("AI_PREFETCH_SESSION_TOKENS", 20000))  # 每个会话预取最多花费的token（估算），0表示关闭
+PREFETCH_MAX_PARALLEL = int(get_config_value("AI_PREFETCH_MAX_PARALLEL", 2))
+PREFETCH_MIN_TOPIC_LENGTH = 3
+PREFETCH_TARGETS = {
+    "vocabulary": (EnhancedAIAssistant.recommend_vocabulary_for_topic, EnhancedAIAssistant._vocabulary_messages),
+    "sentences": (EnhancedAIAssistant.recommend_sentences_for_topic, EnhancedAIAssistant._sentences_messages),
+    "essay": (EnhancedAIAssistant.recommend_model_essay, EnhancedAIAssistant._model_essay_messages),
+}
+
+class Prefetcher:
+    """写作页的推测预取：主题确定后在后台生成词汇、句型和范文推荐，结果写入共享缓存。
+    所有会话共用少量工作线程，同一个缓存键同时只预取一次"""
+
+    def __init__(self, max_parallel: int):
+        self.executor = ThreadPoolExecutor(max_workers=max_parallel, thread_name_prefix="prefetch")
+        self.in_flight = set()
+        self.lock = threading.Lock()
+        self.scheduled = 0
+        self.completed = 0
+        self.failed = 0
+        self.cancelled = 0
+        self.already_cached = 0
+
+    def submit(self, key: str, job: Callable[[], object]) -> Optional[Future]:
+        """同一个键已在预取时返回None"""
+        with self.lock:
+            if key in self.in_flight:
+                return None
+            self.in_flight.add(key)
+            self.scheduled += 1
+        return self.executor.submit(self._run, key, job)
+
+    def cancel(self, key: str, future: Future) -> bool:
+        """取消还没开始执行的预取任务，已经在执行的不打断"""
+        if not future.cancel():
+            return False
+        with self.lock:
+            self.in_flight.discard(key)
+            self.cancelled += 1
+        return True
+
+    def _run(self, key: str, job: Callable[[], object]):
+        try:
+            # AI不可用时推荐方法会返回离线内容，以缓存里是否有结果为准
+            run_in_scope(RequestScope(priority="prefetch"), job)
+            succeeded = get_response_cache().peek(key) is not None
+        except Exception:
+            succeeded = False
+        with self.lock:
+            self.in_flight.discard(key)
+            if succeeded:
+                self.completed += 1
+            else:
+                self.failed += 1
+
+    def record_cached(self):
+        with self.lock:
+            self.already_cached += 1
+
+    def stats(self) -> Dict:
+        with self.lock:
+            return {"in_flight": len(self.in_flight), "scheduled": self.scheduled, "completed": self.completed,
+                    "failed": self.failed, "cancelled": self.cancelled, "already_cached": self.already_cached}
+
+@st.cache_resource(show_spinner=False)
+def get_prefetcher() -> Prefetcher:
+    return Prefetcher(PREFETCH_MAX_PARALLEL)
+
+def prefetch_topic_resources(topic: str, grade: str) -> int:
+    """为当前会话预取主题的推荐内容，返回新安排的任务数。
+    主题和年级要连续两次运行都没有变化才预取，学生还在修改主题时不预取；换了主题后，旧主题还没开始的任务取消并退回预算。
+    已有新鲜缓存或预生成内容的不再请求；每项按估算token数计入会话预算，超出预算后不再预取"""
+    topic = topic.strip()
+    candidate = (canonicalize_topic(topic), grade)
+    if st.session_state.prefetch_candidate != candidate:
+        st.session_state.prefetch_candidate = candidate
+        cancel_abandoned_prefetches(candidate)
+        return 0
+    if len(topic) < PREFETCH_MIN_TOPIC_LENGTH or is_offline_mode():
+        return 0
+    scheduled = 0
+    prefetcher = get_prefetcher()
+    store = get_content_store()
+    for namespace, (recommend, build_messages) in PREFETCH_TARGETS.items():
+        request_key = (namespace, canonicalize_topic(topic), grade)
+        if request_key in st.session_state.prefetched:
+            continue
+        
+        key = TieredCache.make_key(namespace, resolve_cache_topic(namespace, topic, grade), grade)
+        entry = get_response_cache().peek(key)
+        if (store is not None and store.has(key, namespace)) or (entry is not None and entry.is_fresh(namespace)):
+            st.session_state.prefetched.add(request_key)
+            prefetcher.record_cached()
+            continue
+        
+        cost = estimate_tokens("".join(message["content"] for message in build_messages(topic, grade))) + MAX_COMPLETION_TOKENS
+        if st.session_state.prefetch_spent + cost > PREFETCH_SESSION_TOKENS:
+            break
+        st.session_state.prefetched.add(request_key)
+        future = prefetcher.submit(key, lambda recommend=recommend: recommend(topic, grade))
+        if future is not None:
+            st.session_state.prefetch_spent += cost
+            st.session_state.prefetch_pending[key] = (future, cost, request_key)
+            scheduled += 1
+    return scheduled
+
+def cancel_abandoned_prefetches(candidate: tuple) -> int:
+    """取消本会话中不属于当前主题、还没开始执行的预取任务，退回它们占用的预算，返回取消的任务数"""
+    prefetcher = get_prefetcher()
+    pending = st.session_state.prefetch_pending
+    cancelled = 0
+    for key, (future, cost, request_key) in list(pending.items()):
+        if request_key[1:] == candidate and not future.done():
+            continue
+        del pending[key]
+        if request_key[1:] != candidate and prefetcher.cancel(key, future):
+            st.session_state.prefetch_spent -= cost
+            st.session_state.prefetched.discard(request_key)
+            cancelled += 1
+    return cancelled
+
+# ==================== 后台任务 ====================
+# 任务在调度器里排队时也占着工作线程，线程数按调度器能容纳的请求数来定，排队都发生在调度器里，位置对学生可见
+JOB_MAX_WORKERS = int(get_config_value("AI_JOB_MAX_WORKERS", SCHEDULER_MAX_CONCURRENT + SCHEDULER_MAX_QUEUE))
+JOB_RETENTION_SECONDS = 3600  # 完成的任务保留多久，期间切换页面再回来仍能取到结果
+JOB_POLL_INTERVAL = 0.5  # 页面刷新任务进度的间隔（秒）
+JOB_SLOT_PAGES = {  # 任务在页面上的位置 -> 所属页面，离开页面时取消其中未完成的任务
+    "writing_suggestions": "writing",
+    "model_essay": "writing",
+    "vocab_search": "vocabulary",
+    "vocab_for_writing": "vocabulary",
+    "sentence_search": "sentences",
+    "sentence_for_writing": "sentences",
+    "evaluation": "evaluate",
+}
+
+class Job:
+    """一个后台AI任务：进度、结果和期间产生的提示都保存在这里，由页面轮询读取"""
+
+    def __init__(self, job_id: str, kind: str):
+        self.id = job_id
+        self.kind = kind
+        self.status = "running"  # running / done / failed / cancelled
+        self.result = None
+        self.error: Optional[str] = None
+        self.notices: List[tuple] = []
+        self.progress: Dict = {}
+        self.started_at = time.time()
+        self.finished_at: Optional[float] = None
+        self.cancel_token = CancelToken()
+        self.queue: Dict[int, tuple] = {}  # 排队中的请求 -> (位置, 预计等待秒数)
+        self.lock = threading.Lock()
+
+    @property
+    def done(self) -> bool:
+        return self.status != "running"
+
+    @property
+    def elapsed(self) -> float:
+        return (self.finished_at or time.time()) - self.started_at
+
+    def update(self, **fields):
+        with self.lock:
+            self.progress.update(fields)
+
+    def snapshot(self) -> Dict:
+        with self.lock:
+            return dict(self.progress)
+
+    def cancel(self) -> bool:
+        """请求取消：任务里的AI调用在下一个检查点中止，返回是否确实取消了一个未完成的任务"""
+        return not self.done and self.cancel_token.cancel()
+
+    def report_queue(self, ticket: object, position: Optional[int], eta: Optional[float]):
+        """调度器回调：任务里的请求排队时记录位置和预计等待，开始发送后（position 为None）清除"""
+        with self.lock:
+            if position is None:
+                self.queue.pop(id(ticket), None)
+            else:
+                self.queue[id(ticket)] = (position, eta)
+
+    def queue_status(self) -> Optional[tuple]:
+        """任务里还在排队的请求中最靠前的位置和最长的预计等待；没有排队时返回None"""
+        with self.lock:
+            if not self.queue:
+                return None
+            return min(position for position, _ in self.queue.values()), max(eta for _, eta in self.queue.values())
+
+class JobManager:
+    """所有会话共用的后台任务执行器：AI调用不占用页面脚本线程，页面重跑或切换页面都不会中断请求"""
+
+    def __init__(self, max_workers: int, retention: float):
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="ai-job")
+        self.max_workers = max_workers
+        self.jobs: Dict[str, Job] = {}
+        self.backlog: List[Job] = []  # 已提交、还在等工作线程的任务，按提交顺序
+        self.retention = retention
+        self.lock = threading.Lock()
+
+    def submit(self, kind: str, work: Callable, *args) -> Job:
+        """提交任务，工作线程里执行 work(job, *args)，返回值作为任务结果"""
+        job = Job(uuid.uuid4().hex[:12], kind)
+        with self.lock:
+            self._purge()
+            self.jobs[job.id] = job
+            self.backlog.append(job)
+        self.executor.submit(self._run, job, work, args)
+        return job
+
+    def backlog_status(self, job: Job) -> Optional[tuple]:
+        """任务还在等工作线程时返回 (位置, 预计等待秒数)，已经开始运行返回None"""
+        with self.lock:
+            if job not in self.backlog:
+                return None
+            position = self.backlog.index(job) + 1
+        return position, position * get_scheduler().avg_service / self.max_workers
+
+    def _run(self, job: Job, work: Callable, args: tuple):
+        with self.lock:
+            self.backlog.remove(job)
+        if job.cancel_token.cancelled:
+            # 还没轮到就被取消了，不再执行
+            with job.lock:
+                job.finished_at = time.time()
+                job.status = "cancelled"
+            return
+        try:
+            scope = RequestScope(job.cancel_token, "interactive", job.report_queue)
+            result, notices = run_collecting_notices(lambda: run_in_scope(scope, work, job, *args))
+            status, error = "done", None
+        except Exception as e:
+            result, notices, status, error = None, [], "failed", str(e)[:100]
+        if job.cancel_token.cancelled:
+            # 取消后得到的多半是不完整的结果，不再使用
+            result, notices, status, error = None, [], "cancelled", None
+        with job.lock:
+            job.result = result
+            job.notices.extend(notices)
+            job.error = error
+            job.finished_at = time.time()
+            job.status = status
+
+    def _purge(self):
+        now = time.time()
+        for job_id in [job_id for job_id, job in self.jobs.items()
+                       if job.done and now - job.finished_at > self.retention]:
+            del self.jobs[job_id]
+
+    def get(self, job_id: str) -> Optional[Job]:
+        with self.lock:
+            return self.jobs.get(job_id)
+
+    def stats(self) -> Dict:
+        with self.lock:
+            statuses = [job.status for job in self.jobs.values()]
+            backlog = len(self.backlog)
+        stats = {status: statuses.count(status) for status in ("running", "done", "failed", "cancelled")}
+        stats["backlog"] = backlog
+        return stats
+
+@st.cache_resource(show_spinner=False)
+def get_job_manager() -> JobManager:
+    return JobManager(JOB_MAX_WORKERS, JOB_RETENTION_SECONDS)
+
+def start_job(slot: str, kind: str, work: Callable, *args) -> Job:
+    """提交后台任务，把任务ID按页面上的位置记在会话里；同一位置上还没完成的旧任务被新任务取代，直接取消"""
+    cancel_job(slot)
+    job = get_job_manager().submit(kind, work, *args)
+    st.session_state.jobs[slot] = job.id
+    return job
+
+def current_job(slot: str) -> Optional[Job]:
+    job_id = st.session_state.jobs.get(slot)
+    return get_job_manager().get(job_id) if job_id else None
+
+def cancel_job(slot: str) -> bool:
+    """取消某个位置上未完成的任务并从会话里移除；已完成的任务保留结果"""
+    job = current_job(slot)
+    if job is None or not job.cancel():
+        return False
+    st.session_state.jobs.pop(slot, None)
+    return True
+
+def cancel_page_jobs(page: str) -> int:
+    """取消某个页面上所有未完成的任务，返回取消的个数"""
+    return sum(cancel_job(slot) for slot, slot_page in JOB_SLOT_PAGES.items() if slot_page == page)
+
+def stream_text_job(job: Job, produce: Callable, *args) -> str:
+    """调用 produce(*args, stream=True)，把逐段生成的文本写入任务进度，返回完整文本"""
+    response = produce(*args, stream=True)
+    text = ""
+    for chunk in iter([response]) if isinstance(response, str) else response:
+        text += chunk
+        job.update(text=text)
+    return text
 
-### 1. 定语从句
-**句型：** Noun + that/which + Verb
-**中文：** ...的...
-**例句：**
-- Spring is the season that brings new life.
-- Flowers that bloom in spring are colorful.
+def queue_status_text(job: Job) -> Optional[str]:
+    """任务在等工作线程或请求在调度器排队时的提示；都没有排队时返回None"""
+    status = get_job_manager().backlog_status(job) or job.queue_status()
+    if status is None:
+        return None
+    position, eta = status
+    return f"⏳ 使用人数较多，正在排队：第 {position} 位，预计约 {max(round(eta), 1)} 秒后开始"
 
-### 2. 现在分词作状语
-**句型：** Verb-ing, Subject + Verb
-**中文：** ...着，...
-**例句：**
-- Walking in the park, I enjoy the spring breeze.
-- Seeing flowers bloom, I feel happy.
+def show_text_job(slot: str, waiting_text: str = "🤖 AI正在思考..."):
+    """显示某个位置上的文本任务：进行中时定时刷新进度，完成后显示结果"""
+    job = current_job(slot)
+    if job is None:
+        return
+    if not job.done:
+        poll_text_job(slot, waiting_text)
+        return
+    show_notices(job.notices)
+    if job.status == "failed":
+        st.error(f"生成失败：{job.error}")
+    else:
+        st.markdown(f'<div class="content-box-enhanced">{job.result}</div>', unsafe_allow_html=True)
 
-## 💡 句型组合练习
+@st.fragment(run_every=JOB_POLL_INTERVAL)
+def poll_text_job(slot: str, waiting_text: str):
+    job = current_job(slot)
+    if job is None or job.done:
+        # 整页重跑，按完成后的状态显示并停止轮询
+        st.rerun()
+    text = job.snapshot().get("text")
+    queue_text = queue_status_text(job)
+    if queue_text and not text:
+        st.info(queue_text)
+    st.markdown(f'<div class="content-box-enhanced">{text + "▌" if text else waiting_text}</div>', unsafe_allow_html=True)
 
-### 初级组合
-**原句：** I like spring.
-**扩展：** I like spring because the weather is warm and flowers are beautiful.
+# ==================== 并发分析 ====================
+FULL_ANALYSIS_MAX_PARALLEL = int(get_config_value("AI_FULL_ANALYSIS_MAX_PARALLEL", 4))
+FULL_ANALYSIS_SECTIONS = {
+    "suggestions": "💡 AI详细建议",
+    "vocabulary": "📚 主题词汇推荐",
+    "sentences": "🔤 主题句型推荐",
+}
 
-### 中级组合
-**原句：** Spring is good.
-**扩展：** What I like most about spring is that it brings new life to nature.
+def fan_out(tasks: Dict[str, Callable[[], object]],
+            max_parallel: int = FULL_ANALYSIS_MAX_PARALLEL) -> Iterator[tuple]:
+    """在工作线程里并发执行多个AI任务，按完成顺序产出 (任务名, 结果, 提示列表)；任务取消时抛出 RequestCancelled"""
+    scope = current_scope()
+    executor = ThreadPoolExecutor(max_workers=max(min(len(tasks), max_parallel), 1))
+    try:
+        futures = {executor.submit(run_in_scope, scope, run_collecting_notices, task): name
+                   for name, task in tasks.items()}
+        for future in as_completed(futures):
+            try:
+                result, notices = future.result()
+            except RequestCancelled:
+                raise
+            except Exception:
+                result, notices = None, []
+            yield futures[future], result, notices
+    finally:
+        executor.shutdown(wait=False)
 
-## 🎓 练习建议
+def run_evaluation_job(job: Job, topic: str, grade: str, content: str, full_analysis: bool) -> Dict:
+    """后台评价作文，完整分析时同时并发生成建议和推荐；评分快照和已完成的部分写入任务进度供页面显示"""
+    def on_update(parser: IncrementalJSONParser):
+        job.update(snapshot=(dict(parser.result), parser.partial_text()))
+    
+    if not full_analysis:
+        evaluation = EnhancedAIAssistant.evaluate_writing_detailed(topic, grade, content, on_update=on_update)
+        return {"evaluation": evaluation, "analysis": None}
+    
+    job.update(sections={})
+    analysis_tasks = {
+        "evaluate": lambda: EnhancedAIAssistant.evaluate_writing_detailed(topic, grade, content, on_update=on_update),
+        "suggestions": lambda: EnhancedAIAssistant.provide_detailed_writing_suggestions(topic, grade, content),
+        "vocabulary": lambda: EnhancedAIAssistant.recommend_vocabulary_for_topic(topic, grade),
+        "sentences": lambda: EnhancedAIAssistant.recommend_sentences_for_topic(topic, grade),
+    }
+    evaluation = None
+    analysis_results = {}
+    for name, result, notices in fan_out(analysis_tasks):
+        for level, message in notices:
+            notify(level, message)
+        if name == "evaluate":
+            evaluation = result
+            if evaluation:
+                job.update(snapshot=(evaluation, None))
+            continue
+        analysis_results[name] = result or "（AI暂时无法生成这部分内容，请稍后再试）"
+        job.update(sections=dict(analysis_results))
+    return {"evaluation": evaluation, "analysis": analysis_results}
 
-### 每日练习计划
-1. **句型模仿**：每个句型模仿造2个句子
-2. **句型转换**：把一个句子用不同句型表达
-3. **句子扩展**：把简单句扩展为复杂句
-4. **错误纠正**：检查自己句子的语法错误
+def submit_evaluation_job(pending: Dict) -> Job:
+    return start_job("evaluation", "evaluate", run_evaluation_job,
+                     pending['topic'], pending['grade'], pending['content'], pending.get('full_analysis', False))
 
-### 常见错误提醒
-❌ **错误：** I very like spring.
-✅ **正确：** I like spring very much.
+def show_notices(notices: List[tuple]):
+    for level, message in notices:
+        # 重试进度只在请求进行时有意义，完成后不再显示
+        if level != "info":
+            getattr(st, level)(message)
 
-❌ **错误：** Spring weather is warm and nice.
-✅ **更好：** Spring weather is pleasantly warm and enjoyable.
+def show_analysis_section(name: str, text: Optional[str]):
+    st.markdown(f"### {FULL_ANALYSIS_SECTIONS[name]}")
+    if text is None:
+        st.markdown('<div class="content-box-enhanced">⏳ AI正在生成...</div>', unsafe_allow_html=True)
+    else:
+        st.markdown(f'<div class="content-box-enhanced">{text}</div>', unsafe_allow_html=True)
 
-## 📝 写作应用
+# ==================== 评价卡片渲染 ====================
+def render_overall_score_html(score) -> str:
+    """总体评分卡片"""
+    return f"""
+    <div class="overall-score">
+        <div style="font-size: 1.2rem; margin-bottom: 10px;">总体评分</div>
+        <div class="score-number">{score}</div>
+        <div class="score-text">/ 100</div>
+        <div class="score-scale">
+            <div>0</div>
+            <div>25</div>
+            <div>50</div>
+            <div>75</div>
+            <div>100</div>
+        </div>
+    </div>
+    """
 
-### 开头句参考
-- Among the four seasons, I prefer spring the most.
-- Spring is undoubtedly my favorite season.
+def render_dimension_card_html(dimension: str, score: Optional[int]) -> str:
+    """单个维度的评分卡片；score为None时显示评分中"""
+    color = DIMENSION_COLORS.get(dimension, "#4D96FF")
+    icon = DIMENSION_ICONS.get(dimension, "📊")
+    name = DIMENSION_NAMES.get(dimension, dimension)
+    desc = DIMENSION_DESCRIPTIONS.get(dimension, "")
+    score_text = "⏳ 评分中" if score is None else f"{score}/100"
+    width = 0 if score is None else score
+    
+    return f"""
+    <div class="dimension-card" style="border-left-color: {color};">
+        <div class="dimension-header">
+            <div class="dimension-title">
+                <span>{icon}</span>
+                <div>
+                    <div style="font-size: 1.1rem; font-weight: 700;">{name}</div>
+                    <div style="font-size: 0.85rem; color: #666;">{desc}</div>
+                </div>
+            </div>
+            <div class="dimension-score">{score_text}</div>
+        </div>
+        <div class="score-bar">
+            <div class="score-fill" style="width: {width}%; background: {color};"></div>
+        </div>
+        <div style="display: flex; justify-content: space-between; font-size: 0.85rem; color: #666;">
+            <div>需改进</div>
+            <div>优秀</div>
+        </div>
+    </div>
+    """
 
-### 中间句参考
-- One of the reasons why I love spring is...
-- What makes spring special is...
+@st.fragment(run_every=JOB_POLL_INTERVAL)
+def show_evaluation_job_progress():
+    """评价任务进行中的实时视图：总分、各维度分数和正在生成的评语；完成后整页重跑显示完整报告"""
+    job = current_job("evaluation")
+    if job is None or job.done:
+        st.rerun()
+    progress = job.snapshot()
+    result, partial = progress.get("snapshot", ({}, None))
+    
+    st.info(f"🤖 AI正在深度评价你的作文...（已用时 {job.elapsed:.0f} 秒，离开本页会停止评价）")
+    queue_text = queue_status_text(job)
+    if queue_text:
+        st.info(queue_text)
+    overall = to_score(result.get("overall_score"))
+    st.markdown(render_overall_score_html("⏳" if overall is None else overall), unsafe_allow_html=True)
+    st.markdown("### 📊 多维度评分分析")
+    raw_dimensions = result.get("dimension_scores")
+    scores = {}
+    if isinstance(raw_dimensions, dict):
+        scores = {normalize_dimension_key(key): to_score(value) for key, value in list(raw_dimensions.items())}
+    live_cols = st.columns(2)
+    for idx, dimension in enumerate(DIMENSION_NAMES):
+        with live_cols[idx % 2]:
+            st.markdown(render_dimension_card_html(dimension, scores.get(dimension)), unsafe_allow_html=True)
+    if partial:
+        st.markdown(f'<div class="content-box-enhanced">{EnhancedAIAssistant._as_text(partial[1])}▌</div>',
+                    unsafe_allow_html=True)
+    
+    sections = progress.get("sections")
+    if sections is not None:
+        for name in FULL_ANALYSIS_SECTIONS:
+            show_analysis_section(name, sections.get(name))
 
-### 结尾句参考
-- In conclusion, spring is truly a wonderful season.
-- That's why spring holds a special place in my heart.
+# ==================== 评价报告缓存 ====================
+# 报告各部分的HTML按评价ID缓存在共享的模板缓存里，页面重跑、切换标签页、在成长记录里展开旧评价时直接复用
+def evaluation_report_id(evaluation: Dict) -> str:
+    """评价ID：评价内容的哈希，内容相同的评价共用一份渲染结果"""
+    if evaluation.get("evaluation_id"):
+        return evaluation["evaluation_id"]
+    content = {key: value for key, value in evaluation.items() if key not in ("from_cache", "evaluation_id")}
+    raw = json.dumps(content, ensure_ascii=False, sort_keys=True, default=str)
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()[:16]
 
-✨ **多练习这些句型，你的英语写作会越来越流畅！**
-"""
+def build_evaluation_report(evaluation: Dict) -> Dict[str, str]:
+    """渲染评价报告的各个部分；维度卡片按页面的两列布局分成左右两组"""
+    dimensions = list(evaluation['dimension_scores'].items())
+    suggestions = evaluation.get('improvement_suggestions', [])
+    suggestion_html = "".join(f"""
+        <div class="ai-suggestion-point">
+            <div class="suggestion-title">
+                <span style="background: #4D96FF; color: white; width: 24px; height: 24px; border-radius: 50%; display: flex; align-items: center; justify-content: center; font-size: 0.9rem;">{i}</span>
+                {suggestion}
+            </div>
+        </div>
+        """ for i, suggestion in enumerate(suggestions, 1))
+    encouragement_html = ""
+    if 'encouragement' in evaluation:
+        encouragement_html = f"""
+        <div class="ai-suggestion-card" style="background: linear-gradient(135deg, #E8FFF0, #F0FFF8); border-left-color: #33CC33;">
+            <div class="ai-suggestion-header">
+                <span>🌟</span> 鼓励与总结
+            </div>
+            <div style="font-size: 1.1rem; line-height: 1.6; color: #2D3748;">
+                {evaluation['encouragement']}
+            </div>
+        </div>
+        """
+    return {
+        "overall": render_overall_score_html(evaluation['overall_score']),
+        "dimensions_left": "".join(render_dimension_card_html(dimension, score) for dimension, score in dimensions[0::2]),
+        "dimensions_right": "".join(render_dimension_card_html(dimension, score) for dimension, score in dimensions[1::2]),
+        "english": f"""
+        <div class="content-box-enhanced">
+            {evaluation['english_evaluation']}
+        </div>
+        """,
+        "chinese": f"""
+        <div class="content-box-enhanced">
+            {evaluation['chinese_evaluation']}
+        </div>
+        """,
+        "suggestions": suggestion_html,
+        "encouragement": encouragement_html
+    }
+
+def get_evaluation_report(evaluation: Dict) -> Dict[str, str]:
+    """按评价ID取渲染好的报告，没有时渲染一次并缓存"""
+    report_json = cached_template("report", lambda _: json.dumps(build_evaluation_report(evaluation), ensure_ascii=False),
+                                  evaluation_report_id(evaluation))
+    return json.loads(report_json)
+
+def show_evaluation_report(evaluation: Dict):
+    """显示评分卡片、中英文评价、改进建议和鼓励；每个部分一次输出，减少页面元素数量"""
+    report = get_evaluation_report(evaluation)
+    st.markdown(report["overall"], unsafe_allow_html=True)
+    
+    st.markdown("### 📊 多维度评分分析")
+    col1, col2 = st.columns(2)
+    with col1:
+        st.markdown(report["dimensions_left"], unsafe_allow_html=True)
+    with col2:
+        st.markdown(report["dimensions_right"], unsafe_allow_html=True)
+    
+    st.markdown("### 📝 详细评价报告")
+    tab1, tab2 = st.tabs(["🇺🇸 英文评价", "🇨🇳 中文评价"])
+    with tab1:
+        st.markdown(report["english"], unsafe_allow_html=True)
+    with tab2:
+        st.markdown(report["chinese"], unsafe_allow_html=True)
+    
+    st.markdown("### 💡 具体改进建议")
+    if report["suggestions"]:
+        st.markdown(report["suggestions"], unsafe_allow_html=True)
+    if report["encouragement"]:
+        st.markdown(report["encouragement"], unsafe_allow_html=True)
+
+# ==================== 页面切换 ====================
+# 离开页面时取消该页面上未完成的AI任务，归还上游并发名额；已经完成的结果保留，回来后仍能看到
+if st.session_state.page != st.session_state.last_page:
+    left_page = st.session_state.last_page
+    st.session_state.last_page = st.session_state.page
+    cancelled_jobs = cancel_page_jobs(left_page)
+    if left_page == "evaluate" and current_job("evaluation") is None:
+        # 评价已取消，回到评价页时不再重新提交
+        st.session_state.pending_evaluation = None
+    if cancelled_jobs:
+        st.toast(f"已停止离开页面上 {cancelled_jobs} 个未完成的AI生成")
 
 # ==================== 侧边栏 ====================
 with st.sidebar:
@@ -1388,6 +5001,14 @@ with st.sidebar:
             st.session_state.page = item["id"]
             st.rerun()
     
+    # 离开评价页时刚好完成的评价还没显示过，提示回去查看
+    if st.session_state.pending_evaluation and st.session_state.page != "evaluate":
+        evaluation_job = current_job("evaluation")
+        if evaluation_job is not None and evaluation_job.status == "done":
+            st.success("✅ 作文评价已完成，点击「智能作品评价」查看")
+        elif evaluation_job is not None and evaluation_job.done:
+            st.warning("⚠️ 作文评价没有成功，点击「智能作品评价」重试")
+    
     st.markdown("<hr style='border-color: rgba(255,255,255,0.3)'>", unsafe_allow_html=True)
     
     # 系统状态显示
@@ -1396,16 +5017,128 @@ with st.sidebar:
     status_col1, status_col2 = st.columns(2)
     
     with status_col1:
-        if OFFLINE_MODE:
+        ai_status, _ = get_ai_status()
+        if ai_status == "在线":
+            st.success("🟢 在线")
+        elif ai_status == "离线":
             st.error("🔴 离线")
         else:
-            st.success("🟢 在线")
+            st.warning(f"🟠 {ai_status}")
     
     with status_col2:
         st.info(f"📊 {len(st.session_state.writing_history)}篇")
-    
+
+    if SHOW_OPERATOR_PANELS and not is_offline_mode():
+        with st.expander("🔌 连接池统计", expanded=False):
+            pool_stats = get_http_transport().stats()
+            st.caption(f"请求总数：{pool_stats['requests']}")
+            st.caption(f"复用连接：{pool_stats['reused_connections']} ｜ 新建连接：{pool_stats['new_connections']}")
+            st.caption(f"空闲连接：{pool_stats['idle_connections']} ｜ 每主机上限：{pool_stats['pool_maxsize']}")
+            flight_stats = get_single_flight().stats()
+            st.caption(f"上游调用：{flight_stats['upstream_calls']} ｜ 合并重复请求：{flight_stats['deduplicated']}")
+
+        with st.expander("🗄️ 响应缓存", expanded=False):
+            cache_stats = get_response_cache().stats()
+            st.caption(f"内存命中：{cache_stats['memory_hits']} ｜ 磁盘命中：{cache_stats['disk_hits']} ｜ 未命中：{cache_stats['misses']}")
+            st.caption(f"命中率：{cache_stats['hit_rate']:.0%}")
+            st.caption(f"内存：{cache_stats['memory']['entries']} 条 / {cache_stats['memory']['bytes'] // 1024} KB")
+            if cache_stats['disk'] is not None:
+                st.caption(f"磁盘：{cache_stats['disk']['entries']} 条 / {cache_stats['disk']['bytes'] // 1024} KB ｜ "
+                           f"待刷新：{cache_stats['disk']['stale_entries']} 条")
+            revalidate_stats = get_cache_revalidator().stats()
+            st.caption(f"过期命中：{cache_stats['stale_hits']} 次（最旧 {cache_stats['max_stale_age'] / 3600:.1f} 小时）｜ "
+                       f"后台刷新：{revalidate_stats['refreshed']} 次，进行中 {revalidate_stats['in_flight']}")
+            content_store = get_content_store()
+            if content_store is not None:
+                store_stats = content_store.stats()
+                st.caption(f"预生成：{store_stats['entries']} 条 ｜ 命中：{store_stats['hits']} 次 ｜ 生成于 {store_stats['created_at']}")
+            topic_stats = get_topic_index().stats()
+            st.caption(f"主题：{topic_stats['topics']} 个 ｜ 近似匹配：{topic_stats['fuzzy']} 次")
+            prefetch_stats = get_prefetcher().stats()
+            st.caption(f"预取：完成 {prefetch_stats['completed']} ｜ 进行中 {prefetch_stats['in_flight']} ｜ "
+                       f"失败 {prefetch_stats['failed']} ｜ 已取消 {prefetch_stats['cancelled']} ｜ 已有缓存 {prefetch_stats['already_cached']}")
+
+        with st.expander("🚦 限流状态", expanded=False):
+            pool_summary = get_key_pool().stats()
+            st.caption(f"已放行：{pool_summary['granted']} ｜ 排队超时：{pool_summary['rejected']} ｜ 平均排队：{pool_summary['avg_wait']} 秒")
+            for key_stats in pool_summary['keys']:
+                st.caption(f"🔑 {key_stats['key']}：{key_stats['granted']} 次 ｜ {key_stats['tokens_used']} tokens ｜ "
+                           f"429 {key_stats['rate_limited']} 次 ｜ {key_stats['rpm']} 次/分钟")
+                if key_stats['benched_for'] > 0:
+                    st.caption(f"⏸️ 停用中（{key_stats['bench_reason']}），{key_stats['benched_for']} 秒后恢复")
+            health_stats = get_health_monitor().stats()
+            if health_stats['last_check_ago'] is not None:
+                latency_text = f"，延迟 {health_stats['latency']} 秒" if health_stats['latency'] is not None else ""
+                st.caption(f"🩺 {health_stats['last_check_ago']} 秒前健康检查{latency_text}")
+        
+        with st.expander("🧮 上下文缓存", expanded=False):
+            prompt_cache_stats = get_prompt_cache_stats().stats()
+            if not prompt_cache_stats:
+                st.caption("暂无数据")
+            for version_id, task_stats in prompt_cache_stats.items():
+                if task_stats['hit_rate'] is None:
+                    st.caption(f"**{version_id}**：{task_stats['requests']} 次（上游未返回缓存用量）")
+                    continue
+                st.caption(f"**{version_id}**：命中率 {task_stats['hit_rate']:.0%} ｜ "
+                           f"命中 {task_stats['hit_tokens']} / 未命中 {task_stats['miss_tokens']} tokens")
+                st.caption(f"平均每次：输入 {task_stats['avg_prompt_tokens']} / 输出 {task_stats['avg_completion_tokens']} tokens")
+                if task_stats['hit_latency'] is not None and task_stats['miss_latency'] is not None:
+                    st.caption(f"平均延迟：命中 {task_stats['hit_latency']} 秒 ｜ 未命中 {task_stats['miss_latency']} 秒")
+        
+        with st.expander("📝 提示词版本", expanded=False):
+            for template_stats in PROMPTS.stats():
+                st.caption(f"**{template_stats['version_id']}**：system约 {template_stats['system_tokens']} tokens"
+                           f"（压缩前 {template_stats['raw_tokens']}）｜ 已注册 {', '.join(template_stats['versions'])}")
+        
+        with st.expander("🧩 模型后端", expanded=False):
+            for backend in get_backends():
+                if not backend.is_configured():
+                    continue
+                backend_stats = backend.stats()
+                breaker_stats = backend_stats['breaker']
+                probe = health_stats['backends'].get(backend.name)
+                health_icon = "⚪" if probe is None else ("🟢" if probe['healthy'] else "🔴")
+                st.caption(f"{health_icon} **{backend.name}**（{backend.model}）：并发 {backend_stats['active']}/{backend_stats['concurrency']} ｜ "
+                           f"请求 {backend_stats['requests']} ｜ 转移 {backend_stats['failovers']}")
+                st.caption(f"熔断次数：{breaker_stats['trips']} ｜ 直接兜底：{breaker_stats['short_circuited']}")
+                if breaker_stats['retry_in'] > 0:
+                    st.caption(f"⚡ 熔断中，{breaker_stats['retry_in']} 秒后探测恢复")
+                for latency_key, latency_stats in backend_stats['latency'].items():
+                    if latency_stats['p95'] is not None:
+                        st.caption(f"⏱️ {latency_key}：P95 {latency_stats['p95']:.1f}秒 → 超时 {latency_stats['timeout']}秒")
+        
+        with st.expander("🧵 后台任务", expanded=False):
+            job_stats = get_job_manager().stats()
+            st.caption(f"进行中：{job_stats['running']}（等待线程 {job_stats['backlog']}）｜ 完成：{job_stats['done']} ｜ "
+                       f"失败：{job_stats['failed']} ｜ 已取消：{job_stats['cancelled']}")
+            cancel_stats = get_cancellation_stats().stats()
+            st.caption(f"中止上游请求：发送前 {cancel_stats['before_send']} ｜ 生成中 {cancel_stats['mid_stream']} ｜ "
+                       f"约省下 {cancel_stats['saved_tokens']} tokens")
+        
+        with st.expander("🚥 请求调度", expanded=False):
+            scheduler_stats = get_scheduler().stats()
+            st.caption(f"上游进行中：{scheduler_stats['active']}/{scheduler_stats['max_concurrent']} ｜ "
+                       f"平均占用 {scheduler_stats['avg_service']} 秒")
+            for priority, class_stats in scheduler_stats['classes'].items():
+                st.caption(f"**{priority}**：进行中 {class_stats['active']} ｜ 排队 {class_stats['queued']} ｜ "
+                           f"已放行 {class_stats['granted']}（平均等待 {class_stats['avg_wait']} 秒）｜ 拒绝 {class_stats['rejected']}")
+
+    if SHOW_OPERATOR_PANELS:
+        with st.expander("🧠 共享内存", expanded=False):
+            response_memory = get_response_cache().memory.stats()
+            template_memory = get_template_cache().stats()
+            for label, memory_stats in (("AI结果", response_memory), ("离线模板", template_memory)):
+                st.caption(f"{label}：{memory_stats['entries']} 条 ｜ {memory_stats['bytes'] // 1024} / {memory_stats['max_bytes'] // 1024} KB")
+                st.caption(f"淘汰：{memory_stats['evictions']} 次 ｜ 超过单条上限（{memory_stats['max_entry_bytes'] // 1024} KB）：{memory_stats['rejected']} 次")
+                st.progress(min(memory_stats['bytes'] / memory_stats['max_bytes'], 1.0))
+            content_store = get_content_store()
+            if content_store is not None:
+                st.caption(f"预生成内容（mmap）：{content_store.stats()['bytes'] // 1024} KB")
+            pool_stats = get_http_transport().stats()
+            st.caption(f"HTTP连接：空闲 {pool_stats['idle_connections']} ｜ 每主机上限 {pool_stats['pool_maxsize']}")
+
     # API配置提示
-    if OFFLINE_MODE:
+    if is_offline_mode():
         st.markdown("---")
         with st.expander("🔧 启用AI功能", expanded=False):
             st.warning("AI功能未启用")
@@ -1432,6 +5165,16 @@ with st.sidebar:
         4. 在成长记录查看进步
         """)
 
+# ==================== 按钮回调 ====================
+# 回调在下一次运行开始、控件创建之前执行，可以修改输入框绑定的session_state
+def clear_writing():
+    st.session_state.writing_topic = ''
+    st.session_state.writing_content = ''
+    # 放弃这篇作文：进行中的建议和范文生成直接取消
+    for slot in ("writing_suggestions", "model_essay"):
+        cancel_job(slot)
+        st.session_state.jobs.pop(slot, None)
+
 # ==================== 主页 ====================
 if st.session_state.page == 'home':
     # 增强版标题区域
@@ -1551,10 +5294,9 @@ if st.session_state.page == 'home':
         st.metric("💾 保存草稿", draft_count, "个")
     
     with stat_cols[3]:
-        if OFFLINE_MODE:
-            st.metric("🤖 AI状态", "离线", "需配置")
-        else:
-            st.metric("🤖 AI状态", "在线", "已连接")
+        ai_status, ai_status_detail = get_ai_status()
+        st.metric("🤖 AI状态", ai_status, ai_status_detail,
+                  delta_color="normal" if ai_status == "在线" else "off")
 
 # ==================== 写作工坊页面 ====================
 elif st.session_state.page == 'writing':
@@ -1581,7 +5323,7 @@ elif st.session_state.page == 'writing':
         
         writing_grade = st.selectbox(
             "**适合年级**",
-            ["Grade 1-2", "Grade 3-4", "Grade 5-6", "Grade 7-8"],
+            GRADE_OPTIONS,
             index=1,
             key="writing_grade"
         )
@@ -1599,6 +5341,17 @@ elif st.session_state.page == 'writing':
     with col2:
         st.markdown("### 🛠️ 创作工具")
         
+        if PREFETCH_SESSION_TOKENS > 0:
+            prefetch_enabled = st.toggle(
+                "⚡ 提前准备推荐", key="prefetch_enabled",
+                help="输入主题后在后台提前生成词汇、句型和范文，点击工具按钮时可以立即显示"
+            )
+            if prefetch_enabled:
+                # 主题清空也要记录，之后重新输入同一主题时仍然等下一次运行再预取
+                prefetch_topic_resources(writing_topic or "", writing_grade)
+                if st.session_state.prefetch_spent >= PREFETCH_SESSION_TOKENS:
+                    st.caption("本次预取额度已用完")
+        
         tool_cols = st.columns(2)
         
         with tool_cols[0]:
@@ -1606,8 +5359,9 @@ elif st.session_state.page == 'writing':
                 if writing_topic:
                     st.session_state.page = "vocabulary"
                     st.session_state.search_for_writing = True
-                    st.session_state.writing_topic = writing_topic
-                    st.session_state.writing_grade = writing_grade
+                    # writing_topic/writing_grade 是输入框的key，控件创建后不能再赋值，用单独的键传给目标页面
+                    st.session_state.tool_topic = writing_topic
+                    st.session_state.tool_grade = writing_grade
                     st.rerun()
                 else:
                     st.warning("请输入主题")
@@ -1617,8 +5371,9 @@ elif st.session_state.page == 'writing':
                 if writing_topic:
                     st.session_state.page = "sentences"
                     st.session_state.search_for_writing = True
-                    st.session_state.writing_topic = writing_topic
-                    st.session_state.writing_grade = writing_grade
+                    # writing_topic/writing_grade 是输入框的key，控件创建后不能再赋值，用单独的键传给目标页面
+                    st.session_state.tool_topic = writing_topic
+                    st.session_state.tool_grade = writing_grade
                     st.rerun()
                 else:
                     st.warning("请输入主题")
@@ -1638,36 +5393,31 @@ elif st.session_state.page == 'writing':
         # 查看范文
         if st.button("📖 参考范文", use_container_width=True, key="view_example"):
             if writing_topic:
-                with st.spinner("🤖 AI正在生成范文..."):
-                    example = EnhancedAIAssistant.recommend_sentences_for_topic(writing_topic, writing_grade)
-                    st.markdown("### 📖 写作参考")
-                    st.markdown(f'<div class="content-box-enhanced">{example}</div>', unsafe_allow_html=True)
+                start_job("model_essay", "essay", stream_text_job,
+                          EnhancedAIAssistant.recommend_model_essay, writing_topic, writing_grade)
             else:
                 st.warning("请输入主题")
+        if current_job("model_essay") is not None:
+            st.markdown("### 📖 写作参考")
+            show_text_job("model_essay", waiting_text="🤖 AI正在生成范文...")
     
     # 操作按钮区域
     st.markdown("<br>", unsafe_allow_html=True)
     
+    full_analysis = st.toggle(
+        "🚀 完整分析：提交评价时同时生成详细建议、主题词汇和句型推荐",
+        key="full_analysis",
+        help="几项AI分析并发进行，总等待时间约等于最慢的一项"
+    )
+    
     btn_col1, btn_col2, btn_col3 = st.columns(3)
     
     with btn_col1:
         if st.button("💡 AI详细建议", use_container_width=True, type="primary", key="ai_suggest"):
             if writing_content and writing_topic:
-                with st.spinner("🤖 AI正在深度分析你的作文..."):
-                    suggestions = EnhancedAIAssistant.provide_detailed_writing_suggestions(
-                        writing_topic, writing_grade, writing_content
-                    )
-                    
-                    # 显示详细的AI建议
-                    st.markdown("""
-                    <div class="ai-suggestion-card">
-                        <div class="ai-suggestion-header">
-                            <span>🤖</span> AI智能写作分析报告
-                        </div>
-                    </div>
-                    """, unsafe_allow_html=True)
-                    
-                    st.markdown(f'<div class="content-box-enhanced">{suggestions}</div>', unsafe_allow_html=True)
+                start_job("writing_suggestions", "suggestions", stream_text_job,
+                          EnhancedAIAssistant.provide_detailed_writing_suggestions,
+                          writing_topic, writing_grade, writing_content)
             else:
                 st.warning("请先完成写作内容")
     
@@ -1683,29 +5433,32 @@ elif st.session_state.page == 'writing':
                 }
                 st.session_state.writing_history.append(writing_record)
                 
-                # 获取评价
-                with st.spinner("🤖 AI正在深度评价你的作文..."):
-                    evaluation = EnhancedAIAssistant.evaluate_writing_detailed(writing_topic, writing_grade, writing_content)
-                    st.session_state.evaluation_content = evaluation
-                    
-                    # 保存评价历史
-                    evaluation_record = {
-                        'topic': writing_topic,
-                        'evaluation': evaluation,
-                        'timestamp': datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-                    }
-                    st.session_state.evaluation_history.append(evaluation_record)
-                
+                # 评价在后台任务里进行，评价页面定时刷新，每个分数一生成就先显示
+                st.session_state.pending_evaluation = {
+                    'topic': writing_topic,
+                    'grade': writing_grade,
+                    'content': writing_content,
+                    'full_analysis': full_analysis
+                }
+                submit_evaluation_job(st.session_state.pending_evaluation)
                 st.session_state.page = "evaluate"
                 st.rerun()
             else:
                 st.warning("请先完成写作")
     
     with btn_col3:
-        if st.button("🔄 重新开始", use_container_width=True, key="clear_writing"):
-            st.session_state.writing_topic = ''
-            st.session_state.writing_content = ''
-            st.rerun()
+        st.button("🔄 重新开始", use_container_width=True, key="clear_writing", on_click=clear_writing)
+    
+    # AI详细建议（后台生成，切换页面后回来仍然保留）
+    if current_job("writing_suggestions") is not None:
+        st.markdown("""
+        <div class="ai-suggestion-card">
+            <div class="ai-suggestion-header">
+                <span>🤖</span> AI智能写作分析报告
+            </div>
+        </div>
+        """, unsafe_allow_html=True)
+        show_text_job("writing_suggestions", waiting_text="🤖 AI正在深度分析你的作文...")
 
 # ==================== 词汇助手页面 ====================
 elif st.session_state.page == 'vocabulary':
@@ -1720,6 +5473,15 @@ elif st.session_state.page == 'vocabulary':
     tab1, tab2 = st.tabs(["🔍 智能搜索", "📚 主题分类"])
     
     with tab1:
+        # 从写作页的工具按钮跳转过来：直接显示当前作文主题的推荐（预取过的会立即显示）
+        if st.session_state.search_for_writing and st.session_state.tool_topic:
+            start_job("vocab_for_writing", "vocabulary", stream_text_job, EnhancedAIAssistant.recommend_vocabulary_for_topic,
+                      st.session_state.tool_topic, st.session_state.tool_grade)
+            st.session_state.search_for_writing = False
+        if current_job("vocab_for_writing") is not None:
+            st.markdown(f"### ✏️ 为你的作文「{st.session_state.tool_topic}」推荐词汇")
+            show_text_job("vocab_for_writing", waiting_text="🤖 AI正在智能推荐词汇...")
+        
         st.markdown("### 🔍 智能词汇搜索")
         
         search_topic = st.text_input(
@@ -1730,24 +5492,17 @@ elif st.session_state.page == 'vocabulary':
         
         search_grade = st.selectbox(
             "选择年级",
-            ["Grade 1-2", "Grade 3-4", "Grade 5-6", "Grade 7-8"],
+            GRADE_OPTIONS,
             index=1,
             key="vocab_grade"
         )
         
         if st.button("🔍 智能搜索词汇", type="primary", use_container_width=True, key="search_vocab"):
             if search_topic:
-                with st.spinner("🤖 AI正在智能推荐词汇..."):
-                    try:
-                        recommendation = EnhancedAIAssistant.recommend_vocabulary_for_topic(search_topic, search_grade)
-                        st.markdown(f'<div class="content-box-enhanced">{recommendation}</div>', unsafe_allow_html=True)
-                    except Exception as e:
-                        st.error(f"搜索失败：{str(e)[:100]}")
-                        st.info("正在使用本地词汇库...")
-                        # 显示本地备用
-                        st.markdown(f'<div class="content-box-enhanced">主题"{search_topic}"的词汇推荐正在准备中...</div>', unsafe_allow_html=True)
+                start_job("vocab_search", "vocabulary", stream_text_job, EnhancedAIAssistant.recommend_vocabulary_for_topic, search_topic, search_grade)
             else:
                 st.warning("请输入写作主题")
+        show_text_job("vocab_search", waiting_text="🤖 AI正在智能推荐词汇...")
     
     with tab2:
         st.markdown("### 📚 主题词汇库")
@@ -1780,6 +5535,15 @@ elif st.session_state.page == 'sentences':
     tab1, tab2 = st.tabs(["🔍 智能搜索", "📖 句型宝库"])
     
     with tab1:
+        # 从写作页的工具按钮跳转过来：直接显示当前作文主题的推荐（预取过的会立即显示）
+        if st.session_state.search_for_writing and st.session_state.tool_topic:
+            start_job("sentence_for_writing", "sentences", stream_text_job, EnhancedAIAssistant.recommend_sentences_for_topic,
+                      st.session_state.tool_topic, st.session_state.tool_grade)
+            st.session_state.search_for_writing = False
+        if current_job("sentence_for_writing") is not None:
+            st.markdown(f"### ✏️ 为你的作文「{st.session_state.tool_topic}」推荐句型")
+            show_text_job("sentence_for_writing", waiting_text="🤖 AI正在智能推荐句型...")
+        
         st.markdown("### 🔍 智能句型搜索")
         
         search_topic = st.text_input(
@@ -1790,24 +5554,17 @@ elif st.session_state.page == 'sentences':
         
         search_grade = st.selectbox(
             "选择年级",
-            ["Grade 1-2", "Grade 3-4", "Grade 5-6", "Grade 7-8"],
+            GRADE_OPTIONS,
             index=1,
             key="sentence_grade"
         )
         
         if st.button("🔍 智能搜索句型", type="primary", use_container_width=True, key="search_sentences"):
             if search_topic:
-                with st.spinner("🤖 AI正在智能推荐句型..."):
-                    try:
-                        recommendation = EnhancedAIAssistant.recommend_sentences_for_topic(search_topic, search_grade)
-                        st.markdown(f'<div class="content-box-enhanced">{recommendation}</div>', unsafe_allow_html=True)
-                    except Exception as e:
-                        st.error(f"搜索失败：{str(e)[:100]}")
-                        st.info("正在使用本地句型库...")
-                        # 显示本地备用
-                        st.markdown(f'<div class="content-box-enhanced">主题"{search_topic}"的句型推荐正在准备中...</div>', unsafe_allow_html=True)
+                start_job("sentence_search", "sentences", stream_text_job, EnhancedAIAssistant.recommend_sentences_for_topic, search_topic, search_grade)
             else:
                 st.warning("请输入写作主题")
+        show_text_job("sentence_search", waiting_text="🤖 AI正在智能推荐句型...")
 
 # ==================== 作品评价页面 ====================
 elif st.session_state.page == 'evaluate':
@@ -1819,7 +5576,7 @@ elif st.session_state.page == 'evaluate':
     """, unsafe_allow_html=True)
     
     # 网络状态检查
-    if OFFLINE_MODE:
+    if is_offline_mode():
         st.markdown("""
         <div class="network-status">
             <h3>⚠️ 离线模式</h3>
@@ -1828,25 +5585,71 @@ elif st.session_state.page == 'evaluate':
         </div>
         """, unsafe_allow_html=True)
     
-    # 评价内容
-    if st.session_state.evaluation_content:
-        evaluation = st.session_state.evaluation_content
-    else:
-        # 如果没有评价内容，使用默认示例
-        st.info("暂无评价内容，请先提交作文进行评价")
-        
-        # 示例评价
-        evaluation = {
-            "overall_score": 85,
-            "dimension_scores": {
-                "structure": 82,
-                "vocabulary": 80,
-                "phrases": 78,
-                "sentence_patterns": 85,
-                "grammar": 88,
-                "content": 90
-            },
-            "english_evaluation": """
+    # 刚提交的作文：评价在后台任务里进行，页面定时刷新进度，总分和各维度分数到达后立即显示
+    evaluation_running = False
+    evaluation_failed = False
+    if st.session_state.pending_evaluation:
+        pending = st.session_state.pending_evaluation
+        evaluation_job = current_job("evaluation")
+        if evaluation_job is None:
+            # 服务重启等原因任务已经不在了，重新提交
+            evaluation_job = submit_evaluation_job(pending)
+        if not evaluation_job.done:
+            evaluation_running = True
+            show_evaluation_job_progress()
+        elif evaluation_job.status != "done" or not (evaluation_job.result or {}).get("evaluation"):
+            # 评价失败不拿离线示例分数顶替，保留作文让学生重试
+            evaluation_failed = True
+            show_notices(evaluation_job.notices)
+            if evaluation_job.status == "cancelled":
+                st.warning("⏹️ 作文评价已取消")
+            else:
+                st.error(f"❌ 作文评价失败：{evaluation_job.error or 'AI没有返回评价结果'}")
+            if st.button("🔄 重新评价", key="retry_evaluation", type="primary"):
+                submit_evaluation_job(pending)
+                st.rerun()
+        else:
+            show_notices(evaluation_job.notices)
+            job_result = evaluation_job.result
+            evaluation = job_result["evaluation"]
+            analysis_results = job_result.get("analysis")
+            
+            evaluation['evaluation_id'] = evaluation_report_id(evaluation)
+            st.session_state.evaluation_content = evaluation
+            st.session_state.pending_evaluation = None
+            st.session_state.analysis_results = dict(analysis_results, evaluation_id=evaluation['evaluation_id']) \
+                if analysis_results is not None else None
+            
+            # 保存评价历史；离线示例评分不是真实评价，不计入历史
+            if not evaluation.get('is_offline'):
+                evaluation_record = {
+                    'topic': pending['topic'],
+                    'evaluation': evaluation,
+                    'timestamp': datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+                }
+                st.session_state.evaluation_history.append(evaluation_record)
+    
+    # 评价进行中只显示实时进度，失败时只显示错误和重试
+    if not evaluation_running and not evaluation_failed:
+        # 评价内容
+        if st.session_state.evaluation_content:
+            evaluation = st.session_state.evaluation_content
+        else:
+            # 如果没有评价内容，使用默认示例
+            st.info("暂无评价内容，请先提交作文进行评价")
+            
+            # 示例评价
+            evaluation = {
+                "overall_score": 85,
+                "dimension_scores": {
+                    "structure": 82,
+                    "vocabulary": 80,
+                    "phrases": 78,
+                    "sentence_patterns": 85,
+                    "grammar": 88,
+                    "content": 90
+                },
+                "english_evaluation": """
 📝 **English Evaluation for "My Favorite Season"**
 
 **Overall Assessment:**
@@ -1878,7 +5681,7 @@ This is a good effort! The essay shows understanding of the topic and generally
 ✅ **Strengths:** Addresses the topic with relevant ideas.
 📝 **Areas for Improvement:** Add more specific details and examples to support main points.
 """,
-            "chinese_evaluation": """
+                "chinese_evaluation": """
 📝 **中文评价报告 - "My Favorite Season"**
 
 **总体评估：**
@@ -1910,168 +5713,50 @@ This is a good effort! The essay shows understanding of the topic and generally
 ✅ **优点：** 围绕主题表达了相关观点。
 📝 **改进建议：** 增加更多具体细节和例子来支持主要观点。
 """,
-            "improvement_suggestions": [
-                "Add more descriptive details to make your writing more vivid.",
-                "Try using different sentence structures to make your essay more interesting.",
-                "Proofread carefully for grammar and spelling errors.",
-                "Include specific examples to support your main ideas.",
-                "Practice using new vocabulary words in your writing."
-            ],
-            "encouragement": "Great effort! Keep practicing and you will continue to improve your English writing skills. Remember, every great writer started somewhere! 🌟"
-        }
-    
-    # 显示总体评分
-    st.markdown(f"""
-    <div class="overall-score">
-        <div style="font-size: 1.2rem; margin-bottom: 10px;">总体评分</div>
-        <div class="score-number">{evaluation['overall_score']}</div>
-        <div class="score-text">/ 100</div>
-        <div class="score-scale">
-            <div>0</div>
-            <div>25</div>
-            <div>50</div>
-            <div>75</div>
-            <div>100</div>
-        </div>
-    </div>
-    """, unsafe_allow_html=True)
-    
-    # 显示各维度评分
-    st.markdown("### 📊 多维度评分分析")
-    
-    dimension_colors = {
-        "structure": "#4D96FF",
-        "vocabulary": "#FF9A3D",
-        "phrases": "#6BCF7F",
-        "sentence_patterns": "#9D4DFF",
-        "grammar": "#FF3366",
-        "content": "#33CC33"
-    }
-    
-    dimension_icons = {
-        "structure": "🏗️",
-        "vocabulary": "📚",
-        "phrases": "💬",
-        "sentence_patterns": "🔤",
-        "grammar": "✓",
-        "content": "📝"
-    }
-    
-    dimension_names = {
-        "structure": "结构",
-        "vocabulary": "词汇",
-        "phrases": "短语",
-        "sentence_patterns": "句型",
-        "grammar": "语法",
-        "content": "内容"
-    }
-    
-    dimension_descriptions = {
-        "structure": "段落组织、逻辑连贯性",
-        "vocabulary": "词汇丰富度、准确性",
-        "phrases": "固定搭配、习惯用语",
-        "sentence_patterns": "句式多样性、复杂度",
-        "grammar": "语法准确性、时态一致性",
-        "content": "内容充实度、主题相关性"
-    }
-    
-    # 创建两列显示维度评分
-    col1, col2 = st.columns(2)
-    
-    dimensions = list(evaluation['dimension_scores'].keys())
-    for idx, dimension in enumerate(dimensions):
-        score = evaluation['dimension_scores'][dimension]
-        color = dimension_colors.get(dimension, "#4D96FF")
-        icon = dimension_icons.get(dimension, "📊")
-        name = dimension_names.get(dimension, dimension)
-        desc = dimension_descriptions.get(dimension, "")
+                "improvement_suggestions": [
+                    "Add more descriptive details to make your writing more vivid.",
+                    "Try using different sentence structures to make your essay more interesting.",
+                    "Proofread carefully for grammar and spelling errors.",
+                    "Include specific examples to support your main ideas.",
+                    "Practice using new vocabulary words in your writing."
+                ],
+                "encouragement": "Great effort! Keep practicing and you will continue to improve your English writing skills. Remember, every great writer started somewhere! 🌟"
+            }
         
-        with (col1 if idx % 2 == 0 else col2):
-            st.markdown(f"""
-            <div class="dimension-card" style="border-left-color: {color};">
-                <div class="dimension-header">
-                    <div class="dimension-title">
-                        <span>{icon}</span>
-                        <div>
-                            <div style="font-size: 1.1rem; font-weight: 700;">{name}</div>
-                            <div style="font-size: 0.85rem; color: #666;">{desc}</div>
-                        </div>
-                    </div>
-                    <div class="dimension-score">{score}/100</div>
-                </div>
-                <div class="score-bar">
-                    <div class="score-fill" style="width: {score}%; background: {color};"></div>
-                </div>
-                <div style="display: flex; justify-content: space-between; font-size: 0.85rem; color: #666;">
-                    <div>需改进</div>
-                    <div>优秀</div>
-                </div>
-            </div>
-            """, unsafe_allow_html=True)
-    
-    # 显示详细评价
-    st.markdown("### 📝 详细评价报告")
-    
-    tab1, tab2 = st.tabs(["🇺🇸 英文评价", "🇨🇳 中文评价"])
-    
-    with tab1:
-        st.markdown(f"""
-        <div class="content-box-enhanced">
-            {evaluation['english_evaluation']}
-        </div>
-        """, unsafe_allow_html=True)
-    
-    with tab2:
-        st.markdown(f"""
-        <div class="content-box-enhanced">
-            {evaluation['chinese_evaluation']}
-        </div>
-        """, unsafe_allow_html=True)
-    
-    # 显示改进建议
-    st.markdown("### 💡 具体改进建议")
-    
-    suggestions = evaluation.get('improvement_suggestions', [])
-    for i, suggestion in enumerate(suggestions, 1):
-        st.markdown(f"""
-        <div class="ai-suggestion-point">
-            <div class="suggestion-title">
-                <span style="background: #4D96FF; color: white; width: 24px; height: 24px; border-radius: 50%; display: flex; align-items: center; justify-content: center; font-size: 0.9rem;">{i}</span>
-                {suggestion}
-            </div>
-        </div>
-        """, unsafe_allow_html=True)
-    
-    # 显示鼓励性总结
-    if 'encouragement' in evaluation:
-        st.markdown(f"""
-        <div class="ai-suggestion-card" style="background: linear-gradient(135deg, #E8FFF0, #F0FFF8); border-left-color: #33CC33;">
-            <div class="ai-suggestion-header">
-                <span>🌟</span> 鼓励与总结
-            </div>
-            <div style="font-size: 1.1rem; line-height: 1.6; color: #2D3748;">
-                {evaluation['encouragement']}
-            </div>
-        </div>
-        """, unsafe_allow_html=True)
-    
-    # 操作按钮
-    st.markdown("<br>", unsafe_allow_html=True)
-    col1, col2, col3 = st.columns(3)
-    
-    with col1:
-        if st.button("✏️ 重新修改", use_container_width=True, key="revise_essay"):
-            st.session_state.page = "writing"
-            st.rerun()
-    
-    with col2:
-        if st.button("💾 保存评价", use_container_width=True, key="save_evaluation"):
-            st.success("✅ 评价已保存到历史记录！")
-    
-    with col3:
-        if st.button("📊 查看历史", use_container_width=True, key="view_history"):
-            st.session_state.page = "progress"
-            st.rerun()
+        if evaluation.get('is_offline'):
+            st.warning("⚠️ AI评价暂时不可用，以下是离线示例评价，分数不代表你的作文水平，也不会保存到评价历史")
+        if evaluation.get('is_partial'):
+            st.info("ℹ️ AI评价内容生成不完整，已保留AI给出的评分，缺失部分用默认内容补充")
+        if evaluation.get('from_cache'):
+            st.caption("♻️ 作文内容没有变化，显示的是上次的评价结果")
+        
+        # 评分卡片、详细评价、改进建议和鼓励（按评价ID缓存渲染结果）
+        show_evaluation_report(evaluation)
+        
+        # 完整分析生成的建议和推荐
+        analysis_results = st.session_state.analysis_results
+        if analysis_results and analysis_results.get('evaluation_id') == evaluation.get('evaluation_id'):
+            for name in FULL_ANALYSIS_SECTIONS:
+                if analysis_results.get(name):
+                    show_analysis_section(name, analysis_results[name])
+        
+        # 操作按钮
+        st.markdown("<br>", unsafe_allow_html=True)
+        col1, col2, col3 = st.columns(3)
+        
+        with col1:
+            if st.button("✏️ 重新修改", use_container_width=True, key="revise_essay"):
+                st.session_state.page = "writing"
+                st.rerun()
+        
+        with col2:
+            if st.button("💾 保存评价", use_container_width=True, key="save_evaluation"):
+                st.success("✅ 评价已保存到历史记录！")
+        
+        with col3:
+            if st.button("📊 查看历史", use_container_width=True, key="view_history"):
+                st.session_state.page = "progress"
+                st.rerun()
 
 # ==================== 成长记录页面 ====================
 elif st.session_state.page == 'progress':
@@ -2099,14 +5784,8 @@ elif st.session_state.page == 'progress':
         for i, evaluation_record in enumerate(reversed(st.session_state.evaluation_history[-5:]), 1):
             evaluation = evaluation_record['evaluation']
             with st.expander(f"{i}. {evaluation_record['topic']} - 评分: {evaluation['overall_score']}/100 - {evaluation_record['timestamp']}"):
-                # 显示评分概览
-                cols = st.columns(6)
-                for idx, (dimension, score) in enumerate(evaluation['dimension_scores'].items()):
-                    with cols[idx]:
-                        st.metric(
-                            dimension_names.get(dimension, dimension),
-                            f"{score}/100"
-                        )
+                # 复用评价页渲染过的报告
+                show_evaluation_report(evaluation)
     
     # 如果没有历史记录
     if not st.session_state.writing_history and not st.session_state.evaluation_history:
@@ -2147,7 +5826,7 @@ with footer_cols[2]:
     st.caption("🚀 增强版 v4.0")
 
 # ==================== API配置提示 ====================
-if OFFLINE_MODE:
+if is_offline_mode():
     st.markdown("---")
     with st.expander("🚀 启用完整AI功能", expanded=True):
         st.markdown("### 🤖 解锁AI魔法功能")
@@ -2197,4 +5876,5 @@ DEEPSEEK_API_KEY="sk-a9b0d92a0d474ca6acd0ceb24360fef8"
         st.write("4. 创建新的API密钥（目前免费）")
         
         if st.button("🔄 我已配置，重新检查", key="recheck_api"):
+            get_health_monitor().check_now()
             st.rerun()
@@ -0,0 +1,19 @@
+"""测试共用的夹具"""
+import importlib.util
+import os
+
+import pytest
+
+APP_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "magic_writing_app.py")
+
+
+@pytest.fixture(scope="session")
+def app(tmp_path_factory):
+    # 应用是Streamlit脚本，没有页面上下文时以bare模式执行；缓存文件放到临时目录
+    cache_dir = tmp_path_factory.mktemp("cache")
+    os.environ["AI_CACHE_DB_PATH"] = str(cache_dir / "cache.sqlite3")
+    os.environ["AI_CONTENT_STORE_PATH"] = str(cache_dir / "missing.bin")
+    spec = importlib.util.spec_from_file_location("magic_writing_app", APP_PATH)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
@@ -0,0 +1,25 @@
+"""熔断器：健康检查连续失败才熔断"""
+
+
+def make_breaker(app):
+    return app.CircuitBreaker(0.5, 15, 0.8, 30, probe_failures=3)
+
+
+def test_single_failed_probe_does_not_trip(app):
+    breaker = make_breaker(app)
+    breaker.on_health_probe(False)
+    breaker.on_health_probe(False)
+    breaker.on_health_probe(True)
+    breaker.on_health_probe(False)
+    assert breaker.state == app.CircuitBreaker.CLOSED
+    assert breaker.allow_request()
+
+
+def test_consecutive_failed_probes_trip(app):
+    breaker = make_breaker(app)
+    for _ in range(3):
+        breaker.on_health_probe(False)
+    assert breaker.state == app.CircuitBreaker.OPEN
+    assert breaker.trips == 1
+    breaker.on_health_probe(True)
+    assert breaker.state == app.CircuitBreaker.HALF_OPEN
@@ -0,0 +1,43 @@
+"""预生成内容文件：写入读出、提示词版本不一致时不使用旧内容"""
+
+
+def make_record(app, topic, namespace="vocabulary", grade="Grade 5-6", version=None, value="text"):
+    return {"key": app.TieredCache.make_key(namespace, topic, grade), "namespace": namespace, "grade": grade,
+            "topic": topic, "version": version or app.PROMPTS.version_id(namespace), "value": value}
+
+
+def test_round_trip(app, tmp_path):
+    path = str(tmp_path / "store.bin")
+    records = [make_record(app, "school", value="学校 school"), make_record(app, "family", namespace="sentences")]
+    app.ContentStore.write(path, records)
+    store = app.ContentStore(path)
+    assert store.get(records[0]["key"], "vocabulary") == "学校 school"
+    assert store.get(records[1]["key"], "sentences") == "text"
+    assert store.get("missing") is None
+    assert [record["value"] for record in store.records()] == ["学校 school", "text"]
+    assert store.stats()["entries"] == 2
+
+
+def test_outdated_version_is_a_miss(app, tmp_path):
+    path = str(tmp_path / "store.bin")
+    record = make_record(app, "school", version="vocabulary@old")
+    app.ContentStore.write(path, [record])
+    store = app.ContentStore(path)
+    assert not store.has(record["key"], "vocabulary")
+    assert store.get(record["key"], "vocabulary") is None
+    # 不指定 namespace 时按原样读出，供重新生成时比较版本
+    assert store.get(record["key"]) == "text"
+
+
+def test_pregeneration_regenerates_only_outdated_records(app, tmp_path, monkeypatch):
+    path = str(tmp_path / "store.bin")
+    monkeypatch.setattr(app, "PREGENERATION_BUILDERS", {"vocabulary": lambda topic, grade: []})
+    app.ContentStore.write(path, [make_record(app, "school", value="kept"),
+                                  make_record(app, "family", version="vocabulary@old", value="old")])
+    calls = []
+    monkeypatch.setattr(app, "call_deepseek_api", lambda messages, task=None: calls.append(task) or "new")
+    assert app.run_pregeneration(["school", "family"], ["Grade 5-6"], path) == 1
+    store = app.ContentStore(path)
+    assert [record["value"] for record in store.records()] == ["kept", "new"]
+    assert store.get(app.TieredCache.make_key("vocabulary", "family", "Grade 5-6"), "vocabulary") == "new"
+    assert calls == ["vocabulary"]
@@ -0,0 +1,58 @@
+"""作文评价：流中途断开时保留已解析的评分，任务取消不被吞掉"""
+import pytest
+
+
+def stream(*chunks, error=None):
+    def produce(*args, **kwargs):
+        def chunks_then_error():
+            yield from chunks
+            if error is not None:
+                raise error
+        return chunks_then_error()
+    return produce
+
+
+def test_cancelled_stream_propagates(app, monkeypatch):
+    monkeypatch.setattr(app, "is_offline_mode", lambda: False)
+    monkeypatch.setattr(app, "call_deepseek_api", stream('{"overall_score": 80', error=app.RequestCancelled()))
+    with pytest.raises(app.RequestCancelled):
+        app.EnhancedAIAssistant.evaluate_writing_detailed("Cancelled topic", "Grade 7-8", "I like it.", on_update=lambda parser: None)
+
+
+def test_cut_stream_keeps_scores_as_partial(app, monkeypatch):
+    monkeypatch.setattr(app, "is_offline_mode", lambda: False)
+    monkeypatch.setattr(app, "call_deepseek_api", stream('{"overall_score": 80, ',
+                                                          error=app.StreamIncomplete("AI回复中途断开")))
+    evaluation = app.EnhancedAIAssistant.evaluate_writing_detailed("Cut topic", "Grade 7-8", "I like it.", on_update=lambda parser: None)
+    assert evaluation["overall_score"] == 80
+    assert evaluation["is_partial"] is True
+    assert not evaluation.get("is_offline")
+
+
+def test_chunked_evaluation_cache_follows_chunk_prompt_version(app, monkeypatch):
+    part = {"overall_score": 82, "dimension_scores": {name: 82 for name in app.DIMENSION_NAMES},
+            "english_evaluation": "Good.", "chinese_evaluation": "不错。",
+            "improvement_suggestions": ["Use more linking words."], "encouragement": "Keep going!"}
+    calls = []
+
+    def fake_api(messages, **kwargs):
+        calls.append(kwargs.get("task"))
+        return app.json.dumps(part)
+
+    monkeypatch.setattr(app, "is_offline_mode", lambda: False)
+    monkeypatch.setattr(app, "call_deepseek_api", fake_api)
+    content = "\n\n".join(f"Paragraph {index}. " + "I went to the park with my friends and we played games. " * 40
+                          for index in range(3))
+    assert len(app.split_essay(content)) > 1
+
+    first = app.EnhancedAIAssistant.evaluate_writing_detailed("A day in the park", "Grade 7-8", content)
+    assert first["is_partial"] is False and set(calls) == {"evaluate_chunk"}
+    cached = app.EnhancedAIAssistant.evaluate_writing_detailed("A day in the park", "Grade 7-8", content)
+    assert cached.get("from_cache") is True
+
+    # 分段提示词换了版本，旧的合并结果不再使用
+    template = app.PROMPTS.get("evaluate_chunk")
+    new_version = app.PromptTemplate("evaluate_chunk", "v-test", template.system, template.user)
+    monkeypatch.setitem(app.PROMPTS.templates, "evaluate_chunk", {**app.PROMPTS.templates["evaluate_chunk"], "v-test": new_version})
+    fresh = app.EnhancedAIAssistant.evaluate_writing_detailed("A day in the park", "Grade 7-8", content)
+    assert not fresh.get("from_cache")
@@ -0,0 +1,45 @@
+"""完整分析的并发执行：总耗时接近最慢的任务，单个任务失败不影响其他任务，取消会传出来"""
+import time
+
+import pytest
+
+
+def slow(value, delay):
+    def task():
+        time.sleep(delay)
+        return value
+    return task
+
+
+def test_tasks_run_concurrently_and_yield_in_completion_order(app):
+    started = time.monotonic()
+    results = list(app.fan_out({"slow": slow("a", 0.4), "fast": slow("b", 0.1), "middle": slow("c", 0.25)},
+                               max_parallel=3))
+    assert time.monotonic() - started < 0.7
+    assert [(name, result) for name, result, _ in results] == [("fast", "b"), ("middle", "c"), ("slow", "a")]
+
+
+def test_failed_task_yields_none(app):
+    def broken():
+        raise ValueError("boom")
+
+    results = {name: result for name, result, _ in app.fan_out({"ok": slow("fine", 0), "broken": broken})}
+    assert results == {"ok": "fine", "broken": None}
+
+
+def test_notices_are_collected_per_task(app):
+    def noisy():
+        app.notify("warning", "retrying")
+        return "done"
+
+    [(name, result, notices)] = list(app.fan_out({"noisy": noisy}))
+    assert (name, result) == ("noisy", "done")
+    assert notices == [("warning", "retrying")]
+
+
+def test_cancellation_propagates(app):
+    def cancelled():
+        raise app.RequestCancelled()
+
+    with pytest.raises(app.RequestCancelled):
+        list(app.fan_out({"cancelled": cancelled, "ok": slow("fine", 0.2)}))
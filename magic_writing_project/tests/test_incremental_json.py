@@ -0,0 +1,41 @@
+"""流式JSON增量解析：字段跨段到达、转义序列被截断时也能得到正确结果"""
+
+
+def feed_all(app, chunks):
+    parser = app.IncrementalJSONParser()
+    for chunk in chunks:
+        parser.feed(chunk)
+    return parser
+
+
+def test_fields_split_across_chunks(app):
+    parser = feed_all(app, ['```json\n{"overall', '_score": 8', '5, "dimension_scores": {"grammar": 9',
+                            '0}, "improvement_suggestions": ["a", "b', '"]', '}\n```'])
+    assert parser.done
+    assert parser.result == {"overall_score": 85, "dimension_scores": {"grammar": 90},
+                             "improvement_suggestions": ["a", "b"]}
+
+
+def test_field_is_available_as_soon_as_it_completes(app):
+    parser = app.IncrementalJSONParser()
+    assert parser.feed('{"overall_score": 7') == {}
+    assert parser.feed('8, "english') == {"overall_score": 78}
+
+
+def test_escapes_split_across_chunks(app):
+    parser = feed_all(app, ['{"text": "He said \\', '"hi\\', '" \\u4f', '60\\u597d\\n', 'end"}'])
+    assert parser.result == {"text": 'He said "hi" 你好\nend'}
+
+
+def test_partial_text_drops_truncated_escape(app):
+    parser = app.IncrementalJSONParser()
+    parser.feed('{"english_evaluation": "Good work \\u4f')
+    assert parser.partial_text() == ("english_evaluation", "Good work ")
+    parser.feed('60 \\')
+    assert parser.partial_text() == ("english_evaluation", "Good work 你 ")
+    assert parser.finish() == {"english_evaluation": "Good work 你 "}
+
+
+def test_malformed_value_does_not_lose_other_fields(app):
+    parser = feed_all(app, ['{"overall_score": 8x, "encouragement": "Keep going"}'])
+    assert parser.result == {"encouragement": "Keep going"}
@@ -0,0 +1,29 @@
+"""后台任务：等工作线程的任务能看到排队位置，轮到之前取消就不再执行"""
+import threading
+import time
+
+
+def wait_done(job):
+    while not job.done:
+        time.sleep(0.01)
+
+
+def test_backlog_position_and_cancel_before_start(app):
+    manager = app.JobManager(1, 60)
+    release = threading.Event()
+    ran = []
+    first = manager.submit("block", lambda job: release.wait(5))
+    second = manager.submit("second", lambda job: ran.append(job.id))
+    third = manager.submit("third", lambda job: "ok")
+    while manager.backlog_status(first) is not None:
+        time.sleep(0.01)
+    assert manager.backlog_status(second)[0] == 1
+    assert manager.backlog_status(third)[0] == 2
+    assert manager.stats()["backlog"] == 2
+    assert second.cancel()
+    release.set()
+    for job in (first, second, third):
+        wait_done(job)
+    assert second.status == "cancelled" and ran == []
+    assert third.status == "done" and third.result == "ok"
+    assert manager.stats()["backlog"] == 0
@@ -0,0 +1,39 @@
+"""密钥池：额度用完时等待或换用其他密钥，统计只用序号标识密钥，不暴露密钥片段"""
+
+
+def elapse(limiter, seconds):
+    # 把上次补充的时间往前移，相当于过去了 seconds 秒
+    limiter.last_refill -= seconds
+
+
+def test_stats_use_opaque_key_labels(app):
+    keys = ["sk-0123456789abcdef0001", "sk-0123456789abcdef0002"]
+    pool = app.ApiKeyPool(60, 120000)
+    pool.sync(keys)
+    assert [key_stats["key"] for key_stats in pool.stats()["keys"]] == ["#1", "#2"]
+    assert not any(key[:5] in str(pool.stats()) or key[-4:] in str(pool.stats()) for key in keys)
+    # 删除第一个密钥后序号跟着配置列表走
+    pool.sync(keys[1:])
+    assert [key_stats["key"] for key_stats in pool.stats()["keys"]] == ["#1"]
+
+
+def test_pool_waits_for_refill_and_rejects_after_timeout(app):
+    pool = app.ApiKeyPool(requests_per_minute=1, tokens_per_minute=100000)
+    pool.sync(["sk-test-one"])
+    assert pool.acquire(10, timeout=0.1) is not None
+    assert pool.acquire(10, timeout=0.1) is None
+    assert pool.stats()["rejected"] == 1
+    elapse(pool.states["sk-test-one"].limiter, 60)
+    assert pool.acquire(10, timeout=0.1) is not None
+
+
+def test_pool_moves_to_another_key_when_one_is_exhausted(app):
+    pool = app.ApiKeyPool(requests_per_minute=1, tokens_per_minute=100000)
+    pool.sync(["sk-test-one", "sk-test-two"])
+    first = pool.acquire(10, timeout=0.1)
+    second = pool.acquire(10, timeout=0.1)
+    assert {first.label, second.label} == {"#1", "#2"}
+    pool.on_rate_limited(first, retry_after=30)
+    elapse(first.limiter, 60)
+    elapse(second.limiter, 60)
+    assert pool.acquire(10, timeout=0.1) is second
@@ -0,0 +1,68 @@
+"""推测预取：主题稳定后才预取，换主题时退回未执行任务的预算，预算用完后不再预取"""
+from concurrent.futures import Future
+
+import pytest
+
+
+class FakePrefetcher:
+    """不执行任务的预取器，任务在测试中手动取消"""
+
+    def __init__(self):
+        self.submitted = []
+        self.cancelled = []
+
+    def submit(self, key, job):
+        self.submitted.append(key)
+        return Future()
+
+    def cancel(self, key, future):
+        self.cancelled.append(key)
+        return future.cancel()
+
+    def record_cached(self):
+        pass
+
+
+@pytest.fixture
+def prefetch(app, monkeypatch):
+    prefetcher = FakePrefetcher()
+    monkeypatch.setattr(app, "get_prefetcher", lambda: prefetcher)
+    monkeypatch.setattr(app, "is_offline_mode", lambda: False)
+    state = app.st.session_state
+    state.prefetched = set()
+    state.prefetch_spent = 0
+    state.prefetch_candidate = None
+    state.prefetch_pending = {}
+    return prefetcher
+
+
+def test_topic_is_prefetched_only_after_it_settles(app, prefetch):
+    assert app.prefetch_topic_resources("my summer holiday", "Grade 5-6") == 0
+    assert prefetch.submitted == []
+    assert app.prefetch_topic_resources("my summer holiday", "Grade 5-6") == len(app.PREFETCH_TARGETS)
+    # 已经预取过的主题不再重复
+    assert app.prefetch_topic_resources("my summer holiday", "Grade 5-6") == 0
+
+
+def test_abandoned_topic_is_refunded(app, prefetch):
+    app.prefetch_topic_resources("my summer holiday", "Grade 5-6")
+    app.prefetch_topic_resources("my summer holiday", "Grade 5-6")
+    assert app.st.session_state.prefetch_spent > 0
+    assert app.prefetch_topic_resources("my best friend", "Grade 5-6") == 0
+    assert len(prefetch.cancelled) == len(app.PREFETCH_TARGETS)
+    assert app.st.session_state.prefetch_spent == 0
+    assert app.st.session_state.prefetched == set()
+
+
+def test_budget_exhaustion_stops_prefetching(app, prefetch, monkeypatch):
+    monkeypatch.setattr(app, "PREFETCH_SESSION_TOKENS", app.MAX_COMPLETION_TOKENS + 1000)
+    app.prefetch_topic_resources("my summer holiday", "Grade 5-6")
+    assert app.prefetch_topic_resources("my summer holiday", "Grade 5-6") == 1
+    spent = app.st.session_state.prefetch_spent
+    assert 0 < spent <= app.PREFETCH_SESSION_TOKENS
+    # 已经开始执行的任务不退回预算，换主题后也不能再预取
+    future, _, _ = next(iter(app.st.session_state.prefetch_pending.values()))
+    future.set_running_or_notify_cancel()
+    app.prefetch_topic_resources("my best friend", "Grade 5-6")
+    assert app.prefetch_topic_resources("my best friend", "Grade 5-6") == 0
+    assert app.st.session_state.prefetch_spent == spent
@@ -0,0 +1,40 @@
+"""提示词注册表：默认使用最后注册的版本，可以按配置固定版本，system部分紧凑保存"""
+
+
+def make_registry(app, overrides=None):
+    registry = app.PromptRegistry(overrides or {})
+    registry.register("greet", "v1", "  You are a teacher.\n\n   Be kind.  ", "Topic: {topic}")
+    registry.register("greet", "v2", "You are a strict teacher.", "Topic: {topic}!")
+    return registry
+
+
+def test_latest_version_is_used_by_default(app):
+    registry = make_registry(app)
+    assert registry.get("greet").version == "v2"
+    assert registry.version_id("greet") == "greet@v2"
+
+
+def test_override_pins_a_version(app):
+    registry = make_registry(app, {"greet": "v1"})
+    assert registry.version_id("greet") == "greet@v1"
+    # 配置了不存在的版本时退回最新版本
+    assert make_registry(app, {"greet": "v9"}).version_id("greet") == "greet@v2"
+
+
+def test_unknown_task_uses_its_name_as_version(app):
+    assert make_registry(app).version_id("health_check") == "health_check"
+
+
+def test_render_uses_compact_system_prompt(app):
+    registry = make_registry(app, {"greet": "v1"})
+    messages = registry.get("greet").render(topic="My school")
+    assert messages == [{"role": "system", "content": "You are a teacher.\nBe kind."},
+                        {"role": "user", "content": "Topic: My school"}]
+    template = registry.get("greet")
+    assert template.system_tokens <= template.raw_tokens
+
+
+def test_app_prompts_are_registered(app):
+    stats = {entry["version_id"].split("@")[0]: entry for entry in app.PROMPTS.stats()}
+    assert {"evaluate", "vocabulary", "sentences", "essay"} <= set(stats)
+    assert all(entry["system_tokens"] > 0 for entry in stats.values())
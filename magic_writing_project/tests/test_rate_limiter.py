@@ -0,0 +1,35 @@
+"""令牌桶限流：额度用完后给出等待时间，随时间补充，429后暂停并降速"""
+
+
+def elapse(limiter, seconds):
+    # 把上次补充的时间往前移，相当于过去了 seconds 秒
+    limiter.last_refill -= seconds
+
+
+def test_exhausted_bucket_reports_wait_and_refills(app):
+    limiter = app.TokenBucketRateLimiter(requests_per_minute=2, tokens_per_minute=100000)
+    assert limiter.try_acquire(10) == 0
+    assert limiter.try_acquire(10) == 0
+    wait = limiter.try_acquire(10)
+    assert 29 < wait <= 30
+    elapse(limiter, 30)
+    assert limiter.try_acquire(10) == 0
+
+
+def test_token_bucket_limits_large_requests(app):
+    limiter = app.TokenBucketRateLimiter(requests_per_minute=100, tokens_per_minute=600)
+    assert limiter.try_acquire(500) == 0
+    assert 39 < limiter.try_acquire(500) <= 40
+    # 超过桶容量的请求按容量计算，等桶满后可以拿到
+    elapse(limiter, 60)
+    assert limiter.try_acquire(10000) == 0
+
+
+def test_rate_limited_pauses_and_slows_down(app):
+    limiter = app.TokenBucketRateLimiter(requests_per_minute=60, tokens_per_minute=100000)
+    limiter.on_rate_limited(retry_after=5)
+    assert limiter.try_acquire(10) >= 4.9
+    assert limiter.stats()["rate_factor"] == limiter.RATE_DECREASE
+    limiter.record_usage(10, 10)
+    assert limiter.stats()["rate_factor"] == limiter.RATE_DECREASE + limiter.RATE_INCREASE
+
@@ -0,0 +1,41 @@
+"""两级响应缓存：内存淘汰后从SQLite回填，提示词换版本后旧内容不再作为新鲜内容返回"""
+
+
+def make_cache(app, tmp_path, max_bytes=10000):
+    disk = app.SQLiteCache(str(tmp_path / "cache.sqlite3"), max_entries=100, max_topics=100)
+    return app.TieredCache(app.MemoryLRUCache(max_bytes), disk, ttl=3600)
+
+
+def test_disk_hit_is_promoted_to_memory(app, tmp_path):
+    cache = make_cache(app, tmp_path)
+    key = cache.make_key("vocabulary", "school", "Grade 5-6")
+    cache.put(key, "vocabulary", "school words")
+    cache.memory.entries.clear()
+    assert cache.get(key, "vocabulary") == "school words"
+    assert cache.get(key, "vocabulary") == "school words"
+    stats = cache.stats()
+    assert (stats["disk_hits"], stats["memory_hits"]) == (1, 1)
+
+
+def test_entries_evicted_from_memory_are_still_on_disk(app, tmp_path):
+    cache = make_cache(app, tmp_path, max_bytes=300)
+    keys = [cache.make_key("vocabulary", f"topic {index}", "Grade 5-6") for index in range(5)]
+    for index, key in enumerate(keys):
+        cache.put(key, "vocabulary", f"words {index} " * 10)
+    assert cache.memory.stats()["evictions"] > 0
+    assert keys[0] not in cache.memory.entries
+    assert cache.get(keys[0], "vocabulary") == "words 0 " * 10
+    assert keys[0] in cache.memory.entries
+
+
+def test_new_prompt_version_invalidates_entries(app, tmp_path, monkeypatch):
+    cache = make_cache(app, tmp_path)
+    key = cache.make_key("vocabulary", "school", "Grade 5-6")
+    cache.put(key, "vocabulary", "old words")
+    template = app.PROMPTS.get("vocabulary")
+    new_version = app.PromptTemplate("vocabulary", "v-test", template.system, template.user)
+    monkeypatch.setitem(app.PROMPTS.templates, "vocabulary", {**app.PROMPTS.templates["vocabulary"], "v-test": new_version})
+    assert cache.get(key, "vocabulary") is None
+    # 旧内容仍可作为过期内容读出，由后台重新生成
+    entry = cache.lookup(key)
+    assert entry.value == "old words" and not entry.is_fresh("vocabulary")
@@ -0,0 +1,64 @@
+"""请求调度：排队顺序和合并请求的优先级提升"""
+import threading
+import time
+
+
+def start_acquire(scheduler, priority, results, **kwargs):
+    thread = threading.Thread(target=lambda: results.append((priority, scheduler.acquire(priority, 5, **kwargs))))
+    thread.start()
+    return thread
+
+
+def wait_queued(scheduler, count):
+    while len(scheduler.queue) < count:
+        time.sleep(0.01)
+
+
+def test_interactive_is_granted_before_queued_prefetch(app):
+    scheduler = app.PriorityScheduler(1, 0, 10)
+    busy = scheduler.acquire("batch", 1)
+    results = []
+    threads = [start_acquire(scheduler, "prefetch", results)]
+    wait_queued(scheduler, 1)
+    threads.append(start_acquire(scheduler, "interactive", results))
+    wait_queued(scheduler, 2)
+    scheduler.release(busy)
+    while len(results) < 1:
+        time.sleep(0.01)
+    assert results[0][0] == "interactive"
+    scheduler.release(results[0][1])
+    for thread in threads:
+        thread.join()
+    scheduler.release(results[1][1])
+
+
+def test_interactive_joiner_boosts_queued_prefetch_leader(app):
+    scheduler = app.PriorityScheduler(1, 0, 10)
+    busy = scheduler.acquire("batch", 1)
+    flight = app.InFlightRequest("prefetch")
+    results = []
+    leader = start_acquire(scheduler, "prefetch", results, on_enqueue=flight.set_ticket)
+    wait_queued(scheduler, 1)
+    other = start_acquire(scheduler, "prefetch", results)
+    wait_queued(scheduler, 2)
+    # 学生的请求合并进排队中的预取请求，发起者应当排到其他预取请求前面
+    flight.raise_priority("interactive", scheduler)
+    assert scheduler.queue[0] is flight.ticket
+    assert flight.ticket.priority == "interactive"
+    scheduler.release(busy)
+    leader.join()
+    assert results[0][1] is flight.ticket
+    scheduler.release(flight.ticket)
+    other.join()
+    scheduler.release(results[1][1])
+    assert scheduler.stats()["active"] == 0
+
+
+def test_priority_raised_before_enqueue_is_applied(app):
+    scheduler = app.PriorityScheduler(1, 0, 10)
+    flight = app.InFlightRequest("batch")
+    flight.raise_priority("interactive", scheduler)
+    ticket = scheduler.acquire("batch", 1, on_enqueue=flight.set_ticket)
+    assert ticket.priority == "interactive"
+    assert scheduler.stats()["classes"]["interactive"]["active"] == 1
+    scheduler.release(ticket)
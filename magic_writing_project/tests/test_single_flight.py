@@ -0,0 +1,28 @@
+"""请求合并：对应同一条缓存的请求只调用一次上游"""
+import threading
+import time
+
+
+def test_requests_for_same_cache_key_are_coalesced(app, monkeypatch):
+    calls = []
+
+    def fake_request(messages, *args, **kwargs):
+        calls.append(messages[0]["content"])
+        time.sleep(0.3)
+        return "shared result"
+
+    monkeypatch.setattr(app, "is_offline_mode", lambda: False)
+    monkeypatch.setattr(app, "_request_deepseek", fake_request)
+    key = app.TieredCache.make_key("vocabulary", "coalesce topic", "Grade 5-6")
+    results = []
+    threads = [
+        threading.Thread(target=lambda content=content: results.append(
+            app.serve_ai_text("vocabulary", key, [{"role": "user", "content": content}], task="vocabulary")))
+        for content in ("coalesce topic", "Coalesce topic!")
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert results == ["shared result", "shared result"]
+    assert len(calls) == 1
@@ -0,0 +1,36 @@
+"""长作文分段：在段落或句子边界切开，每段不超过上限，内容不丢失"""
+
+
+def words(text):
+    return text.split()
+
+
+def test_short_essay_is_one_chunk(app):
+    content = "My school is big.\n\nI love it."
+    assert app.split_essay(content, max_tokens=100) == [content]
+
+
+def test_chunks_break_at_paragraph_boundaries(app):
+    paragraphs = [f"Paragraph {index}. " + "We played games in the park. " * 8 for index in range(6)]
+    content = "\n\n".join(paragraph.strip() for paragraph in paragraphs)
+    chunks = app.split_essay(content, max_tokens=150)
+    assert len(chunks) > 1
+    assert all(app.estimate_tokens(chunk) <= 150 for chunk in chunks)
+    assert all(chunk.startswith("Paragraph ") and chunk.endswith(".") for chunk in chunks)
+    assert words(" ".join(chunks)) == words(content)
+
+
+def test_long_paragraph_breaks_at_sentence_ends(app):
+    content = " ".join(f"Sentence number {index} is about my family and our weekend trip." for index in range(40))
+    chunks = app.split_essay(content, max_tokens=120)
+    assert len(chunks) > 1
+    assert all(chunk.startswith("Sentence number") and chunk.endswith("trip.") for chunk in chunks)
+    assert words(" ".join(chunks)) == words(content)
+
+
+def test_chunks_have_similar_length(app):
+    content = "\n\n".join("I like reading books about animals and space. " * 5 for _ in range(7))
+    chunks = app.split_essay(content, max_tokens=200)
+    sizes = [app.estimate_tokens(chunk) for chunk in chunks]
+    # 最后一段不会只剩很短的一点
+    assert min(sizes) >= max(sizes) / 2
@@ -0,0 +1,59 @@
+"""主题近似匹配：只合并词形和拼写变体，不合并意思相反的主题"""
+import pytest
+
+
+def resolve(app, known: str, topic: str) -> str:
+    index = app.TopicIndex(app.TOPIC_MATCH_THRESHOLD)
+    group = ("vocabulary", "Grade 7-8")
+    index.add(group, app.canonicalize_topic(known))
+    resolved, _ = index.resolve(group, app.canonicalize_topic(topic))
+    return resolved
+
+
+def test_disadvantages_is_not_merged_with_advantages(app):
+    known = "The advantages of using mobile phones for middle school students"
+    topic = "The disadvantages of using mobile phones for middle school students"
+    assert resolve(app, known, topic) == app.canonicalize_topic(topic)
+
+
+def test_negated_question_is_not_merged(app):
+    known = "Should students wear school uniforms"
+    topic = "Should students not wear school uniforms"
+    assert resolve(app, known, topic) == app.canonicalize_topic(topic)
+
+
+def test_spelling_and_plural_variants_are_merged(app):
+    assert resolve(app, "My favorite season", "My favourite seasons") == "my favorite season"
+    known = "How to protect the environment in our city"
+    assert resolve(app, known, "How to protect the enviroment in our city") == app.canonicalize_topic(known)
+
+
+@pytest.mark.parametrize("known, topic", [
+    ("A visit to my grandparents' house", "A visit to my grandparents' horse"),
+    ("The importance of reading books", "The importance of reading boots"),
+    ("My plans for the summer holiday", "My planes for the summer holiday"),
+])
+def test_different_real_words_are_not_merged(app, known, topic):
+    assert resolve(app, known, topic) == app.canonicalize_topic(topic)
+
+
+def test_inflections_share_a_stem(app):
+    assert app.word_stems("boxes") & app.word_stems("box")
+    assert app.word_stems("horses") & app.word_stems("horse")
+    assert app.word_stems("running") & app.word_stems("run")
+    assert not app.word_stems("planes") & app.word_stems("plans")
+
+
+def test_full_index_does_not_register_new_topics(app):
+    index = app.TopicIndex(app.TOPIC_MATCH_THRESHOLD, max_topics=1)
+    group = ("vocabulary", "Grade 5-6")
+    assert index.resolve(group, "my school") == ("my school", True)
+    assert index.resolve(group, "my family") == ("my family", False)
+    assert index.stats()["topics"] == 1
+
+
+def test_persisted_topics_are_capped(app, tmp_path):
+    disk = app.SQLiteCache(str(tmp_path / "cache.sqlite3"), max_entries=10, max_topics=2)
+    for topic in ("spring", "summer", "autumn"):
+        disk.add_topic("vocabulary", "Grade 5-6", topic)
+    assert disk.load_topics() == [("vocabulary", "Grade 5-6", "summer"), ("vocabulary", "Grade 5-6", "autumn")]
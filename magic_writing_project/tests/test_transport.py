@@ -0,0 +1,49 @@
+"""HTTP传输层：取消时直接断开等待中的请求"""
+import http.server
+import threading
+import time
+
+import pytest
+import requests
+
+
+class SlowHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers["Content-Length"]))
+        time.sleep(3)
+        body = b"{}"
+        self.send_response(200)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def slow_url():
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), SlowHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield f"http://127.0.0.1:{server.server_port}/"
+    server.shutdown()
+
+
+def test_abort_interrupts_request_waiting_for_headers(app, slow_url):
+    transport = app.PooledHTTPTransport(1, 2)
+    abort = app.RequestAbort()
+    threading.Timer(0.3, abort.abort).start()
+    started = time.monotonic()
+    with pytest.raises(requests.exceptions.ConnectionError):
+        transport.post(slow_url, json={}, timeout=(2, 10), stream=True, abort=abort)
+    assert time.monotonic() - started < 1.5
+
+
+def test_finished_request_is_not_aborted(app):
+    abort = app.RequestAbort()
+    abort.finish()
+    abort.abort()
+    assert not abort.aborted